@@ -0,0 +1,333 @@
+"""
+LoRA Adapter Registry
+Keeps several LoRA adapters loaded on one shared base model and switches
+between them, so checkpoints can be attached or detached without a restart
+"""
+
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from export_merged import hash_adapter
+from mixed_lora import MixedLoraBatcher, unsupported_adapters
+
+logger = logging.getLogger(__name__)
+
+_ADAPTER_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+
+class AdapterInUseError(RuntimeError):
+    """Raised when detaching an adapter that queued or running sequences still use"""
+
+
+@dataclass
+class AdapterInfo:
+    """One attached adapter"""
+    name: str
+    path: str
+    fingerprint: str
+    attached_at: str
+
+
+def discover_adapters(outputs_dir: str = "./outputs", extra: str = "") -> Dict[str, str]:
+    """
+    Adapters to attach at startup
+
+    Args:
+        outputs_dir: Training output directory (dpo_model and sft_model become "dpo" and "sft")
+        extra: Comma-separated name=path pairs, e.g. from config.ini
+
+    Returns:
+        name -> adapter directory, trained adapters first
+    """
+    adapters = {}
+    for name in ("dpo", "sft"):
+        path = os.path.join(outputs_dir, f"{name}_model")
+        if os.path.exists(path):
+            adapters[name] = path
+    for pair in extra.split(","):
+        if not pair.strip():
+            continue
+        name, _, path = pair.partition("=")
+        adapters[name.strip()] = path.strip()
+    return adapters
+
+
+class AdapterRegistry:
+    """
+    Named LoRA adapters attached to a PEFT-wrapped base model
+
+    Forward passes run under rows(), which either routes each batch row
+    through its own adapter (mixed batching) or activates the single
+    adapter the batch uses. Loading and deleting adapter weights must run
+    where no forward pass is in flight (the scheduler thread, via
+    ContinuousBatchScheduler.call), while the metadata can be read from
+    request handlers.
+    """
+
+    def __init__(
+        self,
+        model,
+        adapters: Optional[Dict[str, str]] = None,
+        default: Optional[str] = None,
+        mixed_batching: bool = False,
+    ):
+        """
+        Load the startup adapters
+
+        Args:
+            model: Base model; it is wrapped in a PeftModel when adapters are given
+            adapters: name -> adapter directory, attached in order
+            default: Adapter used by requests that do not name one (default: the first)
+            mixed_batching: Let one batch mix rows of different adapters
+        """
+        self.model = model
+        self.adapters: Dict[str, AdapterInfo] = {}
+        self.default: Optional[str] = None
+        self.mixed: Optional[MixedLoraBatcher] = None
+        self._lock = threading.Lock()
+
+        for name, path in (adapters or {}).items():
+            if not self.has_peft_wrapper:
+                from peft import PeftModel
+                self._validate(name, path)
+                logger.info(f"Loading adapter {name!r} from {path}...")
+                self.model = PeftModel.from_pretrained(self.model, path, adapter_name=name)
+                self._record(name, path)
+            else:
+                self.attach(name, path)
+        if default:
+            self.set_default(default)
+
+        if mixed_batching and self.has_peft_wrapper:
+            unsupported = unsupported_adapters(self.model)
+            if unsupported:
+                logger.warning(f"Adapters {unsupported} use LoRA variants; batches will run one adapter at a time")
+            else:
+                self.mixed = MixedLoraBatcher(self.model)
+
+    @property
+    def has_peft_wrapper(self) -> bool:
+        # transformers models have their own load_adapter, so check for PEFT's wrapper
+        from peft import PeftModel
+        return isinstance(self.model, PeftModel)
+
+    @property
+    def names(self) -> List[str]:
+        with self._lock:
+            return list(self.adapters)
+
+    def attach(self, name: str, path: str) -> AdapterInfo:
+        """
+        Load an adapter onto the base model
+
+        Args:
+            name: Name requests select the adapter by
+            path: Adapter directory (adapter_config.json + weights)
+
+        Returns:
+            The registered adapter
+        """
+        self._validate(name, path)
+        if not self.has_peft_wrapper:
+            raise ValueError("The served model has no PEFT wrapper; start the server with an adapter to hot-swap")
+        with self._lock:
+            if name in self.adapters:
+                raise ValueError(f"Adapter {name!r} is already attached")
+
+        logger.info(f"Attaching adapter {name!r} from {path}...")
+        self.model.load_adapter(path, adapter_name=name)
+        if self.mixed is not None:
+            if name in unsupported_adapters(self.model):
+                self.model.delete_adapter(name)
+                raise ValueError(f"Adapter {name!r} uses a LoRA variant that mixed-adapter batching cannot apply")
+            self.mixed.refresh()
+        return self._record(name, path)
+
+    def detach(self, name: str):
+        """Unload an adapter (the default adapter cannot be detached)"""
+        with self._lock:
+            if name not in self.adapters:
+                raise KeyError(name)
+            if name == self.default:
+                raise ValueError(f"Adapter {name!r} is the default; choose another default first")
+
+        logger.info(f"Detaching adapter {name!r}")
+        self.model.delete_adapter(name)
+        with self._lock:
+            del self.adapters[name]
+        if self.mixed is not None:
+            self.mixed.refresh()
+
+    def record(self, info: AdapterInfo):
+        """Register an adapter loaded elsewhere, e.g. in a worker pool's workers, without loading weights"""
+        with self._lock:
+            self.adapters[info.name] = info
+            if self.default is None:
+                self.default = info.name
+
+    def forget(self, name: str):
+        """Drop an adapter's metadata without touching weights"""
+        with self._lock:
+            self.adapters.pop(name, None)
+
+    def set_default(self, name: str):
+        with self._lock:
+            if name not in self.adapters:
+                raise KeyError(name)
+            self.default = name
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
+        """
+        Adapter a request runs with
+
+        Args:
+            name: Requested adapter, or None for the default
+
+        Returns:
+            The adapter name (None when serving without adapters)
+
+        Raises:
+            KeyError: If the adapter is not attached
+        """
+        with self._lock:
+            if name is None:
+                return self.default
+            if name not in self.adapters:
+                raise KeyError(name)
+            return name
+
+    def activate(self, name: Optional[str]):
+        """Route forward passes through an adapter"""
+        if name is not None and self.model.active_adapter != name:
+            self.model.set_adapter(name)
+
+    @property
+    def mixed_batching(self) -> bool:
+        return self.mixed is not None
+
+    @contextmanager
+    def rows(self, names: List[Optional[str]]):
+        """
+        Run the forward passes inside the block with one adapter per batch row
+
+        Args:
+            names: Adapter of each row; they must all match without mixed batching
+        """
+        if self.mixed is not None and names[0] is not None:
+            with self.mixed.rows(names):
+                yield
+            return
+        if len(set(names)) > 1:
+            raise ValueError("Rows of different adapters need mixed-adapter batching")
+        self.activate(names[0])
+        yield
+
+    @contextmanager
+    def using(self, name: Optional[str]):
+        """Temporarily activate an adapter"""
+        previous = getattr(self.model, "active_adapter", None)
+        self.activate(name)
+        try:
+            yield
+        finally:
+            self.activate(previous)
+
+    def fingerprint(self, name: Optional[str]) -> Optional[str]:
+        """Identity of an adapter's weights, for cache keys"""
+        with self._lock:
+            info = self.adapters.get(name) if name is not None else None
+            return info.fingerprint if info is not None else None
+
+    def info(self, name: Optional[str]) -> Optional[AdapterInfo]:
+        with self._lock:
+            return self.adapters.get(name) if name is not None else None
+
+    def describe(self) -> List[dict]:
+        with self._lock:
+            return [{**asdict(info), "default": info.name == self.default} for info in self.adapters.values()]
+
+    @staticmethod
+    def _validate(name: str, path: str):
+        if not _ADAPTER_NAME.match(name):
+            raise ValueError(f"Invalid adapter name {name!r}")
+        if not os.path.exists(os.path.join(path, "adapter_config.json")):
+            raise ValueError(f"No LoRA adapter found at {path}")
+
+    def _record(self, name: str, path: str) -> AdapterInfo:
+        info = AdapterInfo(
+            name=name,
+            path=path,
+            fingerprint=hash_adapter(path)[:16],
+            attached_at=datetime.now().isoformat(),
+        )
+        self.record(info)
+        return info
+
+
+def register_prefixes(prefix_cache, adapters: Optional[AdapterRegistry], texts: List[str], names=None):
+    """
+    Precompute preamble KV states under each adapter
+
+    Args:
+        prefix_cache: PrefixCache to fill
+        adapters: Registry of the served model (None when serving without adapters)
+        texts: Preambles to cache
+        names: Adapters to cache them for (default: every attached adapter)
+    """
+    names = names if names is not None else (adapters.names if adapters is not None else [])
+    if not names:
+        for text in texts:
+            prefix_cache.register(text)
+        return
+    for name in names:
+        with adapters.using(name):
+            for text in texts:
+                prefix_cache.register(text, namespace=name)
+
+
+# Scheduler operations: run through scheduler.call(), which passes the scheduler in.
+# Module-level so worker pools can pickle them to their forked workers.
+def attach_adapter(scheduler, name: str, path: str) -> AdapterInfo:
+    """Attach an adapter between decode steps and cache its prompt preambles"""
+    if scheduler.adapters is None:
+        raise ValueError("Adapter hot-swapping is disabled")
+    info = scheduler.adapters.attach(name, path)
+    if scheduler.prefix_cache is not None:
+        register_prefixes(scheduler.prefix_cache, scheduler.adapters, scheduler.prefix_cache.texts(), [name])
+    return info
+
+
+def detach_adapter(scheduler, name: str):
+    """Detach an adapter between decode steps, unless sequences still use it"""
+    if scheduler.adapters is None:
+        raise KeyError(name)
+    if scheduler.uses_adapter(name):
+        raise AdapterInUseError(f"Adapter {name!r} is used by queued or running sequences")
+    scheduler.adapters.detach(name)
+    if scheduler.prefix_cache is not None:
+        scheduler.prefix_cache.drop(name)
+
+
+def make_default_adapter(scheduler, name: str):
+    """Make an attached adapter the default of requests without an `adapter` field"""
+    if scheduler.adapters is None:
+        raise KeyError(name)
+    scheduler.adapters.set_default(name)
+
+
+def restore_adapter(scheduler, name: str, path: str):
+    """Undo a detach where it went through: attach the adapter unless it is still attached"""
+    if scheduler.adapters is not None and name not in scheduler.adapters.names:
+        attach_adapter(scheduler, name, path)
+
+
+def discard_adapter(scheduler, name: str):
+    """Undo an attach where it went through: detach the adapter if it is attached"""
+    if scheduler.adapters is not None and name in scheduler.adapters.names:
+        detach_adapter(scheduler, name)
@@ -3,17 +3,51 @@ FastAPI Server for Flutter Code Generation
 Serves the trained AI model and provides REST API endpoints
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import functools
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from peft import PeftModel
 import uvicorn
 import logging
+from dataclasses import asdict
 from datetime import datetime
 import os
+import hashlib
+import math
+import threading
+import time
+
+from generation_engine import ContinuousBatchScheduler, PruningPolicy, QueueFullError, SamplingParams, score_continuations
+from dart_stopping import structurally_complete
+from adapter_registry import (
+    AdapterInUseError,
+    AdapterRegistry,
+    attach_adapter,
+    detach_adapter,
+    discard_adapter,
+    discover_adapters,
+    make_default_adapter,
+    register_prefixes,
+    restore_adapter,
+)
+from cpu_quantization import quantize_model
+from export_merged import find_adapter_path, find_merged_model, load_manifest, manifest_fingerprint
+from metrics import ServingMetrics
+from prefix_cache import PrefixCache
+from profiling import ProfileCapture, ProfilerBusyError
+from readiness import ReadinessTracker
+from response_cache import ResponseCache, make_cache_key
+from serving_config import load_serving_config
+from singleflight import SingleFlight
+from speculative import DraftModelProposer, PromptLookupProposer, SpeculativeDecoder, vocabularies_match
+from streaming import TokenStream, format_sse
+from worker_pool import ModelWorkerPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -33,12 +67,53 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Cache"],
 )
 
 # Global model variables
 model = None
 tokenizer = None
+scheduler = None
+speculative = None
+prompt_lookup = None
+model_fingerprint = None
+# LoRA adapters attached to the served base model (None when serving a single merged model)
+adapters = None
+# What load_model actually loaded: base model, adapter path and/or merged artifact
+model_source = {}
 device = "cuda" if torch.cuda.is_available() else "cpu"
+serving_config = load_serving_config()
+
+# Startup progress of the background model loader
+readiness = ReadinessTracker()
+
+response_cache = None
+if serving_config.response_cache:
+    response_cache = ResponseCache(
+        max_entries=serving_config.response_cache_max_entries,
+        max_bytes=serving_config.response_cache_max_mb * 1024 * 1024,
+        ttl_seconds=serving_config.response_cache_ttl_seconds,
+        disk_dir=serving_config.response_cache_dir or None,
+    )
+
+# Identical concurrent requests share one in-flight generation
+flights = SingleFlight()
+
+# Exported on /metrics
+metrics = ServingMetrics(throughput_window_seconds=serving_config.metrics_window_seconds)
+# How long /metrics waits for the scheduler to report its batch between decode steps
+METRICS_USAGE_TIMEOUT_SECONDS = 2.0
+
+# Armed on demand by /api/admin/profile
+profile_capture = ProfileCapture(
+    output_dir=serving_config.profile_dir,
+    max_seconds=serving_config.profile_max_seconds,
+    sample_interval_seconds=serving_config.profile_sample_interval_seconds,
+)
+
+# Constant preambles every prompt starts with; their KV states are computed once at startup
+GENERATE_PREAMBLE = "### Instruction:\nCreate a Flutter widget based on this description:"
+REFINE_PREAMBLE = "### Instruction:\nRefine this Flutter code based on these instructions:"
 
 # Request/Response Models
 class GenerateRequest(BaseModel):
@@ -46,7 +121,37 @@ class GenerateRequest(BaseModel):
     temperature: float = 0.7
     max_tokens: int = 512
     num_variants: int = 3
+    # Sample this many candidates and return the best num_variants
+    best_of: Optional[int] = None
     style: Optional[str] = "lovable"
+    seed: Optional[int] = None
+    adapter: Optional[str] = None
+    include_timings: bool = False
+
+class RefineRequest(BaseModel):
+    code: str
+    instructions: str
+    seed: Optional[int] = None
+    adapter: Optional[str] = None
+    include_timings: bool = False
+
+class AttachAdapterRequest(BaseModel):
+    name: str
+    path: str
+    make_default: bool = False
+
+class ProfileRequest(BaseModel):
+    requests: Optional[int] = None
+    seconds: Optional[float] = None
+
+class BatchGenerateRequest(BaseModel):
+    requests: List[GenerateRequest]
+
+class ScoreRequest(BaseModel):
+    prompt: str
+    candidates: List[str]
+    style: Optional[str] = "lovable"
+    adapter: Optional[str] = None
 
 class CodeVariant(BaseModel):
     id: str
@@ -54,64 +159,900 @@ class CodeVariant(BaseModel):
     description: str
     score: float
 
+class VariantTimings(BaseModel):
+    variant_id: str
+    queue_ms: float
+    prefill_ms: float
+    decode_ms: float
+    detokenize_ms: float
+    tokens_generated: int
+    tokens_per_second: float
+
+class Timings(BaseModel):
+    tokenize_ms: float
+    prompt_tokens: int
+    cached_prompt_tokens: int
+    variants: List[VariantTimings]
+
 class GenerateResponse(BaseModel):
     variants: List[CodeVariant]
     prompt: str
     generated_at: str
+    tokens_saved: int = 0
+    timings: Optional[Timings] = None
+
+class BatchItemResult(BaseModel):
+    # Position of the prompt in the request
+    index: int
+    response: Optional[GenerateResponse] = None
+    status_code: int = 200
+    error: Optional[str] = None
+
+class BatchGenerateResponse(BaseModel):
+    results: List[BatchItemResult]
+
+class CandidateScore(BaseModel):
+    # Position of the candidate in the request
+    index: int
+    # Same scale as CodeVariant.score
+    score: float
+    # None for an empty candidate
+    mean_logprob: Optional[float]
+    total_logprob: float
+    tokens: List[str]
+    # -log p of each token, in nats
+    surprisal: List[float]
+
+class ScoreResponse(BaseModel):
+    # Best first
+    scores: List[CandidateScore]
+    prompt: str
+    prompt_tokens: int
+    scored_at: str
 
 class HealthResponse(BaseModel):
     status: str
     model_loaded: bool
+    phase: str
+    progress: float
+    elapsed_seconds: float
+    phase_timings: Dict[str, float]
+    error: Optional[str] = None
     device: str
+    queue_depth: int
+    active_sequences: int
     timestamp: str
 
 # Model Loading
+def compute_model_fingerprint(base_model_name: str, adapter_path: Optional[str]) -> str:
+    """Identify the served weights so cached responses are never reused across models"""
+    digest = hashlib.sha256(base_model_name.encode("utf-8"))
+    if adapter_path:
+        for name in sorted(os.listdir(adapter_path)):
+            if not name.startswith("adapter_"):
+                continue
+            with open(os.path.join(adapter_path, name), "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()[:16]
+
 def load_model():
-    """Load the trained model and tokenizer"""
-    global model, tokenizer
+    """Load the trained model and tokenizer, preferring a merged export over base + adapter"""
+    global model, tokenizer, model_fingerprint, model_source, adapters
     
     try:
-        base_model_name = "codellama/CodeLlama-7b-hf"
+        base_model_name = serving_config.base_model
         
         # Check for trained model
-        model_path = "outputs/dpo_model" if os.path.exists("outputs/dpo_model") else "outputs/sft_model"
+        model_path = find_adapter_path()
         
-        if not os.path.exists(model_path):
-            logger.warning(f"No trained model found at {model_path}. Using base model only.")
-            model_path = None
+        # A merged export bakes in a single adapter, so it is only served without hot-swapping
+        merged_path = None
+        if serving_config.merged_model_dir and not serving_config.hot_swap_adapters:
+            merged_path = find_merged_model(
+                serving_config.merged_model_dir,
+                model_path,
+                base_model=base_model_name,
+                # The dtype base + adapter would be served in
+                dtype=serving_config.cpu_dtype if device == "cpu" else "float16",
+            )
+        elif serving_config.merged_model_dir and load_manifest(serving_config.merged_model_dir) is not None:
+            logger.info(
+                f"Skipping the merged export in {serving_config.merged_model_dir} because hot_swap_adapters is on; "
+                "set hot_swap_adapters = false to serve it when no runtime adapter changes are needed"
+            )
+        if merged_path and device == "cpu" and load_manifest(merged_path)["quantization"] != "none":
+            logger.warning(f"{merged_path} holds bitsandbytes weights, which need CUDA; loading base + adapter instead")
+            merged_path = None
+        if merged_path:
+            load_merged_model(merged_path)
+            return
+        
+        if model_path is None:
+            logger.warning("No trained model found in outputs/. Using base model only.")
         
+        readiness.enter("loading_tokenizer")
         logger.info(f"Loading tokenizer from {base_model_name}...")
         tokenizer = AutoTokenizer.from_pretrained(base_model_name)
         
+        readiness.enter("loading_weights")
         logger.info(f"Loading base model from {base_model_name}...")
-        model = AutoModelForCausalLM.from_pretrained(
-            base_model_name,
-            load_in_4bit=True,
-            device_map="auto",
-            torch_dtype=torch.float16,
-        )
+        model = load_base_model(base_model_name)
         
-        # Load fine-tuned adapter if available
-        if model_path:
+        if serving_config.hot_swap_adapters:
+            startup_adapters = discover_adapters(extra=serving_config.adapters)
+            if startup_adapters:
+                readiness.enter("loading_adapter")
+            adapters = AdapterRegistry(
+                model,
+                startup_adapters,
+                default=serving_config.default_adapter or None,
+                mixed_batching=serving_config.mixed_adapter_batching,
+            )
+            model = adapters.model
+            logger.info(f"✅ Adapters attached: {adapters.names or 'none'} (default: {adapters.default})")
+            # Each request's cache key carries its own adapter's fingerprint
+            model_path = None
+        elif model_path:
+            # Load fine-tuned adapter if available
+            readiness.enter("loading_adapter")
             logger.info(f"Loading fine-tuned adapter from {model_path}...")
             model = PeftModel.from_pretrained(model, model_path)
             logger.info("✅ Fine-tuned model loaded successfully!")
         else:
             logger.info("✅ Base model loaded (no fine-tuning applied)")
         
+        model = quantize_for_cpu(model, merge=adapters is None)
         model.eval()
+        model_fingerprint = compute_model_fingerprint(base_model_name, model_path) + cpu_quantization_suffix()
+        model_source = {
+            "base_model": base_model_name,
+            "adapter_path": model_path,
+            "merged_path": None,
+            "weight_quantization": serving_config.cpu_quantization if device == "cpu" else "bnb-4bit",
+        }
         logger.info(f"Model loaded on device: {device}")
         
     except Exception as e:
         logger.error(f"Error loading model: {e}")
         raise
 
+def load_base_model(base_model_name: str):
+    """Base weights: bitsandbytes 4-bit on GPU, cpu_dtype on CPU (quantized later by quantize_for_cpu)"""
+    if device == "cuda":
+        return AutoModelForCausalLM.from_pretrained(
+            base_model_name,
+            load_in_4bit=True,
+            device_map="auto",
+            torch_dtype=torch.float16,
+        )
+    return AutoModelForCausalLM.from_pretrained(
+        base_model_name,
+        torch_dtype=getattr(torch, serving_config.cpu_dtype),
+        low_cpu_mem_usage=True,
+    )
+
+def cpu_quantization_suffix() -> str:
+    """Fingerprint suffix for CPU weight quantization, which changes the outputs"""
+    if device != "cpu" or serving_config.cpu_quantization == "none":
+        return ""
+    return f"-{serving_config.cpu_quantization}"
+
+def quantize_for_cpu(loaded_model, merge: bool = True):
+    """Merge any adapter (unless `merge` is False) and quantize Linear weights as configured, when serving on CPU"""
+    mode = serving_config.cpu_quantization
+    if device != "cpu" or mode == "none":
+        return loaded_model
+    if mode not in ("int8", "int4"):
+        raise ValueError(f"Unsupported cpu_quantization {mode!r}; choose none, int8 or int4")
+    
+    logger.info(f"Quantizing weights to {mode} for CPU serving...")
+    return quantize_model(
+        loaded_model,
+        bits=8 if mode == "int8" else 4,
+        group_size=serving_config.quantization_group_size,
+        merge=merge,
+    )
+
+def load_merged_model(merged_path: str):
+    """Load an export_merged.py artifact: adapter already folded in, no PEFT wrapper"""
+    global model, tokenizer, model_fingerprint, model_source
+    
+    manifest = load_manifest(merged_path)
+    
+    readiness.enter("loading_tokenizer")
+    logger.info(f"Loading tokenizer from {merged_path}...")
+    tokenizer = AutoTokenizer.from_pretrained(merged_path)
+    
+    readiness.enter("loading_weights")
+    logger.info(f"Loading merged model from {merged_path} ({manifest['dtype']}, quantization: {manifest['quantization']})...")
+    # Quantized exports carry their quantization config in config.json
+    if device == "cuda":
+        model = AutoModelForCausalLM.from_pretrained(
+            merged_path,
+            device_map="auto",
+            torch_dtype=getattr(torch, manifest["dtype"]),
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            merged_path,
+            torch_dtype=getattr(torch, serving_config.cpu_dtype),
+            low_cpu_mem_usage=True,
+        )
+    model = quantize_for_cpu(model)
+    model.eval()
+    
+    model_fingerprint = manifest_fingerprint(manifest) + cpu_quantization_suffix()
+    model_source = {
+        "base_model": manifest["base_model"],
+        "adapter_path": manifest["adapter_path"],
+        "merged_path": merged_path,
+        "weight_quantization": serving_config.cpu_quantization if device == "cpu" else manifest["quantization"],
+    }
+    logger.info(f"✅ Merged model loaded on device: {device}")
+
+def load_draft_model():
+    """Load the speculative decoding draft model, if configured"""
+    global speculative
+    
+    draft_name = serving_config.draft_model
+    if not draft_name:
+        return
+    
+    logger.info(f"Loading draft model from {draft_name}...")
+    draft_tokenizer = AutoTokenizer.from_pretrained(draft_name)
+    if not vocabularies_match(tokenizer, draft_tokenizer):
+        logger.warning(f"Draft model {draft_name} does not share the served tokenizer; speculative decoding disabled")
+        return
+    
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_name,
+        torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+    ).to(device)
+    draft_model.eval()
+    
+    speculative = SpeculativeDecoder(
+        DraftModelProposer(draft_model, device),
+        num_draft_tokens=serving_config.num_draft_tokens,
+        min_acceptance=serving_config.speculative_min_acceptance,
+    )
+    logger.info(f"✅ Speculative decoding enabled ({serving_config.num_draft_tokens} draft tokens per step)")
+
+def initialize_serving():
+    """Load the model and start the generation scheduler (runs on a background thread)"""
+    try:
+        load_model()
+        readiness.enter("warming_up")
+        start_scheduler()
+        if serving_config.warmup:
+            warm_up()
+    except Exception as e:
+        logger.error(f"Model startup failed: {e}")
+        readiness.fail(e)
+        return
+    
+    readiness.enter("ready")
+    logger.info("Server ready to accept requests!")
+
+def start_scheduler():
+    """Build the draft model, prefix caches and scheduler (or worker pool) around the loaded model"""
+    global scheduler, prompt_lookup
+    load_draft_model()
+    
+    prefill_buckets = None
+    if serving_config.compile_model:
+        # Dynamic shapes: the merged batch cache grows every step, prompts only come in bucket sizes
+        logger.info("Compiling the model with torch.compile...")
+        model.forward = torch.compile(model.forward, dynamic=True)
+        prefill_buckets = serving_config.bucket_sizes()
+    
+    if serving_config.prompt_lookup:
+        prompt_lookup = SpeculativeDecoder(
+            PromptLookupProposer(max_ngram=serving_config.prompt_lookup_max_ngram),
+            num_draft_tokens=serving_config.prompt_lookup_num_tokens,
+            min_acceptance=serving_config.speculative_min_acceptance,
+        )
+    
+    prefix_texts = [GENERATE_PREAMBLE, REFINE_PREAMBLE] if serving_config.prefix_cache else []
+    
+    if serving_config.workers > 1 and device == "cpu":
+        # Workers are forked after loading so they share the weights copy-on-write
+        scheduler = ModelWorkerPool(
+            model,
+            tokenizer,
+            num_workers=serving_config.workers,
+            cores_per_worker=serving_config.cores_per_worker,
+            max_batch_size=serving_config.max_batch_size,
+            max_queue_size=serving_config.max_queue_size,
+            idle_wait_seconds=serving_config.idle_wait_seconds,
+            prefix_texts=prefix_texts,
+            speculative=speculative,
+            prompt_lookup=prompt_lookup,
+            prefill_buckets=prefill_buckets,
+            adapters=adapters,
+        )
+    else:
+        if serving_config.workers > 1:
+            logger.warning(f"Worker pool is CPU-only; serving from a single process on {device}")
+        
+        prefix_cache = None
+        if prefix_texts:
+            prefix_cache = PrefixCache(model, tokenizer, device)
+            register_prefixes(prefix_cache, adapters, prefix_texts)
+        
+        scheduler = ContinuousBatchScheduler(
+            model,
+            tokenizer,
+            device,
+            max_batch_size=serving_config.max_batch_size,
+            max_queue_size=serving_config.max_queue_size,
+            idle_wait_seconds=serving_config.idle_wait_seconds,
+            prefix_cache=prefix_cache,
+            speculative=speculative,
+            prompt_lookup=prompt_lookup,
+            prefill_buckets=prefill_buckets,
+            adapters=adapters,
+        )
+    scheduler.start()
+
+def warm_up():
+    """
+    Run synthetic generations through the scheduler before serving traffic
+    
+    In compiled mode every prefill bucket is exercised so compilation happens
+    now; otherwise one short generation is enough to initialize the kernels.
+    Each length is run with one and then two sequences, since compiled
+    graphs specialize on a batch of one, and once per worker.
+    """
+    # Real prompt format, so the prefix cache path is exercised too
+    base = tokenizer(format_generate_prompt(GenerateRequest(prompt="A counter widget")))["input_ids"]
+    filler = tokenizer("class WarmupWidget extends StatelessWidget {}\n", add_special_tokens=False)["input_ids"]
+    lengths = serving_config.bucket_sizes() if serving_config.compile_model else [len(base)]
+    params = SamplingParams(temperature=0, top_p=1.0, max_new_tokens=serving_config.warmup_tokens)
+    
+    for length in lengths:
+        prompt_ids = (base + filler * (length // len(filler) + 1))[:length]
+        started = time.time()
+        for group_size in (1, 2):
+            futures = []
+            for _ in range(getattr(scheduler, "num_workers", 1)):
+                futures.extend(scheduler.submit_many(prompt_ids, [params] * group_size))
+            for future in futures:
+                future.result()
+        logger.info(f"Warmup with a {length}-token prompt took {time.time() - started:.2f}s")
+
 @app.on_event("startup")
 async def startup_event():
-    """Load model on server startup"""
+    """Bind right away and load the model in the background"""
     logger.info("Starting Flutter AI Code Generator API...")
-    load_model()
-    logger.info("Server ready to accept requests!")
+    threading.Thread(target=initialize_serving, name="model-loader", daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the generation scheduler"""
+    if scheduler is not None:
+        scheduler.stop()
+
+def submit_generation(prompt_ids: List[int], params_list: List[SamplingParams], on_token=None, pruning=None):
+    """
+    Queue sequences on the scheduler
+    
+    A full queue rejects the request with 503, and an adapter detached since
+    pin_adapter resolved it with 404.
+    """
+    try:
+        return scheduler.submit_many(prompt_ids, params_list, on_token=on_token, pruning=pruning)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Unknown adapter {e}")
+    except QueueFullError as e:
+        logger.warning(f"Rejecting request: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(serving_config.retry_after_seconds)},
+        )
+
+def decode_response(token_ids: List[int]) -> str:
+    """Decode generated tokens, cutting off any follow-up turn the model starts"""
+    text = tokenizer.decode(token_ids, skip_special_tokens=True)
+    return text.split("### Response:")[0].split("### Instruction:")[0].strip()
+
+def log_tokens_saved(results) -> int:
+    """Total tokens early stopping and pruning spared a request, logged when non-zero"""
+    saved = sum(result.tokens_saved for result in results)
+    if saved:
+        stopped = sum(result.finish_reason == "structure" for result in results)
+        pruned = sum(result.finish_reason == "pruned" for result in results)
+        logger.info(
+            f"Early stopping ended {stopped}/{len(results)} sequences, pruning {pruned}; saved {saved} tokens"
+        )
+    return saved
+
+def format_generate_prompt(request: GenerateRequest) -> str:
+    """Format a generation request for the model"""
+    return f"""{GENERATE_PREAMBLE} {request.prompt}
+
+Style: {request.style}
+
+### Response:
+"""
+
+def format_refine_prompt(request: RefineRequest) -> str:
+    """Format a refinement request for the model"""
+    return f"""{REFINE_PREAMBLE} {request.instructions}
+
+Current code:
+{request.code}
+
+### Response:
+"""
+
+def num_candidates(request: GenerateRequest) -> int:
+    """Sequences sampled for a generation request (best_of, or one per variant)"""
+    return max(request.best_of or 0, request.num_variants)
+
+def check_variants(request: GenerateRequest):
+    """
+    Reject impossible variant counts with 400
+    
+    num_variants must be at least 1, best_of between num_variants and
+    max_best_of, and the candidates must fit in the waiting queue at once,
+    since a 503 would have the client retry a request that can never be queued.
+    """
+    if request.num_variants < 1:
+        raise HTTPException(status_code=400, detail="num_variants must be at least 1")
+    if num_candidates(request) > serving_config.max_queue_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {serving_config.max_queue_size} sequences can be generated per request",
+        )
+    if request.best_of is None:
+        return
+    if request.best_of < request.num_variants:
+        raise HTTPException(status_code=400, detail="best_of must be at least num_variants")
+    if request.best_of > serving_config.max_best_of:
+        raise HTTPException(status_code=400, detail=f"best_of is limited to {serving_config.max_best_of}")
+
+def candidate_pruning(request: GenerateRequest) -> Optional[PruningPolicy]:
+    """Pruning of the extra candidates of a best_of request, if enabled"""
+    if num_candidates(request) <= request.num_variants or serving_config.prune_interval_tokens <= 0:
+        return None
+    margin = serving_config.prune_margin if serving_config.prune_margin > 0 else None
+    percentile = serving_config.prune_percentile if serving_config.prune_percentile > 0 else None
+    if margin is None and percentile is None:
+        return None
+    return PruningPolicy(
+        min_keep=request.num_variants,
+        interval_tokens=serving_config.prune_interval_tokens,
+        margin=margin,
+        percentile=percentile,
+    )
+
+def variant_temperatures(request: GenerateRequest) -> List[float]:
+    """Sampling temperature of each candidate, varied for diversity"""
+    return [request.temperature + (i * 0.1) for i in range(num_candidates(request))]
+
+def variant_params(request: GenerateRequest) -> List[SamplingParams]:
+    return [
+        SamplingParams(
+            temperature=temperature,
+            top_p=0.95,
+            max_new_tokens=request.max_tokens,
+            seed=request.seed + i if request.seed is not None else None,
+            stop_at_structure=serving_config.early_stopping,
+            adapter=request.adapter,
+        )
+        for i, temperature in enumerate(variant_temperatures(request))
+    ]
+
+def refine_params(request: RefineRequest) -> SamplingParams:
+    # Refinements mostly copy the submitted code, so draft from it
+    return SamplingParams(
+        temperature=0.7,
+        top_p=0.95,
+        max_new_tokens=512,
+        seed=request.seed,
+        prompt_lookup=True,
+        stop_at_structure=serving_config.early_stopping,
+        adapter=request.adapter,
+    )
+
+def generate_request_key(request: GenerateRequest) -> str:
+    """Identity of a generation request: every field that affects its output"""
+    return make_cache_key(
+        endpoint="generate",
+        prompt=request.prompt,
+        style=request.style,
+        temperature=request.temperature,
+        max_tokens=request.max_tokens,
+        num_variants=request.num_variants,
+        best_of=num_candidates(request),
+        seed=request.seed,
+        early_stopping=serving_config.early_stopping,
+        structure_penalty=serving_config.structure_penalty,
+        pruning=candidate_pruning(request),
+        model=model_fingerprint,
+        adapter=adapters.fingerprint(request.adapter) if adapters is not None else None,
+    )
+
+def generate_cache_key(request: GenerateRequest) -> Optional[str]:
+    """Cache key for a generation request, or None if its output is not reproducible"""
+    deterministic = request.seed is not None or all(t <= 0 for t in variant_temperatures(request))
+    if response_cache is None or not deterministic:
+        return None
+    return generate_request_key(request)
+
+def refine_request_key(request: RefineRequest) -> str:
+    """Identity of a refinement request"""
+    return make_cache_key(
+        endpoint="refine",
+        code=request.code,
+        instructions=request.instructions,
+        seed=request.seed,
+        early_stopping=serving_config.early_stopping,
+        model=model_fingerprint,
+        adapter=adapters.fingerprint(request.adapter) if adapters is not None else None,
+    )
+
+def refine_cache_key(request: RefineRequest) -> Optional[str]:
+    """Cache key for a refinement request, or None if it is unseeded"""
+    if response_cache is None or request.seed is None:
+        return None
+    return refine_request_key(request)
+
+async def cached_events(payload: dict):
+    """Replay a cached response as a finished stream"""
+    yield "done", payload
+
+def decode_results(results) -> Tuple[List[str], List[float]]:
+    """Decode every finished generation, timing each detokenization"""
+    texts, seconds = [], []
+    for result in results:
+        started = time.monotonic()
+        texts.append(decode_response(result.token_ids))
+        seconds.append(time.monotonic() - started)
+    return texts, seconds
+
+def variant_score(mean_logprob: float, text: str) -> float:
+    """
+    Score of a generated variant in [0, 1]
+    
+    The geometric mean of its tokens' probabilities under the model, taken
+    from the logits generation already computed, multiplied by
+    structure_penalty when the code does not close cleanly.
+    """
+    score = math.exp(mean_logprob)
+    if serving_config.structure_penalty < 1.0 and not structurally_complete(text):
+        score *= serving_config.structure_penalty
+    return round(score, 4)
+
+def build_variants(request: GenerateRequest, results, texts: List[str], variant_ids: List[str]) -> List[CodeVariant]:
+    """Turn decoded generations into response variants, best first, keeping the top num_variants"""
+    variants = []
+    for i, (result, text, temperature) in enumerate(zip(results, texts, variant_temperatures(request))):
+        if result.finish_reason == "pruned":
+            continue
+        variants.append(CodeVariant(
+            id=variant_ids[i],
+            code=text,
+            description=f"Variant {i+1} - Temperature {temperature:.1f}",
+            score=variant_score(result.mean_logprob, text),
+        ))
+    variants.sort(key=lambda variant: variant.score, reverse=True)
+    return variants[:request.num_variants]
+
+def build_timings(results, variant_ids: List[str], tokenize_seconds: float, prompt_tokens: int, detokenize_seconds: List[float]) -> Timings:
+    """Stage timings of a finished generation, per variant"""
+    variants = []
+    for variant_id, result, detokenize in zip(variant_ids, results, detokenize_seconds):
+        generating = result.prefill_seconds + result.decode_seconds
+        variants.append(VariantTimings(
+            variant_id=variant_id,
+            queue_ms=round(result.queue_seconds * 1000, 3),
+            prefill_ms=round(result.prefill_seconds * 1000, 3),
+            decode_ms=round(result.decode_seconds * 1000, 3),
+            detokenize_ms=round(detokenize * 1000, 3),
+            tokens_generated=len(result.token_ids),
+            tokens_per_second=round(len(result.token_ids) / generating, 2) if generating > 0 else 0.0,
+        ))
+    return Timings(
+        tokenize_ms=round(tokenize_seconds * 1000, 3),
+        prompt_tokens=prompt_tokens,
+        cached_prompt_tokens=results[0].cached_tokens if results else 0,
+        variants=variants,
+    )
+
+def server_timing(timings: Optional[dict], started: float, cache_hit: bool = False) -> str:
+    """
+    Server-Timing header value for a finished request
+    
+    Variants share one queue slot and prefill, so those come from the first
+    variant; decode is the slowest variant, which the request waited for.
+    """
+    entries = []
+    if cache_hit:
+        entries.append('cache;desc="hit"')
+    if timings is not None and timings["variants"]:
+        variants = timings["variants"]
+        entries += [
+            f"tokenize;dur={timings['tokenize_ms']}",
+            f"queue;dur={min(v['queue_ms'] for v in variants)}",
+            f"prefill;dur={variants[0]['prefill_ms']}",
+            f"decode;dur={max(v['decode_ms'] for v in variants)}",
+            f"detokenize;dur={round(sum(v['detokenize_ms'] for v in variants), 3)}",
+            f'tokens;desc="{sum(v["tokens_generated"] for v in variants)}"',
+        ]
+    entries.append(f"total;dur={(time.monotonic() - started) * 1000:.3f}")
+    return ", ".join(entries)
+
+def without_timings(payload: dict) -> dict:
+    return {key: value for key, value in payload.items() if key != "timings"}
+
+async def select_timings(events, include: bool):
+    """Drop the timings block from a stream's done event unless the request asked for it"""
+    try:
+        async for event, data in events:
+            if event == "done" and not include:
+                data = without_timings(data)
+            yield event, data
+    finally:
+        await events.aclose()
+
+def new_variant_ids(count: int) -> List[str]:
+    timestamp = datetime.now().timestamp()
+    return [f"variant_{i+1}_{timestamp}" for i in range(count)]
+
+def stream_generation(prompt_ids: List[int], params_list: List[SamplingParams], variant_ids: List[str], finalize, pruning=None):
+    """
+    Queue sequences and return an async iterator of streaming events
+
+    The iterator yields ("token", {...}) for every text delta, then
+    ("done", finalize(results)). Unfinished sequences are cancelled if the
+    consumer stops early. Queueing happens immediately so a full queue is
+    still reported as a 503 before any event is sent.
+    """
+    stream = TokenStream(tokenizer, len(params_list))
+    futures = submit_generation(prompt_ids, params_list, on_token=stream.on_token, pruning=pruning)
+    stream.watch(futures)
+
+    async def events():
+        try:
+            async for index, text in stream.deltas():
+                yield "token", {"variant_id": variant_ids[index], "index": index, "text": text}
+            try:
+                results = [f.result() for f in futures]
+            except KeyError as e:
+                # Worker pools only find out once the sequences reach a worker
+                raise HTTPException(status_code=404, detail=f"Unknown adapter {e}")
+            yield "done", finalize(results)
+        finally:
+            for f in futures:
+                f.cancel()
+
+    return events()
+
+async def final_payload(events) -> dict:
+    """Consume a generation's events and return the payload of its done event"""
+    try:
+        async for event, data in events:
+            if event == "done":
+                return data
+    finally:
+        await events.aclose()
+    raise RuntimeError("Generation ended without a result")
+
+def sse_response(events) -> StreamingResponse:
+    """Wrap a stream_generation iterator as Server-Sent Events"""
+    async def body():
+        try:
+            async for event, data in events:
+                yield format_sse(event, data)
+        except HTTPException as e:
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.error(f"Error streaming generation: {e}")
+            yield format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def websocket_stream(websocket: WebSocket, start_events):
+    """
+    Serve one streamed generation over a WebSocket
+
+    The client sends the request as JSON, receives {"type": "token"} messages
+    followed by {"type": "done"}, and may send {"type": "cancel"} at any time.
+    """
+    await websocket.accept()
+    try:
+        payload = await websocket.receive_json()
+        events = start_events(payload)
+
+        async def watch_cancel():
+            while True:
+                message = await websocket.receive_json()
+                if message.get("type") == "cancel":
+                    return
+
+        cancel_task = asyncio.create_task(watch_cancel())
+        try:
+            async for event, data in events:
+                if cancel_task.done():
+                    # Either an explicit cancel or a disconnect (which re-raises below)
+                    cancel_task.result()
+                    await websocket.send_json({"type": "cancelled"})
+                    break
+                await websocket.send_json({"type": event, **data})
+        finally:
+            cancel_task.cancel()
+            await events.aclose()
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info("WebSocket client disconnected")
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "status_code": e.status_code, "detail": e.detail})
+        await websocket.close()
+    except Exception as e:
+        logger.error(f"Error streaming generation: {e}")
+        await websocket.send_json({"type": "error", "detail": str(e)})
+        await websocket.close()
+
+def ensure_model_loaded():
+    """Reject requests with 503 and the startup progress until the model is ready"""
+    if readiness.ready and scheduler is not None:
+        return
+    status = readiness.snapshot()
+    if readiness.failed:
+        message = f"Model failed to load: {status['error']}"
+    else:
+        message = f"Model is loading ({status['phase']}, {status['progress']:.0%})"
+    raise HTTPException(
+        status_code=503,
+        detail={"message": message, **status},
+        headers={"Retry-After": str(serving_config.retry_after_seconds)},
+    )
+
+def pin_adapter(request):
+    """
+    Resolve a request's adapter to a concrete name, before any cache key is built
+    
+    Unknown adapters are rejected with 404, and naming one while a single
+    merged model is served with 400.
+    """
+    if adapters is None:
+        if request.adapter is not None:
+            raise HTTPException(status_code=400, detail="Adapter selection needs hot_swap_adapters = true")
+        return
+    try:
+        request.adapter = adapters.resolve(request.adapter)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown adapter {request.adapter!r}")
+
+class RequestMetrics:
+    """
+    Latency and rejection metrics of one request
+
+    Used as a context manager around a handler: HTTP errors other than 500
+    raised inside count as rejections. Non-streamed requests record their
+    latency when the block exits, streamed ones when track()'s iterator ends.
+    """
+
+    def __init__(self, endpoint: str, request):
+        self.endpoint = endpoint
+        self.request = request
+        self.started = time.monotonic()
+        self.streamed = False
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        # Only attached adapters become label values, so bad requests cannot add series
+        adapter = self.request.adapter
+        if adapters is None or adapter not in adapters.names:
+            adapter = None
+        return ServingMetrics.labels(self.endpoint, adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if isinstance(exc, HTTPException) and exc.status_code != 500:
+            metrics.rejected_requests.inc(status=str(exc.status_code), **self.labels)
+        elif not self.streamed:
+            self.finish()
+        return False
+
+    def finish(self):
+        metrics.request_latency.observe(time.monotonic() - self.started, **self.labels)
+        profile_capture.request_finished()
+
+    def track(self, events):
+        """Wrap a request's event stream so its latency is recorded when the stream ends"""
+        self.streamed = True
+
+        async def tracked():
+            try:
+                async for item in events:
+                    yield item
+            finally:
+                await events.aclose()
+                self.finish()
+
+        return tracked()
+
+def cached_response(cache_key: Optional[str], labels: Dict[str, str]) -> Optional[dict]:
+    """Look a request up in the response cache, counting the hit or miss"""
+    if cache_key is None:
+        return None
+    cached = response_cache.get(cache_key)
+    metrics.cache_lookups.inc(cache="response", result="hit" if cached is not None else "miss", **labels)
+    return cached
+
+def generate_events(request: GenerateRequest, cache_key: Optional[str], labels: Dict[str, str]):
+    """
+    Stream the generation of every variant of a request
+
+    Served from the response cache when possible; otherwise identical
+    concurrent requests share one generation.
+    """
+    cached = cached_response(cache_key, labels)
+    if cached is not None:
+        return cached_events(cached)
+    return select_timings(generate_flight(request, cache_key, labels), request.include_timings)
+
+def generate_flight(request: GenerateRequest, cache_key: Optional[str], labels: Dict[str, str]):
+    """Join the in-flight generation of an identical request, or start one"""
+    return flights.join(generate_request_key(request), lambda: start_generate_stream(request, cache_key, labels))
+
+def start_generate_stream(request: GenerateRequest, cache_key: Optional[str], labels: Dict[str, str]):
+    started = time.monotonic()
+    prompt_ids = tokenizer(format_generate_prompt(request))["input_ids"]
+    tokenize_seconds = time.monotonic() - started
+    variant_ids = new_variant_ids(num_candidates(request))
+
+    def finalize(results):
+        metrics.observe_generation(labels, results, tokenize_seconds, len(prompt_ids))
+        texts, detokenize_seconds = decode_results(results)
+        payload = GenerateResponse(
+            variants=build_variants(request, results, texts, variant_ids),
+            prompt=request.prompt,
+            generated_at=datetime.now().isoformat(),
+            tokens_saved=log_tokens_saved(results),
+            timings=build_timings(results, variant_ids, tokenize_seconds, len(prompt_ids), detokenize_seconds),
+        ).model_dump()
+        if cache_key is not None:
+            # Timings describe this generation, not later cache hits
+            response_cache.put(cache_key, without_timings(payload))
+        return payload
+
+    return stream_generation(prompt_ids, variant_params(request), variant_ids, finalize, candidate_pruning(request))
+
+def refine_events(request: RefineRequest, cache_key: Optional[str], labels: Dict[str, str]):
+    """Stream a refinement, from the response cache or a shared in-flight generation"""
+    cached = cached_response(cache_key, labels)
+    if cached is not None:
+        return cached_events(cached)
+    return select_timings(refine_flight(request, cache_key, labels), request.include_timings)
+
+def refine_flight(request: RefineRequest, cache_key: Optional[str], labels: Dict[str, str]):
+    return flights.join(refine_request_key(request), lambda: start_refine_stream(request, cache_key, labels))
+
+def start_refine_stream(request: RefineRequest, cache_key: Optional[str], labels: Dict[str, str]):
+    started = time.monotonic()
+    prompt_ids = tokenizer(format_refine_prompt(request))["input_ids"]
+    tokenize_seconds = time.monotonic() - started
+
+    def finalize(results):
+        metrics.observe_generation(labels, results, tokenize_seconds, len(prompt_ids))
+        texts, detokenize_seconds = decode_results(results)
+        payload = {
+            "refined_code": texts[0],
+            "tokens_saved": log_tokens_saved(results),
+            "timings": build_timings(results, ["refined"], tokenize_seconds, len(prompt_ids), detokenize_seconds).model_dump(),
+        }
+        if cache_key is not None:
+            response_cache.put(cache_key, without_timings(payload))
+        return payload
+
+    return stream_generation(prompt_ids, [refine_params(request)], ["refined"], finalize)
 
 # API Endpoints
 @app.get("/", response_model=dict)
@@ -123,159 +1064,486 @@ async def root():
         "endpoints": {
             "health": "/health",
             "generate": "/api/generate",
+            "generate_stream": "/api/generate/stream",
+            "generate_ws": "/api/generate/ws",
+            "generate_batch": "/api/generate/batch",
+            "refine": "/api/refine",
+            "refine_stream": "/api/refine/stream",
+            "refine_ws": "/api/refine/ws",
+            "score": "/api/score",
+            "adapters": "/api/adapters",
+            "metrics": "/metrics",
             "docs": "/docs"
         }
     }
 
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
-    """Health check endpoint"""
+    """Health check endpoint, with startup progress while the model loads"""
+    status = readiness.snapshot()
     return HealthResponse(
-        status="healthy" if model is not None else "model_not_loaded",
-        model_loaded=model is not None,
+        status="healthy" if readiness.ready else "failed" if readiness.failed else "loading",
+        model_loaded=readiness.ready,
+        **status,
         device=device,
+        queue_depth=scheduler.num_waiting if scheduler is not None else 0,
+        active_sequences=scheduler.num_active if scheduler is not None else 0,
         timestamp=datetime.now().isoformat()
     )
 
 @app.post("/api/generate", response_model=GenerateResponse)
-async def generate_code(request: GenerateRequest):
+async def generate_code(request: GenerateRequest, http_response: Response):
     """
     Generate Flutter code variants from a prompt
     
+    Seeded (or fully greedy) requests are served from the response cache
+    when an identical request has already been answered.
+    
     Args:
         request: GenerateRequest with prompt and generation parameters
     
     Returns:
         GenerateResponse with code variants
     """
-    if model is None or tokenizer is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-    
-    try:
-        logger.info(f"Generating code for prompt: {request.prompt[:50]}...")
+    with RequestMetrics("generate", request) as tracker:
+        ensure_model_loaded()
+        pin_adapter(request)
+        check_variants(request)
         
-        variants = []
+        cache_key = generate_cache_key(request)
+        cached = cached_response(cache_key, tracker.labels)
+        if cache_key is not None:
+            http_response.headers["X-Cache"] = "HIT" if cached is not None else "MISS"
+        if cached is not None:
+            http_response.headers["Server-Timing"] = server_timing(None, tracker.started, cache_hit=True)
+            return GenerateResponse(**cached)
         
-        # Generate multiple variants
-        for i in range(request.num_variants):
-            # Format prompt for the model
-            formatted_prompt = f"""### Instruction:
-Create a Flutter widget based on this description: {request.prompt}
-
-Style: {request.style}
-
-### Response:
-"""
-            
-            # Tokenize input
-            inputs = tokenizer(formatted_prompt, return_tensors="pt").to(device)
-            
-            # Generate code
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=request.max_tokens,
-                    temperature=request.temperature + (i * 0.1),  # Vary temperature for diversity
-                    top_p=0.95,
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id,
-                    num_return_sequences=1,
-                )
+        try:
+            logger.info(f"Generating code for prompt: {request.prompt[:50]}...")
             
-            # Decode output
-            generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+            # Queue every variant (or join an identical in-flight request);
+            # the scheduler decodes them alongside other requests
+            payload = await final_payload(generate_flight(request, cache_key, tracker.labels))
+            http_response.headers["Server-Timing"] = server_timing(payload["timings"], tracker.started)
+            response = GenerateResponse(**(payload if request.include_timings else without_timings(payload)))
             
-            # Extract only the response part
-            if "### Response:" in generated_text:
-                code = generated_text.split("### Response:")[1].strip()
-            else:
-                code = generated_text.strip()
+            logger.info(f"Successfully generated {len(response.variants)} variants")
+            return response
             
-            # Create variant
-            variant = CodeVariant(
-                id=f"variant_{i+1}_{datetime.now().timestamp()}",
-                code=code,
-                description=f"Variant {i+1} - Temperature {request.temperature + (i * 0.1):.1f}",
-                score=0.9 - (i * 0.1)  # Mock score, higher for first variants
-            )
-            variants.append(variant)
-            
-            logger.info(f"Generated variant {i+1}/{request.num_variants}")
-        
-        response = GenerateResponse(
-            variants=variants,
-            prompt=request.prompt,
-            generated_at=datetime.now().isoformat()
-        )
-        
-        logger.info(f"Successfully generated {len(variants)} variants")
-        return response
-        
-    except Exception as e:
-        logger.error(f"Error generating code: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error generating code: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/refine")
-async def refine_code(code: str, instructions: str):
-    """Refine existing code based on instructions"""
-    if model is None or tokenizer is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
+@app.post("/api/generate/stream")
+async def generate_code_stream(request: GenerateRequest):
+    """
+    Stream Flutter code variants as Server-Sent Events
     
+    Emits `token` events tagged with variant_id as text is decoded, then a
+    `done` event carrying the full GenerateResponse (including scores).
+    With best_of, tokens of every candidate are streamed and the `done`
+    event lists the variants that were kept.
+    """
+    with RequestMetrics("generate_stream", request) as tracker:
+        ensure_model_loaded()
+        pin_adapter(request)
+        check_variants(request)
+        logger.info(f"Streaming code for prompt: {request.prompt[:50]}...")
+        return sse_response(tracker.track(generate_events(request, generate_cache_key(request), tracker.labels)))
+
+@app.websocket("/api/generate/ws")
+async def generate_code_ws(websocket: WebSocket):
+    """Stream Flutter code variants over a WebSocket"""
+    def start(payload):
+        request = GenerateRequest(**payload)
+        with RequestMetrics("generate_ws", request) as tracker:
+            ensure_model_loaded()
+            pin_adapter(request)
+            check_variants(request)
+            return tracker.track(generate_events(request, generate_cache_key(request), tracker.labels))
+
+    await websocket_stream(websocket, start)
+
+async def generate_batch_item(index: int, request: GenerateRequest) -> BatchItemResult:
+    """One prompt of a batch, served like /api/generate (cache, shared flights, best_of)"""
     try:
-        formatted_prompt = f"""### Instruction:
-Refine this Flutter code based on these instructions: {instructions}
+        with RequestMetrics("generate_batch", request) as tracker:
+            pin_adapter(request)
+            check_variants(request)
+            cache_key = generate_cache_key(request)
+            payload = cached_response(cache_key, tracker.labels)
+            if payload is None:
+                payload = await final_payload(generate_flight(request, cache_key, tracker.labels))
+            if not request.include_timings:
+                payload = without_timings(payload)
+            return BatchItemResult(index=index, response=GenerateResponse(**payload))
+    except HTTPException as e:
+        return BatchItemResult(index=index, status_code=e.status_code, error=str(e.detail))
+    except Exception as e:
+        logger.error(f"Error generating batch prompt {index}: {e}")
+        return BatchItemResult(index=index, status_code=500, error=str(e))
 
-Current code:
-{code}
+@app.post("/api/generate/batch", response_model=BatchGenerateResponse)
+async def generate_code_batch(request: BatchGenerateRequest):
+    """
+    Generate code for many prompts in one call
+    
+    Prompts are queued shortest first, so the scheduler admits prompts of
+    similar length together and the left-padded batch wastes little compute
+    on padding. At most max_batch_size sequences are queued at a time, which
+    leaves queue room for interactive traffic. Each prompt gets its own
+    result or error, in request order.
+    """
+    ensure_model_loaded()
+    if not request.requests:
+        raise HTTPException(status_code=400, detail="requests must not be empty")
+    if len(request.requests) > serving_config.max_batch_prompts:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {serving_config.max_batch_prompts} prompts can be generated per batch",
+        )
+    
+    lengths = [len(tokenizer(format_generate_prompt(item))["input_ids"]) for item in request.requests]
+    order = sorted(range(len(request.requests)), key=lambda i: lengths[i])
+    logger.info(f"Generating a batch of {len(order)} prompts ({lengths[order[0]]}-{lengths[order[-1]]} tokens)")
+    
+    budget = asyncio.Semaphore(serving_config.max_batch_size)
+    
+    async def run(index: int, sequences: int) -> BatchItemResult:
+        try:
+            return await generate_batch_item(index, request.requests[index])
+        finally:
+            for _ in range(sequences):
+                budget.release()
+    
+    tasks = []
+    try:
+        for index in order:
+            sequences = min(num_candidates(request.requests[index]), serving_config.max_batch_size)
+            for _ in range(sequences):
+                await budget.acquire()
+            tasks.append(asyncio.create_task(run(index, sequences)))
+        results = await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    
+    return BatchGenerateResponse(results=sorted(results, key=lambda result: result.index))
 
-### Response:
-"""
+@app.post("/api/refine")
+async def refine_code(request: RefineRequest, http_response: Response):
+    """Refine existing code based on instructions"""
+    with RequestMetrics("refine", request) as tracker:
+        ensure_model_loaded()
+        pin_adapter(request)
         
-        inputs = tokenizer(formatted_prompt, return_tensors="pt").to(device)
+        cache_key = refine_cache_key(request)
+        cached = cached_response(cache_key, tracker.labels)
+        if cache_key is not None:
+            http_response.headers["X-Cache"] = "HIT" if cached is not None else "MISS"
+        if cached is not None:
+            http_response.headers["Server-Timing"] = server_timing(None, tracker.started, cache_hit=True)
+            return cached
         
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=512,
-                temperature=0.7,
-                top_p=0.95,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
+        try:
+            payload = await final_payload(refine_flight(request, cache_key, tracker.labels))
+            http_response.headers["Server-Timing"] = server_timing(payload["timings"], tracker.started)
+            return payload if request.include_timings else without_timings(payload)
+            
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error refining code: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/refine/stream")
+async def refine_code_stream(request: RefineRequest):
+    """Stream a refinement as Server-Sent Events (`token` events, then `done`)"""
+    with RequestMetrics("refine_stream", request) as tracker:
+        ensure_model_loaded()
+        pin_adapter(request)
+        return sse_response(tracker.track(refine_events(request, refine_cache_key(request), tracker.labels)))
+
+@app.websocket("/api/refine/ws")
+async def refine_code_ws(websocket: WebSocket):
+    """Stream a refinement over a WebSocket"""
+    def start(payload):
+        request = RefineRequest(**payload)
+        with RequestMetrics("refine_ws", request) as tracker:
+            ensure_model_loaded()
+            pin_adapter(request)
+            return tracker.track(refine_events(request, refine_cache_key(request), tracker.labels))
+
+    await websocket_stream(websocket, start)
+
+@app.post("/api/score", response_model=ScoreResponse)
+async def score_candidates(request: ScoreRequest):
+    """
+    Rank existing completions of a generation prompt without generating
+    
+    Every candidate is scored like a generated variant, from its tokens'
+    log-likelihood given the prompt. The prompt is prefilled once and the
+    candidates share its KV cache in batched forward passes.
+    """
+    with RequestMetrics("score", request):
+        ensure_model_loaded()
+        pin_adapter(request)
+        if not request.candidates:
+            raise HTTPException(status_code=400, detail="candidates must not be empty")
+        if len(request.candidates) > serving_config.max_score_candidates:
+            raise HTTPException(
+                status_code=400,
+                detail=f"At most {serving_config.max_score_candidates} candidates can be scored at once",
             )
         
-        refined_code = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        if "### Response:" in refined_code:
-            refined_code = refined_code.split("### Response:")[1].strip()
-        
-        return {"refined_code": refined_code}
+        try:
+            prompt_ids = tokenizer(format_generate_prompt(GenerateRequest(prompt=request.prompt, style=request.style)))["input_ids"]
+            candidate_ids = [
+                tokenizer(candidate, add_special_tokens=False)["input_ids"] for candidate in request.candidates
+            ]
+            logprobs = await asyncio.wrap_future(scheduler.call_one(functools.partial(
+                score_continuations,
+                prompt_ids=prompt_ids,
+                continuations=candidate_ids,
+                adapter=request.adapter,
+            )))
+            
+            scores = []
+            for index, (candidate, ids, token_logprobs) in enumerate(zip(request.candidates, candidate_ids, logprobs)):
+                mean_logprob = sum(token_logprobs) / len(token_logprobs) if token_logprobs else float("-inf")
+                scores.append(CandidateScore(
+                    index=index,
+                    score=variant_score(mean_logprob, candidate),
+                    mean_logprob=round(mean_logprob, 4) if token_logprobs else None,
+                    total_logprob=round(sum(token_logprobs), 4),
+                    tokens=[tokenizer.decode([token]) for token in ids],
+                    surprisal=[round(-logprob, 4) for logprob in token_logprobs],
+                ))
+            scores.sort(key=lambda score: score.score, reverse=True)
+            return ScoreResponse(
+                scores=scores,
+                prompt=request.prompt,
+                prompt_tokens=len(prompt_ids),
+                scored_at=datetime.now().isoformat(),
+            )
         
-    except Exception as e:
-        logger.error(f"Error refining code: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error scoring candidates: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Hit/miss counters of the response and prefix caches"""
+    return {
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "singleflight": flights.stats(),
+        "prefix_cache": scheduler.prefix_cache.stats() if scheduler is not None and scheduler.prefix_cache is not None else None,
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Serving metrics in the Prometheus text exposition format"""
+    if readiness.ready and scheduler is not None:
+        try:
+            # Batch state belongs to the scheduler thread (one per worker in a pool)
+            usage = await asyncio.wait_for(
+                asyncio.wrap_future(scheduler.call(ContinuousBatchScheduler.usage)),
+                timeout=METRICS_USAGE_TIMEOUT_SECONDS,
+            )
+            metrics.observe_usage(usage if isinstance(usage, list) else [usage])
+        except (asyncio.TimeoutError, RuntimeError) as e:
+            logger.warning(f"Scheduler usage unavailable for /metrics: {e!r}")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/api/model/info")
 async def model_info():
     """Get information about the loaded model"""
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
+    ensure_model_loaded()
     
-    model_path = "outputs/dpo_model" if os.path.exists("outputs/dpo_model") else "outputs/sft_model"
+    # With the registry, the default adapter is what unqualified requests get
+    default = adapters.info(adapters.default) if adapters is not None else None
+    model_path = default.path if default is not None else model_source.get("adapter_path")
     
     return {
-        "base_model": "codellama/CodeLlama-7b-hf",
-        "fine_tuned": os.path.exists(model_path),
-        "model_path": model_path if os.path.exists(model_path) else None,
+        "base_model": model_source.get("base_model"),
+        "fine_tuned": model_path is not None,
+        "model_path": model_path,
+        "merged_path": model_source.get("merged_path"),
         "device": device,
-        "model_type": "DPO" if "dpo" in model_path else "SFT" if os.path.exists(model_path) else "Base",
+        "weight_quantization": model_source.get("weight_quantization"),
+        "model_type": "DPO" if model_path and "dpo" in model_path else "SFT" if model_path else "Base",
+        "default_adapter": adapters.default if adapters is not None else None,
+        "adapters": adapters.describe() if adapters is not None else [],
+        "draft_model": serving_config.draft_model if speculative is not None else None,
+        # Forked workers keep their own counters, so these cover in-process serving only
+        "speculative": speculative.stats.snapshot() if speculative is not None and isinstance(scheduler, ContinuousBatchScheduler) else None,
+        "prompt_lookup": prompt_lookup.stats.snapshot() if prompt_lookup is not None and isinstance(scheduler, ContinuousBatchScheduler) else None,
     }
 
+@app.get("/api/adapters")
+async def list_adapters():
+    """LoRA adapters requests can select with the `adapter` field"""
+    ensure_model_loaded()
+    return {
+        "default": adapters.default if adapters is not None else None,
+        "adapters": adapters.describe() if adapters is not None else [],
+    }
+
+# Clients the admin endpoints accept when no admin_token is configured
+LOOPBACK_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+def require_admin(http_request: Request, token: Optional[str]):
+    """Allow admin calls with the configured token, or only from loopback when none is set"""
+    if serving_config.admin_token:
+        if token != serving_config.admin_token:
+            raise HTTPException(status_code=403, detail="Invalid admin token")
+        return
+    client = http_request.client.host if http_request.client is not None else None
+    if client not in LOOPBACK_HOSTS:
+        raise HTTPException(status_code=403, detail="Admin endpoints need admin_token to be set for non-local clients")
+
+def require_registry():
+    ensure_model_loaded()
+    if adapters is None:
+        raise HTTPException(status_code=400, detail="Adapter hot-swapping is disabled (hot_swap_adapters = false)")
+
+# Admin adapter changes run one at a time, so checks made before a broadcast still hold while it runs
+adapter_changes = asyncio.Lock()
+
+async def broadcast_adapter_change(fn, rollback: Optional[Callable]):
+    """
+    Apply an adapter operation in every worker of the pool
+    
+    If only some workers applied it, rollback (which must be a no-op where
+    the change did not go through) restores them, so the workers never
+    disagree about which adapters exist.
+    """
+    outcomes = await asyncio.wrap_future(scheduler.call_each(fn))
+    errors = [error for error, _ in outcomes if error is not None]
+    if not errors:
+        return outcomes[0][1]
+    if rollback is not None and len(errors) < len(outcomes):
+        logger.warning(f"Adapter change failed in {len(errors)}/{len(outcomes)} workers; rolling it back")
+        await asyncio.wrap_future(scheduler.call(rollback))
+    raise errors[0]
+
+async def change_adapters(fn, update_router: Callable, rollback: Optional[Callable] = None):
+    """
+    Apply an adapter operation between decode steps
+    
+    In-process, the scheduler owns the registry. A worker pool applies it in
+    every worker; update_router then mirrors the result in the router's copy
+    of the registry, which requests are resolved against. The router only
+    tracks metadata, so no adapter weights are loaded in the API process.
+    """
+    try:
+        if isinstance(scheduler, ModelWorkerPool):
+            result = await broadcast_adapter_change(fn, rollback)
+            update_router(result)
+            return result
+        return await asyncio.wrap_future(scheduler.call(fn))
+    except AdapterInUseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Unknown adapter {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def change_default_adapter(name: str):
+    await change_adapters(
+        functools.partial(make_default_adapter, name=name),
+        lambda _: adapters.set_default(name),
+    )
+
+@app.post("/api/admin/adapters")
+async def attach_adapter_endpoint(http_request: Request, request: AttachAdapterRequest, x_admin_token: Optional[str] = Header(None)):
+    """Attach a LoRA adapter to the running model without a restart"""
+    require_admin(http_request, x_admin_token)
+    require_registry()
+    
+    async with adapter_changes:
+        await change_adapters(
+            functools.partial(attach_adapter, name=request.name, path=request.path),
+            adapters.record,
+            rollback=functools.partial(discard_adapter, name=request.name),
+        )
+        if request.make_default:
+            await change_default_adapter(request.name)
+    logger.info(f"Adapter {request.name!r} attached from {request.path}")
+    return {"attached": asdict(adapters.info(request.name)), "default": adapters.default}
+
+@app.delete("/api/admin/adapters/{name}")
+async def detach_adapter_endpoint(http_request: Request, name: str, x_admin_token: Optional[str] = Header(None)):
+    """Detach an adapter no queued or running request uses"""
+    require_admin(http_request, x_admin_token)
+    require_registry()
+    
+    async with adapter_changes:
+        info = adapters.info(name)
+        if info is None:
+            raise HTTPException(status_code=404, detail=f"Unknown adapter {name!r}")
+        if name == adapters.default:
+            raise HTTPException(status_code=400, detail=f"Adapter {name!r} is the default; choose another default first")
+        await change_adapters(
+            functools.partial(detach_adapter, name=name),
+            lambda _: adapters.forget(name),
+            rollback=functools.partial(restore_adapter, name=name, path=info.path),
+        )
+    logger.info(f"Adapter {name!r} detached")
+    return {"detached": name, "default": adapters.default}
+
+@app.post("/api/admin/adapters/{name}/default")
+async def set_default_adapter(http_request: Request, name: str, x_admin_token: Optional[str] = Header(None)):
+    """Make an attached adapter the one requests without an `adapter` field use"""
+    require_admin(http_request, x_admin_token)
+    require_registry()
+    
+    async with adapter_changes:
+        await change_default_adapter(name)
+    logger.info(f"Default adapter is now {name!r}")
+    return {"default": name}
+
+@app.post("/api/admin/profile")
+async def arm_profiler(http_request: Request, request: ProfileRequest, x_admin_token: Optional[str] = Header(None)):
+    """Profile the next `requests` requests and/or `seconds` seconds"""
+    require_admin(http_request, x_admin_token)
+    ensure_model_loaded()
+    if request.requests is None and request.seconds is None:
+        raise HTTPException(status_code=400, detail="Give `requests` and/or `seconds`")
+    if (request.requests is not None and request.requests < 1) or (request.seconds is not None and request.seconds <= 0):
+        raise HTTPException(status_code=400, detail="`requests` and `seconds` must be positive")
+    
+    try:
+        session = await profile_capture.arm(scheduler, requests=request.requests, seconds=request.seconds)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"armed": session}
+
+@app.get("/api/admin/profile")
+async def profiler_status(http_request: Request, x_admin_token: Optional[str] = Header(None)):
+    """The running profiling session, if any, and the last finished one"""
+    require_admin(http_request, x_admin_token)
+    return profile_capture.status()
+
+@app.post("/api/admin/profile/stop")
+async def stop_profiler(http_request: Request, x_admin_token: Optional[str] = Header(None)):
+    """Stop the running profiling session early and write its profiles"""
+    require_admin(http_request, x_admin_token)
+    if not profile_capture.armed:
+        raise HTTPException(status_code=409, detail="No profiling session is running")
+    return {"finished": await profile_capture.stop()}
+
 # Run server
 if __name__ == "__main__":
     uvicorn.run(
         "api_server:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        reload=serving_config.reload,
         log_level="info"
     )
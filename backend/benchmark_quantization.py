@@ -0,0 +1,174 @@
+"""
+CPU Weight Quantization Benchmark
+Compares decode throughput and resident memory of fp32, bf16, int8 and int4
+weights on CPU, using a tiny randomly initialised model unless one is given
+"""
+
+import multiprocessing as mp
+import os
+import time
+from typing import Optional
+
+import torch
+
+from cpu_quantization import quantize_model, weight_bytes
+
+VARIANTS = {
+    "fp32": (torch.float32, None),
+    "bf16": (torch.bfloat16, None),
+    "int8": (torch.bfloat16, 8),
+    "int4": (torch.bfloat16, 4),
+}
+
+
+def rss_mb() -> float:
+    """Resident set size of this process"""
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def build_model(model_path: Optional[str], dtype: torch.dtype):
+    from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+    if model_path:
+        return AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=dtype, low_cpu_mem_usage=True)
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=32000,
+        hidden_size=1024,
+        intermediate_size=2816,
+        num_hidden_layers=8,
+        num_attention_heads=16,
+        num_key_value_heads=16,
+    )
+    return LlamaForCausalLM(config).to(dtype)
+
+
+def run_variant(name: str, args: dict, results):
+    """Load, quantize and time one variant (runs in its own process so RSS is not shared)"""
+    torch.set_num_threads(args["threads"])
+    dtype, bits = VARIANTS[name]
+    baseline_rss = rss_mb()
+
+    model = build_model(args["model_path"], dtype)
+    if bits is not None:
+        model = quantize_model(model, bits=bits, group_size=args["group_size"])
+    model.eval()
+
+    torch.manual_seed(1)
+    input_ids = torch.randint(3, model.config.vocab_size, (1, args["prompt_length"]))
+    generate_kwargs = dict(
+        max_new_tokens=args["new_tokens"],
+        min_new_tokens=args["new_tokens"],
+        do_sample=False,
+        pad_token_id=0,
+    )
+
+    with torch.no_grad():
+        # One short generation so kernel selection is not timed
+        model.generate(input_ids, **{**generate_kwargs, "max_new_tokens": 2, "min_new_tokens": 2})
+        start = time.perf_counter()
+        output = model.generate(input_ids, **generate_kwargs)
+        elapsed = time.perf_counter() - start
+
+        # Greedy outputs of a random model diverge on near-ties, so quality is
+        # measured teacher-forced: next-token agreement along the fp32 continuation
+        reference = args.get("reference_tokens")
+        agreement = None
+        if reference:
+            forced = torch.cat([input_ids, torch.tensor([reference])], dim=1)
+            logits = model(forced).logits[0, args["prompt_length"] - 1:-1]
+            agreement = (logits.argmax(dim=-1) == torch.tensor(reference)).float().mean().item()
+
+    results[name] = {
+        "tokens_per_second": args["new_tokens"] / elapsed,
+        "weights_mb": weight_bytes(model) / (1024 * 1024),
+        "rss_mb": rss_mb() - baseline_rss,
+        "tokens": output[0, args["prompt_length"]:].tolist(),
+        "agreement": agreement,
+    }
+
+
+def main():
+    """Main execution"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark CPU weight quantization against fp32/bf16")
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        default=None,
+        help="Local model to benchmark (default: a tiny random Llama)"
+    )
+    parser.add_argument(
+        "--variants",
+        type=str,
+        default="fp32,bf16,int8,int4",
+        help="Comma-separated variants to run"
+    )
+    parser.add_argument(
+        "--prompt_length",
+        type=int,
+        default=64,
+        help="Prompt tokens"
+    )
+    parser.add_argument(
+        "--new_tokens",
+        type=int,
+        default=64,
+        help="Tokens decoded per timed generation"
+    )
+    parser.add_argument(
+        "--group_size",
+        type=int,
+        default=128,
+        help="int4 quantization group size"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count(),
+        help="Torch CPU threads"
+    )
+
+    args = parser.parse_args()
+    variants = [name.strip() for name in args.variants.split(",") if name.strip()]
+    unknown = [name for name in variants if name not in VARIANTS]
+    if unknown:
+        parser.error(f"Unknown variants {unknown}; choose from {sorted(VARIANTS)}")
+
+    print(f"🧪 Benchmarking {', '.join(variants)} on {args.model_path or 'a tiny random Llama'}")
+    context = mp.get_context("spawn")
+    manager = context.Manager()
+    results = manager.dict()
+
+    # fp32 runs first so the others can be compared against its continuation
+    variants.sort(key=lambda name: name != "fp32")
+    for name in variants:
+        print(f"⏱️  Running {name}...")
+        variant_args = vars(args)
+        if "fp32" in results:
+            variant_args["reference_tokens"] = results["fp32"]["tokens"]
+        process = context.Process(target=run_variant, args=(name, variant_args, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"❌ {name} failed (exit code {process.exitcode})")
+
+    print()
+    print(f"{'variant':<8} {'tok/s':>8} {'weights MB':>11} {'RSS MB':>8} {'fp32 top-1':>11}")
+    for name in variants:
+        if name not in results:
+            continue
+        result = results[name]
+        agreement = f"{result['agreement']:.1%}" if result["agreement"] is not None else "-"
+        print(
+            f"{name:<8} {result['tokens_per_second']:>8.1f} {result['weights_mb']:>11.1f} "
+            f"{result['rss_mb']:>8.1f} {agreement:>11}"
+        )
+
+
+if __name__ == "__main__":
+    main()
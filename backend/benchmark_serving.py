@@ -0,0 +1,636 @@
+"""
+Serving Load Test and Latency Benchmark
+Starts api_server.py against a tiny randomly initialised model (or targets a
+running server), replays the dataset's instructions as open- or closed-loop
+traffic and reports latency percentiles, time to first token, tokens/sec
+and error rate as JSON, optionally compared against a stored baseline
+"""
+
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stand-in prompts when the processed dataset is not available
+FALLBACK_INSTRUCTIONS = [
+    "Create a counter widget with increment and decrement buttons",
+    "Create a login screen with email and password validation",
+    "Create a product card showing an image, title, price and an add-to-cart button",
+    "Create a todo list with swipe-to-delete and a floating action button",
+    "Create a settings page with dark mode and notification toggles",
+]
+
+# Stub models: no downloads, random weights, character-level tokenizer
+STUB_MODELS = {
+    # Exercises the whole serving path with real (small) matmuls
+    "tiny": dict(hidden_size=256, intermediate_size=688, num_hidden_layers=4, num_attention_heads=4),
+    # Next to no model compute, so the numbers show the server's own overhead
+    "micro": dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2),
+}
+
+# Summary metrics compared against a baseline: (key path, True if higher is better)
+COMPARED_METRICS = [
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("ttft_ms", "p50"), False),
+    (("ttft_ms", "p95"), False),
+    (("ttft_ms", "p99"), False),
+    (("tokens_per_second",), True),
+    (("requests_per_second",), True),
+    (("error_rate",), False),
+]
+
+
+def build_stub_model(output_dir: str, size: str = "tiny", seed: int = 0) -> str:
+    """
+    Save a randomly initialised Llama and a character-level tokenizer
+
+    Args:
+        output_dir: Directory to save the model to
+        size: Key of STUB_MODELS
+        seed: Weight initialisation seed
+
+    Returns:
+        The model directory, usable as base_model
+    """
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    vocab = {"<pad>": 0, "<s>": 1, "</s>": 2}
+    for character in string.printable:
+        vocab.setdefault(character, len(vocab))
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<pad>"))
+    backend.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    backend.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>",
+    )
+    tokenizer.save_pretrained(output_dir)
+
+    torch.manual_seed(seed)
+    spec = STUB_MODELS[size]
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        num_key_value_heads=spec["num_attention_heads"],
+        max_position_embeddings=8192,
+        bos_token_id=1,
+        eos_token_id=2,
+        pad_token_id=0,
+        **spec,
+    )
+    model = LlamaForCausalLM(config)
+    with torch.no_grad():
+        # Random weights would end sequences at arbitrary points. Pin residual channel 0
+        # to a positive constant and give EOS a large negative weight on it, so every
+        # generation runs to max_tokens.
+        model.model.embed_tokens.weight[:, 0] = 1.0
+        for layer in model.model.layers:
+            layer.self_attn.o_proj.weight[0] = 0
+            layer.mlp.down_proj.weight[0] = 0
+        model.lm_head.weight[config.eos_token_id] = 0
+        model.lm_head.weight[config.eos_token_id, 0] = -100.0
+    model.save_pretrained(output_dir)
+    return output_dir
+
+
+def load_instructions(dataset_path: str = "./processed_data/sft_dataset", prompts_file: Optional[str] = None) -> List[str]:
+    """
+    Instructions to replay, from a prompts file, the processed SFT dataset or the fallback list
+
+    Args:
+        dataset_path: prepare_dataset.py output with "**Instruction**: ..." prompts
+        prompts_file: Optional text file with one instruction per line
+
+    Returns:
+        Non-empty list of instructions
+    """
+    if prompts_file:
+        with open(prompts_file) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    instructions = []
+    try:
+        from datasets import load_from_disk
+
+        dataset = load_from_disk(dataset_path)
+        for split in dataset.values():
+            for prompt in split["prompt"]:
+                match = re.search(r"\*\*Instruction\*\*: (.+)", prompt)
+                if match:
+                    instructions.append(match.group(1).strip())
+    except Exception as e:
+        print(f"⚠️  Could not read instructions from {dataset_path} ({e}); using built-in prompts")
+    return instructions or list(FALLBACK_INSTRUCTIONS)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(base_model: str, workdir: str, overrides: Dict[str, str], port: int) -> subprocess.Popen:
+    """
+    Run api_server.py under uvicorn with a generated config.ini
+
+    The server runs in its own working directory, so trained adapters and
+    caches under backend/outputs are not picked up; its output goes to
+    server.log there.
+
+    Args:
+        base_model: Model directory or hub id to serve
+        workdir: Working directory holding the generated config.ini
+        overrides: Extra [serving] settings
+        port: Port to bind
+
+    Returns:
+        The server process
+    """
+    settings = {
+        "base_model": base_model,
+        "cpu_quantization": "none",
+        "cpu_dtype": "float32",
+        # Requests are seeded for reproducibility, which would otherwise make them cache hits
+        "response_cache": "false",
+        **overrides,
+    }
+    with open(os.path.join(workdir, "config.ini"), "w") as f:
+        f.write("[serving]\n")
+        for key, value in settings.items():
+            f.write(f"{key} = {value}\n")
+
+    env = {**os.environ, "PYTHONPATH": BACKEND_DIR + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    with open(os.path.join(workdir, "server.log"), "w") as log:
+        return subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api_server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=workdir,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+def wait_until_ready(base_url: str, process: Optional[subprocess.Popen], timeout: float = 600.0):
+    """Poll /health until the model is loaded"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            status, body = http_request(base_url, "GET", "/health")
+            health = json.loads(body)
+            if health["status"] == "healthy":
+                return
+            if health["status"] == "failed":
+                raise RuntimeError(f"Model failed to load: {health.get('error')}")
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server not ready after {timeout:.0f}s")
+
+
+def http_request(base_url: str, method: str, path: str, body: Optional[dict] = None, timeout: float = 600.0):
+    url = urlparse(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        connection.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def send_request(base_url: str, endpoint: str, body: dict) -> dict:
+    """
+    Send one request and time it
+
+    Streamed endpoints measure time to first token at the client; for the
+    others it comes from the server's stage timings (tokenize + queue + prefill).
+
+    Returns:
+        {"ok", "status", "latency", "ttft", "tokens", "error"}
+    """
+    url = urlparse(base_url)
+    record = {"ok": False, "status": None, "latency": None, "ttft": None, "tokens": 0, "error": None}
+    started = time.perf_counter()
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=600)
+    try:
+        connection.request("POST", f"/api/{endpoint.replace('_', '/')}", body=json.dumps(body), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        record["status"] = response.status
+        if response.status != 200:
+            record["error"] = f"HTTP {response.status}"
+            response.read()
+            return record
+
+        if endpoint.endswith("stream"):
+            payload, event = None, None
+            for raw_line in response:
+                line = raw_line.decode().rstrip("\n")
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    if event == "token" and record["ttft"] is None:
+                        record["ttft"] = time.perf_counter() - started
+                    elif event == "done":
+                        payload = json.loads(line[len("data: "):])
+                    elif event == "error":
+                        record["error"] = json.loads(line[len("data: "):]).get("detail", "stream error")
+                        return record
+            if payload is None:
+                record["error"] = "stream ended without a result"
+                return record
+        else:
+            payload = json.loads(response.read())
+
+        timings = payload.get("timings") or {}
+        variants = timings.get("variants", [])
+        record["tokens"] = sum(variant["tokens_generated"] for variant in variants)
+        if record["ttft"] is None and variants:
+            first = min(variant["queue_ms"] + variant["prefill_ms"] for variant in variants)
+            record["ttft"] = (timings["tokenize_ms"] + first) / 1000
+        record["ok"] = True
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        record["latency"] = time.perf_counter() - started
+        connection.close()
+    return record
+
+
+def request_body(endpoint: str, instruction: str, index: int, args) -> dict:
+    """Request for one replayed instruction, seeded so runs are reproducible"""
+    if endpoint.startswith("refine"):
+        return {
+            "code": "class MyWidget extends StatelessWidget {\n  @override\n  Widget build(BuildContext context) => Container();\n}",
+            "instructions": instruction,
+            "seed": index,
+            "include_timings": True,
+        }
+    return {
+        "prompt": instruction,
+        "temperature": args.temperature,
+        "max_tokens": args.max_tokens,
+        "num_variants": args.num_variants,
+        "seed": index,
+        "include_timings": True,
+    }
+
+
+def run_closed_loop(base_url: str, bodies: List[dict], endpoint: str, concurrency: int, duration: Optional[float]) -> List[dict]:
+    """`concurrency` clients, each sending its next request as soon as the previous one returns"""
+    records, lock = [], threading.Lock()
+    next_index = iter(range(len(bodies)))
+    deadline = time.monotonic() + duration if duration else None
+
+    def client():
+        while deadline is None or time.monotonic() < deadline:
+            with lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            record = send_request(base_url, endpoint, bodies[index])
+            with lock:
+                records.append(record)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+
+def run_open_loop(base_url: str, bodies: List[dict], endpoint: str, rate: float, duration: Optional[float], seed: int) -> List[dict]:
+    """Poisson arrivals at `rate` requests/sec, sent whether or not earlier requests have returned"""
+    generator = random.Random(seed)
+    futures = []
+    started = time.monotonic()
+    next_arrival = started
+    with ThreadPoolExecutor(max_workers=1024) as executor:
+        for body in bodies:
+            if duration and next_arrival - started >= duration:
+                break
+            time.sleep(max(0.0, next_arrival - time.monotonic()))
+            futures.append(executor.submit(send_request, base_url, endpoint, body))
+            next_arrival += generator.expovariate(rate)
+        return [future.result() for future in futures]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99/mean/max in milliseconds (nearest-rank)"""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+
+    def rank(q: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))] * 1000
+
+    return {
+        "p50": round(rank(0.50), 3),
+        "p95": round(rank(0.95), 3),
+        "p99": round(rank(0.99), 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def summarize(records: List[dict], wall_seconds: float) -> dict:
+    succeeded = [record for record in records if record["ok"]]
+    errors: Dict[str, int] = {}
+    for record in records:
+        if not record["ok"]:
+            errors[record["error"]] = errors.get(record["error"], 0) + 1
+    tokens = sum(record["tokens"] for record in succeeded)
+    return {
+        "requests": len(records),
+        "succeeded": len(succeeded),
+        "error_rate": round(1 - len(succeeded) / len(records), 4) if records else 0.0,
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(len(succeeded) / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+        "tokens_generated": tokens,
+        "tokens_per_second": round(tokens / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+        "latency_ms": percentiles([record["latency"] for record in succeeded]),
+        "ttft_ms": percentiles([record["ttft"] for record in succeeded if record["ttft"] is not None]),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[dict]:
+    """
+    Metrics that got worse than the baseline by more than `tolerance` (a fraction)
+
+    Returns:
+        One entry per compared metric, with "regression" set where it got worse
+    """
+    rows = []
+    for path, higher_is_better in COMPARED_METRICS:
+        current, previous = results["summary"], baseline["summary"]
+        for key in path:
+            current, previous = current.get(key), previous.get(key)
+        if current is None or previous is None:
+            continue
+        name = ".".join(path)
+        if previous == 0:
+            change = 0.0 if current == 0 else float("inf")
+        else:
+            change = (current - previous) / abs(previous)
+        worse = -change if higher_is_better else change
+        if name == "error_rate":
+            # Error rates start near 0, so compare absolute points instead of ratios
+            worse = current - previous
+        rows.append({
+            "metric": name,
+            "baseline": previous,
+            "current": current,
+            "change": round(change, 4) if change != float("inf") else None,
+            "regression": worse > tolerance,
+        })
+    return rows
+
+
+def main():
+    """Main execution"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load-test api_server.py and report serving latency and throughput")
+    parser.add_argument(
+        "--url",
+        type=str,
+        default=None,
+        help="Benchmark an already running server instead of starting one"
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="tiny",
+        help=f"Stub model to serve ({', '.join(STUB_MODELS)}) or a model path / hub id"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="[serving] config override for the started server (repeatable), e.g. --set max_batch_size=16"
+    )
+    parser.add_argument(
+        "--endpoint",
+        type=str,
+        default="generate_stream",
+        choices=["generate", "generate_stream", "refine", "refine_stream"],
+        help="Endpoint to load (streamed endpoints measure time to first token at the client)"
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="closed",
+        choices=["closed", "open"],
+        help="closed: fixed number of concurrent clients; open: Poisson arrivals at --rate"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Concurrent clients in closed-loop mode"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=2.0,
+        help="Arrival rate (requests/sec) in open-loop mode"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=64,
+        help="Requests to send"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=None,
+        help="Stop sending new requests after this many seconds"
+    )
+    parser.add_argument(
+        "--warmup_requests",
+        type=int,
+        default=4,
+        help="Untimed requests sent before measuring"
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=64,
+        help="max_tokens of generate requests"
+    )
+    parser.add_argument(
+        "--num_variants",
+        type=int,
+        default=1,
+        help="Variants per generate request"
+    )
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        default=0.7,
+        help="Sampling temperature of generate requests"
+    )
+    parser.add_argument(
+        "--dataset_path",
+        type=str,
+        default="./processed_data/sft_dataset",
+        help="Processed dataset the instructions are drawn from"
+    )
+    parser.add_argument(
+        "--prompts_file",
+        type=str,
+        default=None,
+        help="Text file with one instruction per line (overrides --dataset_path)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the stub model, the instruction order and the arrival times"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write the results JSON here"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Results JSON of an earlier run to compare against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.10,
+        help="Allowed relative slowdown (and absolute error-rate increase) before flagging a regression"
+    )
+
+    args = parser.parse_args()
+    overrides = {}
+    for item in args.set:
+        key, separator, value = item.partition("=")
+        if not separator:
+            parser.error(f"--set expects KEY=VALUE, got {item!r}")
+        overrides[key.strip()] = value.strip()
+
+    instructions = load_instructions(args.dataset_path, args.prompts_file)
+    generator = random.Random(args.seed)
+    total = args.warmup_requests + args.requests
+    picked = [generator.choice(instructions) for _ in range(total)]
+    bodies = [request_body(args.endpoint, instruction, index, args) for index, instruction in enumerate(picked)]
+
+    process = None
+    workdir = tempfile.mkdtemp(prefix="benchmark_serving_")
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+            server = {"url": base_url}
+        else:
+            base_model = args.model
+            if args.model in STUB_MODELS:
+                print(f"🧪 Building a random {args.model} model (no downloads)...")
+                base_model = build_stub_model(os.path.join(workdir, "model"), args.model, args.seed)
+                # Random text should not be cut short by the Dart structure check either
+                overrides = {"early_stopping": "false", **overrides}
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            print(f"🚀 Starting api_server on {base_url} with {args.model}...")
+            process = start_server(base_model, workdir, overrides, port)
+            server = {"model": args.model, "overrides": overrides}
+
+        try:
+            wait_until_ready(base_url, process)
+        except (RuntimeError, TimeoutError):
+            if process is not None:
+                with open(os.path.join(workdir, "server.log")) as f:
+                    print(f.read()[-4000:])
+            raise
+        print(f"🔥 Warming up with {args.warmup_requests} requests...")
+        for body in bodies[:args.warmup_requests]:
+            send_request(base_url, args.endpoint, body)
+
+        measured = bodies[args.warmup_requests:]
+        load = f"{args.concurrency} clients" if args.mode == "closed" else f"{args.rate:g} req/s"
+        print(f"⏱️  Sending {len(measured)} {args.endpoint} requests ({args.mode} loop, {load})...")
+        started = time.perf_counter()
+        if args.mode == "closed":
+            records = run_closed_loop(base_url, measured, args.endpoint, args.concurrency, args.duration)
+        else:
+            records = run_open_loop(base_url, measured, args.endpoint, args.rate, args.duration, args.seed)
+        wall_seconds = time.perf_counter() - started
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "server": server,
+        "load": {
+            "endpoint": args.endpoint,
+            "mode": args.mode,
+            "concurrency": args.concurrency if args.mode == "closed" else None,
+            "rate": args.rate if args.mode == "open" else None,
+            "max_tokens": args.max_tokens,
+            "num_variants": args.num_variants,
+            "instructions": len(instructions),
+        },
+        "summary": summarize(records, wall_seconds),
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("load") != results["load"]:
+            print(f"⚠️  {args.baseline} was measured under a different load: {baseline.get('load')}")
+        results["comparison"] = compare(results, baseline, args.tolerance)
+        regressions = [row["metric"] for row in results["comparison"] if row["regression"]]
+        results["regressions"] = regressions
+        exit_code = 1 if regressions else 0
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results saved to {args.output}")
+    if args.baseline:
+        if results["regressions"]:
+            print(f"❌ Regressions beyond {args.tolerance:.0%}: {', '.join(results['regressions'])}")
+        else:
+            print(f"✅ No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
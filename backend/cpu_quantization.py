@@ -0,0 +1,168 @@
+"""
+Weight-Only Quantization for CPU Serving
+Replaces the Linear layers of a loaded model with int8 or int4 versions that
+keep quantized weights in memory and use PyTorch's CPU packed-weight matmul
+kernels when available
+"""
+
+import logging
+from typing import Iterable
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+HAS_INT8_KERNEL = hasattr(torch.ops.aten, "_weight_int8pack_mm")
+HAS_INT4_KERNEL = hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu") and hasattr(
+    torch.ops.aten, "_convert_weight_to_int4pack_for_cpu"
+)
+
+# The packed-weight kernels are only vectorised for bf16 activations; fp32 inputs
+# take a reference path several times slower than a plain fp32 matmul
+KERNEL_DTYPE = torch.bfloat16
+
+
+class Int8Linear(nn.Module):
+    """Linear layer with symmetric per-output-channel int8 weights"""
+
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+
+        weight = linear.weight.detach().float()
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.register_buffer("weight", torch.round(weight / scales[:, None]).clamp(-128, 127).to(torch.int8))
+        self.register_buffer("scales", scales.to(KERNEL_DTYPE if HAS_INT8_KERNEL else linear.weight.dtype))
+        self.register_buffer("bias", linear.bias.detach().clone() if linear.bias is not None else None)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        x = x.reshape(-1, self.in_features)
+        if HAS_INT8_KERNEL:
+            out = torch.ops.aten._weight_int8pack_mm(
+                x.to(KERNEL_DTYPE), self.weight, self.scales.to(KERNEL_DTYPE)
+            ).to(x.dtype)
+        else:
+            out = F.linear(x, self.weight.to(x.dtype)) * self.scales.to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out.reshape(*shape[:-1], self.out_features)
+
+
+class Int4Linear(nn.Module):
+    """
+    Linear layer with asymmetric group-wise int4 weights
+
+    Each group of `group_size` input weights has its own scale and minimum.
+    Weights are stored in the CPU int4 kernel's packed layout when that
+    kernel exists, and as two nibbles per byte otherwise.
+    """
+
+    def __init__(self, linear: nn.Linear, group_size: int = 128):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.group_size = group_size
+
+        weight = linear.weight.detach().float()
+        groups = weight.reshape(self.out_features, -1, group_size)
+        minimum = groups.amin(dim=-1, keepdim=True)
+        scales = ((groups.amax(dim=-1, keepdim=True) - minimum) / 15).clamp(min=1e-8)
+        q = torch.round((groups - minimum) / scales).clamp(0, 15).to(torch.int32).reshape(self.out_features, -1)
+
+        if HAS_INT4_KERNEL:
+            # The kernel dequantizes as (q - 8) * scale + zero
+            zeros = minimum + 8 * scales
+            scales_and_zeros = torch.cat([scales, zeros], dim=-1).transpose(0, 1).contiguous()
+            self.register_buffer("weight", torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, 1))
+            self.register_buffer("scales_and_zeros", scales_and_zeros.to(KERNEL_DTYPE))
+        else:
+            packed = (q[:, 0::2] | (q[:, 1::2] << 4)).to(torch.uint8)
+            self.register_buffer("weight", packed)
+            self.register_buffer("scales_and_zeros", torch.cat([scales, minimum], dim=-1).to(linear.weight.dtype))
+        self.register_buffer("bias", linear.bias.detach().clone() if linear.bias is not None else None)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        x = x.reshape(-1, self.in_features)
+        if HAS_INT4_KERNEL:
+            out = torch.ops.aten._weight_int4pack_mm_for_cpu(
+                x.to(KERNEL_DTYPE), self.weight, self.group_size, self.scales_and_zeros.to(KERNEL_DTYPE)
+            ).to(x.dtype)
+        else:
+            out = F.linear(x, self._dequantize(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out.reshape(*shape[:-1], self.out_features)
+
+    def _dequantize(self, dtype: torch.dtype) -> torch.Tensor:
+        q = torch.stack([self.weight & 0x0F, self.weight >> 4], dim=-1).reshape(self.out_features, -1, self.group_size)
+        scales, minimum = self.scales_and_zeros.to(dtype).unbind(dim=-1)
+        weight = q.to(dtype) * scales[..., None] + minimum[..., None]
+        return weight.reshape(self.out_features, self.in_features)
+
+
+def merge_lora(model):
+    """Fold LoRA adapters into their base Linear layers so they can be quantized"""
+    if hasattr(model, "merge_and_unload"):
+        logger.info("Merging LoRA adapter into the base weights before quantization")
+        return model.merge_and_unload()
+    return model
+
+
+def quantize_model(model, bits: int = 8, group_size: int = 128, skip: Iterable[str] = (), merge: bool = True):
+    """
+    Replace every Linear layer with a weight-only quantized one, in place
+
+    LoRA adapters are merged first unless `merge` is False, in which case
+    only the base layers under them are quantized and the adapters stay
+    switchable. Tied weights (e.g. an lm_head shared with the embeddings)
+    are left alone, and int4 layers whose input size is not a multiple of
+    `group_size` fall back to int8.
+
+    Args:
+        model: Loaded causal LM (optionally wrapped in a PeftModel)
+        bits: 8 or 4
+        group_size: Input weights sharing one int4 scale
+        skip: Module names to keep in full precision
+        merge: Fold LoRA adapters into the base weights first
+
+    Returns:
+        The quantized model (a new object if a PEFT wrapper was removed)
+    """
+    if bits not in (4, 8):
+        raise ValueError(f"Unsupported weight quantization: int{bits}")
+
+    if merge:
+        model = merge_lora(model)
+    skip = set(skip)
+    embeddings = model.get_input_embeddings()
+    tied = embeddings.weight if embeddings is not None else None
+
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            full_name = f"{name}.{child_name}" if name else child_name
+            if type(child) is not nn.Linear or full_name in skip or child.weight is tied:
+                continue
+            if "lora_" in full_name:
+                # Unmerged adapter weights are small, and PEFT manages them as plain Linear layers
+                continue
+            if bits == 4 and child.in_features % group_size == 0:
+                quantized = Int4Linear(child, group_size)
+            else:
+                quantized = Int8Linear(child)
+            setattr(module, child_name, quantized)
+            replaced += 1
+
+    logger.info(f"Quantized {replaced} Linear layers to int{bits} weights")
+    return model
+
+
+def weight_bytes(model) -> int:
+    """Bytes held by a model's parameters and buffers"""
+    tensors = list(model.parameters()) + [b for b in model.buffers() if b is not None]
+    return sum(t.numel() * t.element_size() for t in tensors)
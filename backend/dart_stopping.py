@@ -0,0 +1,310 @@
+"""
+Structure-Aware Early Stopping for Generated Dart Code
+Tracks brace, bracket, string and comment nesting as tokens decode and ends
+generation once the top-level declarations (or a JSON output object) close
+"""
+
+import bisect
+import re
+from typing import List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+from streaming import IncrementalDetokenizer
+
+_OPENERS = {"{": "}", "(": ")", "[": "]"}
+_CLOSERS = set(_OPENERS.values())
+
+# Lines that can start or continue Dart code at the top level of a file
+_TOP_LEVEL_CODE = re.compile(
+    r"""^(?:
+        (?:import|export|part|library|abstract|base|sealed|final|interface|mixin|class|enum
+          |extension|typedef|const|var|late|void|external|static)\b
+        | @\w
+        | //  | /\*
+        | [{}()\[\]]
+        | [A-Za-z_$][\w$<>?,\s\[\]]*\s+[A-Za-z_$][\w$]*\s*(?:[(=;{<]|=>)
+        | [a-z_$][\w$]*\s*\(
+    )""",
+    re.VERBOSE,
+)
+
+
+def looks_like_code(line: str) -> bool:
+    """Whether a line written at the top level reads as Dart rather than prose or markup"""
+    stripped = line.strip()
+    if stripped.endswith((".", ":", "!", "?")) and not stripped.startswith(("//", "/*", "*")):
+        return False
+    return bool(_TOP_LEVEL_CODE.match(stripped))
+
+
+class DartStructureTracker:
+    """
+    Incremental scanner of Dart (or JSON) nesting
+
+    Text is fed in arbitrary chunks. Strings, string interpolation and
+    comments are skipped so braces inside them do not count. Lines that
+    start at the top level are judged as a whole once complete: prose
+    before the code is ignored, and prose or markup after a closed
+    declaration marks the end of the code. Output starting with '{' or
+    '[' is treated as a JSON object and ends when it closes.
+    """
+
+    def __init__(self):
+        self.json_mode: Optional[bool] = None
+        self.complete = False
+        # Whether a top-level declaration has opened and closed a brace block
+        self.closed_declaration = False
+        # Characters consumed when the code last returned to the top level
+        self.code_end = 0
+
+        self._stack: List[str] = []
+        self._pending = ""
+        self._line = ""
+        self._consumed = 0
+        self._in_line_comment = False
+        self._in_block_comment = False
+        self._escape = False
+        self._recent = ""
+
+    @property
+    def depth(self) -> int:
+        return len(self._stack)
+
+    @property
+    def at_top_level(self) -> bool:
+        return not self._stack and not self._in_block_comment
+
+    def feed(self, text: str) -> bool:
+        """
+        Consume more generated text
+
+        Args:
+            text: Newly decoded text
+
+        Returns:
+            True once the output is structurally complete
+        """
+        if self.complete:
+            return True
+        self._pending += text
+
+        if self.json_mode is None:
+            stripped = self._pending.lstrip()
+            if not stripped:
+                return False
+            self.json_mode = stripped[0] in "{["
+
+        # Two characters of lookahead are needed to recognise triple quotes and comment openers
+        while len(self._pending) > 2 and not self.complete:
+            self._advance()
+        return self.complete
+
+    def _advance(self):
+        if self.at_top_level and not self.json_mode and not self._in_line_comment:
+            self._buffer_line()
+        else:
+            self._consume()
+
+    def _consume(self):
+        ch = self._pending[0]
+        self._pending = self._pending[1:]
+        self._consumed += 1
+        self._recent = (self._recent + ch)[-3:]
+        self._scan(ch)
+        return ch
+
+    def _buffer_line(self):
+        """Collect a top-level line and decide what it is once it ends"""
+        newline = self._pending.find("\n")
+        if newline == -1:
+            self._line += self._pending[:-2]
+            self._pending = self._pending[-2:]
+            return
+
+        line = self._line + self._pending[:newline + 1]
+        self._pending = self._pending[newline + 1:]
+        self._line = ""
+
+        if not line.strip() or not looks_like_code(line):
+            self._consumed += len(line)
+            if line.strip() and self.closed_declaration:
+                self.complete = True
+            return
+
+        # Scan the line as code; a block opened on it keeps streaming afterwards
+        self._pending = line + self._pending
+        while not self.complete and self._consume() != "\n":
+            pass
+        if not self._stack:
+            self.code_end = self._consumed
+
+    def _scan(self, ch: str):
+        top = self._stack[-1] if self._stack else None
+        nxt = self._pending[:2]
+
+        if self._in_line_comment:
+            if ch == "\n":
+                self._in_line_comment = False
+            return
+        if self._in_block_comment:
+            if ch == "*" and nxt[:1] == "/":
+                self._skip(1)
+                self._in_block_comment = False
+            return
+
+        if top is not None and top[0] in "'\"":
+            self._scan_string(ch, top, nxt)
+            return
+
+        if not self.json_mode and ch == "/" and nxt[:1] == "/":
+            self._in_line_comment = True
+            return
+        if not self.json_mode and ch == "/" and nxt[:1] == "*":
+            self._skip(1)
+            self._in_block_comment = True
+            return
+
+        if ch == '"' or (ch == "'" and not self.json_mode):
+            raw = not self.json_mode and self._raw_prefix()
+            if nxt == ch * 2:
+                self._skip(2)
+                self._stack.append(ch * 3 + ("r" if raw else ""))
+            else:
+                self._stack.append(ch + ("r" if raw else ""))
+            return
+
+        if ch in _OPENERS:
+            self._stack.append(ch)
+        elif ch in _CLOSERS:
+            if not self._stack:
+                # Unbalanced closer: whatever follows is not part of the code
+                self.complete = True
+                return
+            opener = self._stack.pop()
+            if not self._stack:
+                self.code_end = self._consumed
+                if opener in ("{", "["):
+                    self.closed_declaration = True
+                    if self.json_mode:
+                        self.complete = True
+
+    def _scan_string(self, ch: str, top: str, nxt: str):
+        quote = top.rstrip("r")
+        raw = top.endswith("r")
+
+        if self._escape:
+            self._escape = False
+            return
+        if not raw and ch == "\\":
+            self._escape = True
+            return
+        if not raw and not self.json_mode and ch == "$" and nxt[:1] == "{":
+            self._skip(1)
+            # Interpolation is code again until its brace closes
+            self._stack.append("{")
+            return
+        if len(quote) == 3:
+            if ch == quote[0] and nxt == quote[:2]:
+                self._skip(2)
+                self._stack.pop()
+        elif ch == quote or ch == "\n":
+            self._stack.pop()
+
+    def _raw_prefix(self) -> bool:
+        """Whether the quote being scanned is preceded by Dart's raw-string marker"""
+        return bool(re.search(r"(?:^|[^\w$])r$", self._recent[:-1]))
+
+    def _skip(self, count: int):
+        self._recent = (self._recent + self._pending[:count])[-3:]
+        self._pending = self._pending[count:]
+        self._consumed += count
+
+
+def structurally_complete(text: str) -> bool:
+    """
+    Fast validity check of finished Dart (or JSON) output
+
+    True when at least one top-level declaration opened and closed a brace
+    block and no bracket, string or comment is left open. No parsing beyond
+    that: syntax errors inside balanced code pass.
+    """
+    tracker = DartStructureTracker()
+    # Trailing newlines flush the tracker's lookahead and the last line
+    tracker.feed(text + "\n\n")
+    return tracker.closed_declaration and tracker.at_top_level
+
+
+class DartCodeStopper:
+    """
+    Early-stopping check for one generated sequence, fed a token at a time
+
+    Works with any decoding loop: call append() for each new token and stop
+    when it returns True, then keep the first `keep_tokens` tokens.
+    """
+
+    def __init__(self, tokenizer):
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.tracker = DartStructureTracker()
+        self.num_tokens = 0
+        self.keep_tokens = 0
+        # Length of the decoded text after each token
+        self._offsets: List[int] = []
+
+    def append(self, token_id: int) -> bool:
+        """
+        Track a generated token
+
+        Args:
+            token_id: Newly generated token
+
+        Returns:
+            True once the code is complete and generation can stop
+        """
+        text = self.detokenizer.add(token_id)
+        self.num_tokens += 1
+        self._offsets.append((self._offsets[-1] if self._offsets else 0) + len(text))
+        if not self.tracker.feed(text):
+            return False
+
+        # Drop the tokens generated after the code ended
+        code_end = self.tracker.code_end
+        self.keep_tokens = bisect.bisect_left(self._offsets, code_end) + 1 if code_end else self.num_tokens
+        return True
+
+    def tokens_saved(self, max_new_tokens: int) -> int:
+        """Tokens not generated because of the early stop"""
+        return max(0, max_new_tokens - self.num_tokens) if self.tracker.complete else 0
+
+
+class DartStoppingCriteria(StoppingCriteria):
+    """Hugging Face stopping criterion applying DartCodeStopper to every row of a batch"""
+
+    def __init__(self, tokenizer, prompt_length: int):
+        """
+        Initialize the criterion
+
+        Args:
+            tokenizer: Tokenizer of the generating model
+            prompt_length: Length of the (padded) prompt, excluded from tracking
+        """
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stoppers: List[DartCodeStopper] = []
+        self._done: List[bool] = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if not self.stoppers:
+            self.stoppers = [DartCodeStopper(self.tokenizer) for _ in range(input_ids.shape[0])]
+            self._done = [False] * input_ids.shape[0]
+
+        for row, stopper in enumerate(self.stoppers):
+            if self._done[row]:
+                continue
+            start = self.prompt_length + stopper.num_tokens
+            for token in input_ids[row, start:].tolist():
+                if stopper.append(token):
+                    self._done[row] = True
+                    break
+        return torch.tensor(self._done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,273 @@
+"""
+LoRA Merge-and-Export Script
+Folds the fine-tuned SFT/DPO adapter into the base weights and saves a
+sharded safetensors artifact with a manifest, so serving needs no PEFT
+wrapper or per-token adapter matmuls
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from typing import Optional
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "merge_manifest.json"
+DEFAULT_MERGED_DIR = "./outputs/merged_model"
+
+DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "float32": torch.float32,
+}
+
+
+def find_adapter_path(outputs_dir: str = "./outputs") -> Optional[str]:
+    """Trained adapter to serve: the DPO model if present, else the SFT model"""
+    for name in ("dpo_model", "sft_model"):
+        path = os.path.join(outputs_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def hash_files(directory: str, predicate) -> str:
+    """sha256 over the names and contents of the files in a directory accepted by `predicate`"""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        if not predicate(name):
+            continue
+        digest.update(name.encode("utf-8"))
+        with open(os.path.join(directory, name), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_adapter(adapter_path: str) -> str:
+    return hash_files(adapter_path, lambda name: name.startswith("adapter_"))
+
+
+def hash_base_model(base_model: str) -> str:
+    """Hash the base model's config and weight files (a local dir or the cached hub snapshot)"""
+    path = base_model
+    if not os.path.isdir(path):
+        from huggingface_hub import snapshot_download
+        path = snapshot_download(base_model, allow_patterns=["config.json", "*.safetensors"])
+    # Hub repos often ship both formats; the safetensors weights are the ones loaded
+    weights = ".safetensors" if any(name.endswith(".safetensors") for name in os.listdir(path)) else ".bin"
+    return hash_files(path, lambda name: name == "config.json" or name.endswith(weights))
+
+
+def load_manifest(model_dir: str) -> Optional[dict]:
+    path = os.path.join(model_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def manifest_fingerprint(manifest: dict) -> str:
+    """Identity of a merged artifact, for cache keys"""
+    fields = [manifest["base_hash"], manifest["adapter_hash"] or "", manifest["dtype"], manifest["quantization"]]
+    return hashlib.sha256("|".join(fields).encode("utf-8")).hexdigest()[:16]
+
+
+def find_merged_model(
+    merged_dir: str = DEFAULT_MERGED_DIR,
+    adapter_path: Optional[str] = None,
+    base_model: Optional[str] = None,
+    dtype: Optional[str] = None,
+) -> Optional[str]:
+    """
+    Locate a merged artifact that is safe to serve instead of base + adapter
+
+    Args:
+        merged_dir: Directory written by this script
+        adapter_path: Adapter that would otherwise be served; the artifact is
+            ignored if it was merged from a different version of it
+        base_model: Base model that would otherwise be served (default: the
+            adapter's base_model_name_or_path); the artifact is ignored if it
+            was merged onto different base weights
+        dtype: Dtype the caller loads the weights in; the artifact is ignored
+            if it was exported in another one (None to accept any)
+
+    Returns:
+        The merged model directory, or None
+    """
+    manifest = load_manifest(merged_dir)
+    if manifest is None:
+        return None
+    if adapter_path and os.path.exists(adapter_path) and hash_adapter(adapter_path) != manifest["adapter_hash"]:
+        logger.warning(f"{merged_dir} was merged from an older adapter than {adapter_path}; re-run export_merged.py")
+        return None
+    if dtype is not None and manifest["dtype"] != dtype:
+        logger.warning(f"{merged_dir} holds {manifest['dtype']} weights, not {dtype}; re-run export_merged.py --dtype {dtype}")
+        return None
+
+    if base_model is None and adapter_path and os.path.exists(os.path.join(adapter_path, "adapter_config.json")):
+        with open(os.path.join(adapter_path, "adapter_config.json")) as f:
+            base_model = json.load(f).get("base_model_name_or_path")
+    if base_model:
+        # Checked last: it reads every base weight file
+        logger.info(f"Verifying that {merged_dir} was merged onto {base_model}...")
+        if hash_base_model(base_model) != manifest["base_hash"]:
+            logger.warning(f"{merged_dir} was merged onto different base weights than {base_model}; re-run export_merged.py")
+            return None
+    return merged_dir
+
+
+def export_merged(
+    base_model: str,
+    adapter_path: Optional[str],
+    output_dir: str = DEFAULT_MERGED_DIR,
+    dtype: str = "float16",
+    max_shard_size: str = "2GB",
+    quantize: str = "none",
+) -> dict:
+    """
+    Merge an adapter into its base model and save the result
+
+    Args:
+        base_model: Hub id or local path of the base model
+        adapter_path: LoRA adapter directory (None exports the base model as is)
+        output_dir: Where to write the artifact
+        dtype: Dtype of the merged weights (float16, bfloat16 or float32)
+        max_shard_size: Maximum size of each safetensors shard
+        quantize: "none", or "8bit"/"4bit" to store bitsandbytes-quantized weights
+
+    Returns:
+        The manifest written next to the weights
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype!r}; choose from {sorted(DTYPES)}")
+    if quantize not in ("none", "8bit", "4bit"):
+        raise ValueError(f"Unsupported quantization {quantize!r}; choose none, 8bit or 4bit")
+
+    print(f"📦 Loading base model {base_model} in {dtype}...")
+    # Training scripts save the tokenizer next to the adapter
+    has_tokenizer = adapter_path and os.path.exists(os.path.join(adapter_path, "tokenizer_config.json"))
+    tokenizer = AutoTokenizer.from_pretrained(adapter_path if has_tokenizer else base_model)
+    # Merge into full-precision weights; folding LoRA into quantized weights would lose the update
+    model = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype=DTYPES[dtype], low_cpu_mem_usage=True)
+
+    if adapter_path:
+        from peft import PeftModel
+        print(f"🔗 Merging adapter from {adapter_path}...")
+        model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+    model.eval()
+
+    # Drop a previous export so no stale shard outlives it
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(output_dir):
+        if name.endswith((".safetensors", ".safetensors.index.json")) or name == MANIFEST_NAME:
+            os.remove(os.path.join(output_dir, name))
+    save_dir = output_dir if quantize == "none" else tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_dir)))
+    model.save_pretrained(save_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    del model
+
+    if quantize != "none":
+        print(f"🗜️  Quantizing merged weights to {quantize}...")
+        quantization_config = BitsAndBytesConfig(
+            load_in_8bit=quantize == "8bit",
+            load_in_4bit=quantize == "4bit",
+            bnb_4bit_compute_dtype=DTYPES[dtype],
+        )
+        quantized = AutoModelForCausalLM.from_pretrained(
+            save_dir,
+            quantization_config=quantization_config,
+            device_map="auto",
+        )
+        quantized.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+    tokenizer.save_pretrained(output_dir)
+
+    print("🔏 Hashing base and adapter weights...")
+    manifest = {
+        "format_version": 1,
+        "base_model": base_model,
+        "base_hash": hash_base_model(base_model),
+        "adapter_path": adapter_path,
+        "adapter_hash": hash_adapter(adapter_path) if adapter_path else None,
+        "dtype": dtype,
+        "quantization": quantize,
+        "shards": sorted(name for name in os.listdir(output_dir) if name.endswith(".safetensors")),
+        "created_at": datetime.now().isoformat(),
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"✅ Merged model saved to {output_dir} ({len(manifest['shards'])} shards)")
+    return manifest
+
+
+def main():
+    """Main execution"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge the fine-tuned LoRA adapter into the base model")
+    parser.add_argument(
+        "--base_model",
+        type=str,
+        default="codellama/CodeLlama-7b-hf",
+        help="Base model the adapter was trained on"
+    )
+    parser.add_argument(
+        "--adapter_path",
+        type=str,
+        default=None,
+        help="Adapter to merge (default: outputs/dpo_model, else outputs/sft_model)"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=DEFAULT_MERGED_DIR,
+        help="Where to write the merged model"
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float16",
+        choices=sorted(DTYPES),
+        help="Dtype of the merged weights"
+    )
+    parser.add_argument(
+        "--max_shard_size",
+        type=str,
+        default="2GB",
+        help="Maximum safetensors shard size"
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default="none",
+        choices=["none", "8bit", "4bit"],
+        help="Store bitsandbytes-quantized weights (needs a GPU)"
+    )
+
+    args = parser.parse_args()
+
+    adapter_path = args.adapter_path or find_adapter_path()
+    if adapter_path is None:
+        print("⚠️  No trained adapter found; exporting the base model only")
+
+    export_merged(
+        args.base_model,
+        adapter_path,
+        output_dir=args.output_dir,
+        dtype=args.dtype,
+        max_shard_size=args.max_shard_size,
+        quantize=args.quantize,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,928 @@
+"""
+Continuous Batching Engine for Flutter Code Generation
+Runs in-flight requests through shared decode batches on a dedicated thread
+"""
+
+import contextlib
+import functools
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+from dart_stopping import DartCodeStopper
+
+logger = logging.getLogger(__name__)
+
+
+# KV cache helpers
+def cache_to_layers(past_key_values) -> List[tuple]:
+    """Return the (key, value) tensors of every layer, shaped [batch, heads, seq, head_dim]"""
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "key_cache"):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [(layer[0], layer[1]) for layer in past_key_values]
+
+
+def layers_to_cache(layers: List[tuple]) -> DynamicCache:
+    """Build a DynamicCache from per-layer (key, value) tensors"""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(layers)
+
+
+def left_pad_layers(layers: List[tuple], length: int) -> List[tuple]:
+    """Left-pad every key/value tensor along the sequence axis up to `length`"""
+    current = layers[0][0].shape[-2]
+    if current >= length:
+        return layers
+    padded = []
+    for key, value in layers:
+        pad_shape = list(key.shape)
+        pad_shape[-2] = length - current
+        pad = key.new_zeros(pad_shape)
+        padded.append((torch.cat([pad, key], dim=-2), torch.cat([pad, value], dim=-2)))
+    return padded
+
+
+def nucleus_probs(logits: torch.Tensor, temperatures: torch.Tensor, top_ps: torch.Tensor) -> torch.Tensor:
+    """
+    Next-token distributions after per-row temperature scaling and nucleus filtering
+
+    Args:
+        logits: [batch, vocab] next-token logits
+        temperatures: [batch] temperatures (must be > 0)
+        top_ps: [batch] nucleus probabilities
+
+    Returns:
+        [batch, vocab] probabilities
+    """
+    scaled = logits.float() / temperatures.clamp(min=1e-5).unsqueeze(-1)
+
+    sorted_logits, sorted_indices = torch.sort(scaled, descending=True, dim=-1)
+    sorted_probs = torch.softmax(sorted_logits, dim=-1)
+    cumulative = torch.cumsum(sorted_probs, dim=-1)
+    # Drop tokens once the mass before them already exceeds top_p (always keeps the best one)
+    remove = (cumulative - sorted_probs) > top_ps.unsqueeze(-1)
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    filtered = torch.full_like(scaled, float("-inf")).scatter(-1, sorted_indices, sorted_logits)
+    return torch.softmax(filtered, dim=-1)
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    temperatures: torch.Tensor,
+    top_ps: torch.Tensor,
+    generators: Optional[List[Optional[torch.Generator]]] = None,
+) -> torch.Tensor:
+    """
+    Sample one token per row with per-row temperature and nucleus settings
+
+    Args:
+        logits: [batch, vocab] next-token logits
+        temperatures: [batch] temperatures; rows <= 0 decode greedily
+        top_ps: [batch] nucleus probabilities
+        generators: Optional per-row random generators for seeded rows
+
+    Returns:
+        [batch] sampled token ids
+    """
+    greedy = temperatures <= 0
+    probs = nucleus_probs(logits, temperatures, top_ps)
+    sampled = torch.multinomial(probs, num_samples=1).squeeze(-1)
+    if generators is not None:
+        for row, generator in enumerate(generators):
+            if generator is not None:
+                sampled[row] = torch.multinomial(probs[row], num_samples=1, generator=generator)[0]
+    return torch.where(greedy, logits.argmax(dim=-1), sampled)
+
+
+def token_logprobs(logits: torch.Tensor, tokens: torch.Tensor) -> torch.Tensor:
+    """
+    Log-probability of each chosen token under the model's own distribution
+
+    Temperature and nucleus filtering are not applied, so sequences sampled
+    with different settings are scored on the same scale.
+
+    Args:
+        logits: [batch, vocab] next-token logits
+        tokens: [batch] chosen token ids
+
+    Returns:
+        [batch] log-probabilities
+    """
+    return torch.log_softmax(logits.float(), dim=-1).gather(-1, tokens.view(-1, 1)).squeeze(-1)
+
+
+def score_continuations(
+    scheduler,
+    prompt_ids: List[int],
+    continuations: List[List[int]],
+    adapter: Optional[str] = None,
+) -> List[List[float]]:
+    """
+    Log-probability of every token of each continuation of a prompt, without generating
+
+    Runs on the scheduler thread through call() or call_one(). The prompt
+    is prefilled once (from the prefix cache where possible); its KV cache
+    is then broadcast to right-padded rows of continuations, up to
+    max_batch_size rows per forward pass.
+
+    Args:
+        scheduler: ContinuousBatchScheduler whose model scores the text
+        prompt_ids: Tokenized prompt
+        continuations: Tokenized continuations
+        adapter: LoRA adapter to score with (None = the registry's default)
+
+    Returns:
+        Per continuation, the log-probability of each of its tokens given the prompt and the tokens before it
+    """
+    rows = contextlib.nullcontext
+    if scheduler.adapters is not None:
+        adapter = scheduler.adapters.resolve(adapter)
+        rows = lambda count: scheduler.adapters.rows([adapter] * count)  # noqa: E731
+
+    cached, past_key_values = 0, None
+    hit = scheduler.prefix_cache.lookup(prompt_ids, namespace=adapter or "") if scheduler.prefix_cache is not None else None
+    if hit is not None and hit[0] < len(prompt_ids):
+        cached, prefix_layers = hit
+        past_key_values = layers_to_cache(prefix_layers)
+
+    input_ids = torch.tensor([prompt_ids[cached:]], dtype=torch.long, device=scheduler.device)
+    with rows(1), torch.profiler.record_function("score_prefill"):
+        outputs = scheduler.model(
+            input_ids=input_ids,
+            position_ids=torch.arange(cached, len(prompt_ids), device=scheduler.device).unsqueeze(0),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+    # Distribution of each continuation's first token
+    first = torch.log_softmax(outputs.logits[0, -1].float(), dim=-1)
+    prompt_layers = cache_to_layers(outputs.past_key_values)
+
+    scores: List[List[float]] = [[] for _ in continuations]
+    pending = [index for index, ids in enumerate(continuations) if ids]
+    for start in range(0, len(pending), scheduler.max_batch_size):
+        chunk = pending[start:start + scheduler.max_batch_size]
+        length = max(len(continuations[index]) for index in chunk)
+        input_ids = torch.full((len(chunk), length), scheduler.pad_token_id, dtype=torch.long, device=scheduler.device)
+        continuation_mask = torch.zeros_like(input_ids)
+        for row, index in enumerate(chunk):
+            ids = continuations[index]
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            continuation_mask[row, :len(ids)] = 1
+
+        # Right padding: pad positions come after every real token, so they cannot affect them
+        attention_mask = torch.cat([continuation_mask.new_ones((len(chunk), len(prompt_ids))), continuation_mask], dim=1)
+        position_ids = len(prompt_ids) + torch.arange(length, device=scheduler.device).expand(len(chunk), -1)
+        layers = [(k.expand(len(chunk), -1, -1, -1), v.expand(len(chunk), -1, -1, -1)) for k, v in prompt_layers]
+        with rows(len(chunk)), torch.profiler.record_function("score_continuations"):
+            logits = scheduler.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=layers_to_cache(layers),
+                use_cache=True,
+            ).logits
+
+        # Position j predicts token j + 1; the prompt's last position predicts token 0
+        logprobs = torch.log_softmax(logits[:, :-1].float(), dim=-1).gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+        heads = first.gather(0, input_ids[:, 0])
+        for row, index in enumerate(chunk):
+            count = len(continuations[index])
+            scores[index] = [heads[row].item()] + logprobs[row, :count - 1].tolist()
+    return scores
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the scheduler's waiting queue has no room for a request"""
+
+
+@dataclass
+class SamplingParams:
+    """Per-sequence decoding settings"""
+    temperature: float = 0.7
+    top_p: float = 0.95
+    max_new_tokens: int = 512
+    seed: Optional[int] = None
+    # Draft from n-grams of the context instead of the draft model (for edits of the prompt)
+    prompt_lookup: bool = False
+    # Stop once the generated Dart code (or JSON object) is structurally complete
+    stop_at_structure: bool = False
+    # LoRA adapter to decode with (None = the registry's default)
+    adapter: Optional[str] = None
+
+
+@dataclass
+class PruningPolicy:
+    """
+    Early pruning of the weakest samples of a group
+
+    Every `interval_tokens` tokens of its own, a still-running sample is
+    compared with the rest of its group by mean token log-probability so
+    far (samples of a group split across batches reach their checkpoints
+    at different steps). Samples more than `margin` below
+    the group's leader, or below the `percentile` of the running samples,
+    are stopped with finish_reason "pruned". The lowest-scoring samples go
+    first, and at least `min_keep` samples that were not pruned are left.
+    """
+    min_keep: int
+    interval_tokens: int = 32
+    # Mean log-probability (nats per token) a sample may trail the leader by
+    margin: Optional[float] = 1.0
+    # Fraction of the running samples' scores below which samples are pruned
+    percentile: Optional[float] = None
+
+
+def select_pruned(
+    group: List["GenerationSequence"],
+    policy: PruningPolicy,
+    candidates: Optional[List["GenerationSequence"]] = None,
+) -> List["GenerationSequence"]:
+    """
+    Samples of a group to prune at a checkpoint
+
+    Args:
+        group: Every sequence submitted together, finished or not
+        policy: The group's pruning policy
+        candidates: Sequences at a checkpoint, the only ones that may be pruned (default: all running)
+
+    Returns:
+        Running sequences to stop, weakest first
+    """
+    survivors = [seq for seq in group if seq.finish_reason not in ("pruned", "cancelled") and seq.output_logprobs]
+    running = [seq for seq in survivors if seq.finish_reason is None]
+    budget = len(survivors) - policy.min_keep
+    if budget <= 0 or len(running) < 2:
+        return []
+
+    scores = {seq.seq_id: sum(seq.output_logprobs) / len(seq.output_logprobs) for seq in survivors}
+    running.sort(key=lambda seq: scores[seq.seq_id])
+    leader = max(scores.values())
+    cutoff = float("-inf")
+    if policy.percentile is not None:
+        cutoff = scores[running[int(policy.percentile * (len(running) - 1))].seq_id]
+
+    eligible = None if candidates is None else {seq.seq_id for seq in candidates}
+    pruned = []
+    for seq in running[:budget]:
+        if eligible is not None and seq.seq_id not in eligible:
+            continue
+        score = scores[seq.seq_id]
+        if (policy.margin is not None and score < leader - policy.margin) or score < cutoff:
+            pruned.append(seq)
+    return pruned
+
+
+@dataclass
+class GenerationResult:
+    """Tokens produced for one sequence"""
+    token_ids: List[int]
+    finish_reason: str
+    tokens_saved: int = 0
+    # Prompt tokens served from the prefix cache instead of being prefilled
+    cached_tokens: int = 0
+    # Waiting for a batch slot, then prefilling up to the first token, then decoding the rest
+    queue_seconds: float = 0.0
+    prefill_seconds: float = 0.0
+    decode_seconds: float = 0.0
+    # Log-probability of each token of token_ids (see token_logprobs())
+    token_logprobs: List[float] = field(default_factory=list)
+
+    @property
+    def mean_logprob(self) -> float:
+        """Mean per-token log-probability; -inf for an empty generation"""
+        if not self.token_logprobs:
+            return float("-inf")
+        return sum(self.token_logprobs) / len(self.token_logprobs)
+
+
+@dataclass
+class GenerationSequence:
+    """A sequence waiting for, or taking part in, batched decoding"""
+    seq_id: int
+    prompt_ids: List[int]
+    params: SamplingParams
+    future: Future = field(default_factory=Future)
+    on_token: Optional[Callable[[int], None]] = None
+    generator: Optional[torch.Generator] = None
+    output_ids: List[int] = field(default_factory=list)
+    output_logprobs: List[float] = field(default_factory=list)
+    finish_reason: Optional[str] = None
+    stopper: Optional[DartCodeStopper] = None
+    # Sequences submitted together (shared list) and how to prune them
+    group: Optional[List["GenerationSequence"]] = field(default=None, repr=False, compare=False)
+    pruning: Optional[PruningPolicy] = None
+    cached_tokens: int = 0
+    # time.monotonic() timestamps
+    submitted_at: float = field(default_factory=time.monotonic)
+    prefill_started_at: Optional[float] = None
+    first_token_at: Optional[float] = None
+
+
+class ContinuousBatchScheduler:
+    """
+    Decodes sequences from many requests together
+
+    New sequences are prefilled and merged into the running batch between
+    decode steps; finished ones are dropped and their futures resolved, so
+    the batch never waits for its slowest member. With an adapter registry,
+    each row decodes with its own adapter under mixed-adapter batching;
+    otherwise a batch runs one adapter at a time and a group asking for
+    another adapter waits at the head of the queue until the batch drains.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: str,
+        max_batch_size: int = 8,
+        max_queue_size: int = 64,
+        idle_wait_seconds: float = 0.05,
+        prefix_cache=None,
+        speculative=None,
+        prompt_lookup=None,
+        prefill_buckets: Optional[List[int]] = None,
+        adapters=None,
+    ):
+        """
+        Initialize the scheduler
+
+        Args:
+            model: Causal LM used for decoding
+            tokenizer: Tokenizer matching the model (for the EOS id)
+            device: Device the inputs are placed on
+            max_batch_size: Maximum number of sequences decoded together
+            max_queue_size: Maximum number of sequences waiting for a batch slot
+            idle_wait_seconds: Sleep interval when there is no work
+            prefix_cache: Optional PrefixCache with precomputed preamble KV states
+            speculative: Optional SpeculativeDecoder used while a single sequence is active
+            prompt_lookup: Optional prompt-lookup SpeculativeDecoder for sequences that request it
+            prefill_buckets: Lengths prompts are left-padded to before prefill, so a compiled
+                model sees a few input shapes instead of one per prompt length
+            adapters: Optional AdapterRegistry of the LoRA adapters sequences can select
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.idle_wait_seconds = idle_wait_seconds
+        self.prefix_cache = prefix_cache
+        self.speculative = speculative
+        self.prompt_lookup = prompt_lookup
+        self.prefill_buckets = sorted(prefill_buckets or [])
+        self.adapters = adapters
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.eos_token_id = tokenizer.eos_token_id
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Sequences are queued in groups sharing one prompt, so the prompt is prefilled once
+        self._waiting: Deque[List[GenerationSequence]] = deque()
+        self._num_waiting = 0
+        # Functions to run on the scheduler thread between decode steps
+        self._calls: Deque[Tuple[Callable[[Any], Any], Future]] = deque()
+
+        # Running batch state, owned by the scheduler thread
+        self._active: List[GenerationSequence] = []
+        self._cache_layers: Optional[List[tuple]] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+
+    @property
+    def num_waiting(self) -> int:
+        return self._num_waiting
+
+    @property
+    def num_active(self) -> int:
+        return len(self._active)
+
+    def start(self):
+        """Start the decode loop on a background thread"""
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the decode loop and fail anything still pending"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        error = RuntimeError("Scheduler stopped")
+        with self._lock:
+            pending = [seq for group in self._waiting for seq in group] + self._active
+            self._waiting.clear()
+            self._num_waiting = 0
+            calls = list(self._calls)
+            self._calls.clear()
+        self._reset_batch()
+        for seq in pending:
+            if not seq.future.done():
+                seq.future.set_exception(error)
+        for _, future in calls:
+            if not future.done():
+                future.set_exception(error)
+
+    def call(self, fn: Callable[[Any], Any]) -> Future:
+        """
+        Run a function on the scheduler thread between decode steps
+
+        Used for changes to the model (such as attaching an adapter) that
+        must not overlap a forward pass.
+
+        Args:
+            fn: Called with this scheduler
+
+        Returns:
+            Future resolving to fn's return value
+        """
+        future = Future()
+        with self._lock:
+            if self._stopping.is_set():
+                raise RuntimeError("Scheduler stopped")
+            self._calls.append((fn, future))
+        self._wakeup.set()
+        return future
+
+    def call_one(self, fn: Callable[[Any], Any]) -> Future:
+        """Run a function on the scheduler thread; the counterpart of ModelWorkerPool.call_one"""
+        return self.call(fn)
+
+    def uses_adapter(self, name: str) -> bool:
+        """Whether queued or running sequences decode with an adapter"""
+        with self._lock:
+            waiting = [seq for group in self._waiting for seq in group]
+        return any(seq.params.adapter == name and not seq.future.done() for seq in waiting + self._active)
+
+    def usage(self) -> dict:
+        """
+        Sequences per adapter and the running batch's KV cache size
+
+        Reads the batch state, so run it through call().
+
+        Returns:
+            {"active": {adapter: n}, "waiting": {adapter: n}, "kv_cache_bytes": n}
+        """
+        with self._lock:
+            waiting = [seq for group in self._waiting for seq in group]
+        active_counts, waiting_counts = {}, {}
+        for seq in self._active:
+            active_counts[seq.params.adapter] = active_counts.get(seq.params.adapter, 0) + 1
+        for seq in waiting:
+            waiting_counts[seq.params.adapter] = waiting_counts.get(seq.params.adapter, 0) + 1
+
+        # Prefilled rows broadcast one prompt cache, so count each storage once
+        storages = {}
+        for k, v in self._cache_layers or []:
+            for tensor in (k, v):
+                storage = tensor.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+        return {"active": active_counts, "waiting": waiting_counts, "kv_cache_bytes": sum(storages.values())}
+
+    def submit(self, prompt_ids: List[int], params: SamplingParams) -> Future:
+        """
+        Queue a prompt for generation
+
+        Args:
+            prompt_ids: Tokenized prompt
+            params: Sampling settings for this sequence
+
+        Returns:
+            Future resolving to a GenerationResult
+
+        Raises:
+            QueueFullError: If the waiting queue is full
+        """
+        return self.submit_many(prompt_ids, [params])[0]
+
+    def submit_many(
+        self,
+        prompt_ids: List[int],
+        params_list: List[SamplingParams],
+        on_token: Optional[Callable[[int, int], None]] = None,
+        pruning: Optional[PruningPolicy] = None,
+    ) -> List[Future]:
+        """
+        Queue several samples of one prompt, all or nothing
+
+        Args:
+            prompt_ids: Tokenized prompt
+            params_list: Sampling settings, one entry per sequence
+            on_token: Optional callback receiving (sequence index, token id) for
+                every decoded token; it runs on the scheduler thread
+            pruning: Optional policy for stopping the group's weakest samples early
+
+        Returns:
+            Futures resolving to GenerationResults, in the order of params_list
+
+        Raises:
+            QueueFullError: If the waiting queue cannot hold every sequence
+            KeyError: If the requested adapter is not attached
+        """
+        params_list = self._resolve_adapter(params_list)
+        with self._lock:
+            if self._stopping.is_set():
+                raise RuntimeError("Scheduler stopped")
+            if self._num_waiting + len(params_list) > self.max_queue_size:
+                raise QueueFullError(
+                    f"Generation queue is full ({self._num_waiting}/{self.max_queue_size} waiting)"
+                )
+            seqs = [
+                GenerationSequence(
+                    seq_id=next(self._ids),
+                    prompt_ids=list(prompt_ids),
+                    params=params,
+                    on_token=functools.partial(on_token, index) if on_token is not None else None,
+                    stopper=DartCodeStopper(self.tokenizer) if params.stop_at_structure else None,
+                    pruning=pruning,
+                )
+                for index, params in enumerate(params_list)
+            ]
+            for seq in seqs:
+                seq.group = seqs
+            self._waiting.append(seqs)
+            self._num_waiting += len(seqs)
+        self._wakeup.set()
+        return [seq.future for seq in seqs]
+
+    def _resolve_adapter(self, params_list: List[SamplingParams]) -> List[SamplingParams]:
+        """Pin a group's sequences to one concrete adapter"""
+        if self.adapters is None:
+            return params_list
+        adapters = {params.adapter for params in params_list}
+        if len(adapters) > 1:
+            raise ValueError("All sequences of a group must use the same adapter")
+        adapter = self.adapters.resolve(adapters.pop())
+        return [replace(params, adapter=adapter) for params in params_list]
+
+    def _can_join(self, seq: GenerationSequence) -> bool:
+        """Whether a sequence's adapter lets it join the running batch"""
+        if self.adapters is None or self.adapters.mixed_batching:
+            return True
+        return seq.params.adapter == self._active[0].params.adapter
+
+    def _adapter_rows(self, seqs: List[GenerationSequence]):
+        """Context routing each row of the next forward pass through its sequence's adapter"""
+        if self.adapters is None:
+            return contextlib.nullcontext()
+        return self.adapters.rows([seq.params.adapter for seq in seqs])
+
+    # Scheduler thread
+    def _run(self):
+        with torch.inference_mode():
+            while not self._stopping.is_set():
+                self._run_calls()
+                self._admit_waiting()
+
+                if not self._active:
+                    self._wakeup.wait(self.idle_wait_seconds)
+                    self._wakeup.clear()
+                    continue
+
+                try:
+                    self._step()
+                except Exception as e:
+                    logger.error(f"Decode step failed: {e}")
+                    failed = self._active
+                    self._reset_batch()
+                    for seq in failed:
+                        if not seq.future.done():
+                            seq.future.set_exception(e)
+
+    def _run_calls(self):
+        while True:
+            with self._lock:
+                if not self._calls:
+                    return
+                fn, future = self._calls.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(self))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _admit_waiting(self):
+        """Prefill waiting groups into free batch slots, in arrival order"""
+        while True:
+            free = self.max_batch_size - len(self._active)
+            with self._lock:
+                if not self._waiting or free <= 0:
+                    return
+                group = [seq for seq in self._waiting[0] if not seq.future.cancelled()]
+                self._num_waiting -= len(self._waiting[0]) - len(group)
+
+                if group and self._active and not self._can_join(group[0]):
+                    # Another adapter: let the running batch drain first
+                    self._waiting[0] = group
+                    return
+                if len(group) > free and self._active:
+                    # Keep the group together until enough rows finish
+                    self._waiting[0] = group
+                    return
+                if len(group) > free:
+                    self._waiting[0] = group[free:]
+                    group = group[:free]
+                else:
+                    self._waiting.popleft()
+                self._num_waiting -= len(group)
+
+            if not group:
+                continue
+
+            try:
+                self._prefill(group)
+            except Exception as e:
+                logger.error(f"Prefill failed for sequences {[seq.seq_id for seq in group]}: {e}")
+                for seq in group:
+                    if not seq.future.done():
+                        seq.future.set_exception(e)
+
+    def _prefill(self, seqs: List[GenerationSequence]):
+        """
+        Prefill a shared prompt once and fan it out to every sequence of the group
+
+        Each row samples its first token from the same logits with its own
+        temperature, and the prompt's KV cache is broadcast across the rows.
+        """
+        prompt_ids = seqs[0].prompt_ids
+        adapter = seqs[0].params.adapter
+        started = time.monotonic()
+
+        # Only prefill what the preamble cache does not already cover
+        cached, past_key_values = 0, None
+        hit = self.prefix_cache.lookup(prompt_ids, namespace=adapter or "") if self.prefix_cache is not None else None
+        if hit is not None:
+            cached, prefix_layers = hit
+            past_key_values = layers_to_cache(prefix_layers)
+
+        suffix = prompt_ids[cached:]
+        padding = self._bucket_length(len(suffix)) - len(suffix)
+        input_ids = torch.tensor([[self.pad_token_id] * padding + suffix], dtype=torch.long, device=self.device)
+        suffix_mask = torch.ones_like(input_ids)
+        suffix_mask[:, :padding] = 0
+        attention_mask = torch.cat([suffix_mask.new_ones((1, cached)), suffix_mask], dim=1)
+        position_ids = (cached + suffix_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        with self._adapter_rows(seqs[:1]), torch.profiler.record_function("prefill"):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+
+        logits = outputs.logits[:, -1, :].expand(len(seqs), -1)
+        first_tokens = self._sample(seqs, logits)
+        first_logprobs = token_logprobs(logits, first_tokens).tolist()
+        first_token_at = time.monotonic()
+        for seq in seqs:
+            seq.cached_tokens = cached
+            seq.prefill_started_at = started
+            seq.first_token_at = first_token_at
+
+        keep = []
+        for row, (seq, token, logprob) in enumerate(zip(seqs, first_tokens.tolist(), first_logprobs)):
+            if self._append_token(seq, token, logprob):
+                self._finish(seq)
+            else:
+                keep.append(row)
+        if not keep:
+            return
+
+        rows = len(keep)
+        layers = [
+            (k.expand(rows, -1, -1, -1), v.expand(rows, -1, -1, -1))
+            for k, v in cache_to_layers(outputs.past_key_values)
+        ]
+        self._merge_into_batch(
+            [seqs[row] for row in keep],
+            layers,
+            attention_mask.expand(rows, -1),
+            first_tokens[keep].view(-1, 1),
+        )
+
+    def _bucket_length(self, length: int) -> int:
+        """Smallest prefill bucket that fits a prompt (the prompt's own length if none does)"""
+        for bucket in self.prefill_buckets:
+            if bucket >= length:
+                return bucket
+        return length
+
+    def _merge_into_batch(self, seqs, layers, attention_mask, next_tokens):
+        """Append freshly prefilled rows to the running batch, left-padding whichever side is shorter"""
+        if not self._active:
+            self._active = list(seqs)
+            self._cache_layers = layers
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens
+            return
+
+        length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+        current = left_pad_layers(self._cache_layers, length)
+        incoming = left_pad_layers(layers, length)
+
+        self._cache_layers = [
+            (torch.cat([ck, nk], dim=0), torch.cat([cv, nv], dim=0))
+            for (ck, cv), (nk, nv) in zip(current, incoming)
+        ]
+        self._attention_mask = torch.cat([
+            self._left_pad_mask(self._attention_mask, length),
+            self._left_pad_mask(attention_mask, length),
+        ], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens], dim=0)
+        self._active.extend(seqs)
+
+    @staticmethod
+    def _left_pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+        if mask.shape[1] >= length:
+            return mask
+        pad = mask.new_zeros((mask.shape[0], length - mask.shape[1]))
+        return torch.cat([pad, mask], dim=1)
+
+    def _step(self):
+        """Decode one token for every active sequence"""
+        decoder = self._decoder_for(self._active[0]) if len(self._active) == 1 else None
+        if decoder is not None:
+            # Alone in the batch, the model is idle enough to verify drafted tokens
+            self._speculative_step(decoder)
+            return
+
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True)
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones((len(self._active), 1))], dim=1)
+
+        with self._adapter_rows(self._active), torch.profiler.record_function("decode_step"):
+            outputs = self.model(
+                input_ids=self._next_tokens,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=layers_to_cache(self._cache_layers),
+                use_cache=True,
+            )
+        self._cache_layers = cache_to_layers(outputs.past_key_values)
+        self._attention_mask = attention_mask
+
+        logits = outputs.logits[:, -1, :]
+        tokens = self._sample(self._active, logits)
+        logprobs = token_logprobs(logits, tokens).tolist()
+        keep = []
+        for row, (seq, token, logprob) in enumerate(zip(self._active, tokens.tolist(), logprobs)):
+            if self._append_token(seq, token, logprob):
+                self._finish(seq)
+            else:
+                keep.append(row)
+        keep = self._prune(keep)
+
+        self._next_tokens = tokens.view(-1, 1)
+        if len(keep) < len(self._active):
+            self._select_rows(keep)
+
+    def _prune(self, keep: List[int]) -> List[int]:
+        """Stop the weakest samples of groups at a pruning checkpoint and return the rows left"""
+        # A group split across batches is not in lockstep, so each sample's own length decides its checkpoints
+        due: Dict[int, List[GenerationSequence]] = {}
+        for row in keep:
+            seq = self._active[row]
+            if seq.pruning is not None and len(seq.output_ids) % seq.pruning.interval_tokens == 0:
+                due.setdefault(id(seq.group), []).append(seq)
+        pruned = set()
+        for candidates in due.values():
+            group = candidates[0].group
+            for victim in select_pruned(group, candidates[0].pruning, candidates):
+                victim.finish_reason = "pruned"
+                self._finish(victim)
+                pruned.add(victim.seq_id)
+        if not pruned:
+            return keep
+        return [row for row in keep if self._active[row].seq_id not in pruned]
+
+    def _decoder_for(self, seq: GenerationSequence):
+        """Speculative decoder a sequence runs with, if any"""
+        if seq.params.prompt_lookup and self.prompt_lookup is not None:
+            return self.prompt_lookup
+        return self.speculative
+
+    def _speculative_step(self, decoder):
+        """Draft several tokens for the only active sequence and verify them in one pass"""
+        seq = self._active[0]
+        with self._adapter_rows([seq]), torch.profiler.record_function("speculative_step"):
+            tokens, logprobs, self._cache_layers, self._attention_mask = decoder.step(
+                self.model,
+                self._cache_layers,
+                self._attention_mask,
+                seq.prompt_ids + seq.output_ids,
+                seq.params,
+                self._generator(seq, self._attention_mask.device),
+                key=seq.seq_id,
+            )
+        for token, logprob in zip(tokens, logprobs):
+            if self._append_token(seq, token, logprob):
+                self._finish(seq)
+                self._reset_batch()
+                return
+        self._next_tokens = torch.tensor([[tokens[-1]]], dtype=torch.long, device=self._attention_mask.device)
+
+    def _generator(self, seq: GenerationSequence, device) -> Optional[torch.Generator]:
+        """Per-sequence random generator for seeded sampling"""
+        if seq.params.seed is not None and seq.generator is None:
+            seq.generator = torch.Generator(device=device).manual_seed(seq.params.seed)
+        return seq.generator
+
+    def _sample(self, seqs: List[GenerationSequence], logits: torch.Tensor) -> torch.Tensor:
+        temperatures = torch.tensor([s.params.temperature for s in seqs], device=logits.device)
+        top_ps = torch.tensor([s.params.top_p for s in seqs], device=logits.device)
+
+        generators = [self._generator(s, logits.device) for s in seqs]
+        if not any(g is not None for g in generators):
+            generators = None
+
+        return sample_next_tokens(logits, temperatures, top_ps, generators)
+
+    def _append_token(self, seq: GenerationSequence, token: int, logprob: float) -> bool:
+        """Record a decoded token and its log-probability, and return True once the sequence is done"""
+        if seq.future.cancelled():
+            seq.finish_reason = "cancelled"
+            return True
+        if token == self.eos_token_id:
+            seq.finish_reason = "eos"
+            return True
+        seq.output_ids.append(token)
+        seq.output_logprobs.append(logprob)
+        if seq.on_token is not None:
+            try:
+                seq.on_token(token)
+            except Exception as e:
+                logger.warning(f"Token callback failed for sequence {seq.seq_id}: {e}")
+        if seq.stopper is not None and seq.stopper.append(token):
+            del seq.output_ids[seq.stopper.keep_tokens:]
+            del seq.output_logprobs[seq.stopper.keep_tokens:]
+            seq.finish_reason = "structure"
+            return True
+        if len(seq.output_ids) >= seq.params.max_new_tokens:
+            seq.finish_reason = "length"
+            return True
+        return False
+
+    def _finish(self, seq: GenerationSequence):
+        decoder = self._decoder_for(seq)
+        if decoder is not None:
+            decoder.release(seq.seq_id)
+        tokens_saved = 0
+        if seq.finish_reason == "pruned":
+            tokens_saved = max(0, seq.params.max_new_tokens - len(seq.output_ids))
+        elif seq.stopper is not None:
+            tokens_saved = seq.stopper.tokens_saved(seq.params.max_new_tokens)
+        if not seq.future.done():
+            seq.future.set_result(GenerationResult(
+                token_ids=seq.output_ids,
+                finish_reason=seq.finish_reason,
+                tokens_saved=tokens_saved,
+                cached_tokens=seq.cached_tokens,
+                queue_seconds=seq.prefill_started_at - seq.submitted_at,
+                prefill_seconds=seq.first_token_at - seq.prefill_started_at,
+                decode_seconds=time.monotonic() - seq.first_token_at,
+                token_logprobs=seq.output_logprobs,
+            ))
+
+    def _select_rows(self, keep: List[int]):
+        """Drop finished rows from the batch and trim padding no remaining row needs"""
+        if not keep:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self._attention_mask.device)
+        mask = self._attention_mask.index_select(0, index)
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+
+        self._active = [self._active[i] for i in keep]
+        self._attention_mask = mask[:, start:]
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._cache_layers = [
+            (k.index_select(0, index.to(k.device))[:, :, start:], v.index_select(0, index.to(v.device))[:, :, start:])
+            for k, v in self._cache_layers
+        ]
+
+    def _reset_batch(self):
+        self._active = []
+        self._cache_layers = None
+        self._attention_mask = None
+        self._next_tokens = None
@@ -4,20 +4,75 @@ Test your SFT or DPO models on Flutter code generation tasks
 """
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
-from typing import Optional
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig, StoppingCriteria, StoppingCriteriaList
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
 import json
+import os
+
+from dart_stopping import DartCodeStopper, DartStoppingCriteria
+from export_merged import DEFAULT_MERGED_DIR, find_merged_model
+from generation_engine import SamplingParams, layers_to_cache
+from prefix_cache import PrefixCache
+from speculative import DraftModelProposer, SpeculativeDecoder, speculative_generate, vocabularies_match
+
+
+# Fixed start of every prompt built by generate_code with the default settings
+TASK_PREAMBLE = """### Task: Flutter Application Development
+
+**Framework**: Flutter 3.0+
+**Architecture**: Clean Architecture
+
+**Instruction**:"""
+
+
+class StepLimitCriteria(StoppingCriteria):
+    """
+    Stop after a fixed number of new tokens
+
+    Unlike max_new_tokens it leaves max_length alone, and with it the size
+    of the static KV cache generate() allocates.
+    """
+
+    def __init__(self, prompt_length: int, steps: int):
+        self.limit = prompt_length + steps
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), input_ids.shape[1] >= self.limit, dtype=torch.bool, device=input_ids.device)
 
 
 class FlutterCodeGenerator:
-    def __init__(self, model_path: str, device: str = "auto"):
+    def __init__(
+        self,
+        model_path: str,
+        device: str = "auto",
+        use_prefix_cache: bool = True,
+        draft_model_path: Optional[str] = None,
+        num_draft_tokens: int = 4,
+        compile: bool = False,
+        prompt_buckets: Tuple[int, ...] = (128, 256, 512),
+        merged_model_dir: Optional[str] = DEFAULT_MERGED_DIR,
+    ):
         """
         Initialize the code generator
         
         Args:
             model_path: Path to fine-tuned model (e.g., ./outputs/dpo_model)
             device: Device to run on (auto, cuda, cpu)
+            use_prefix_cache: Precompute the KV states of the fixed prompt preamble
+            draft_model_path: Small model sharing the tokenizer, used for speculative decoding
+            num_draft_tokens: Tokens the draft model proposes per verification step
+            compile: Use torch.compile with a static KV cache and warm it up for every prompt bucket
+            prompt_buckets: Lengths prompts are left-padded to in compiled mode
+            merged_model_dir: export_merged.py artifact used instead of model_path when it
+                was merged from the same adapter (None to always load model_path)
         """
+        if merged_model_dir and os.path.exists(os.path.join(model_path, "adapter_config.json")):
+            merged_path = find_merged_model(merged_model_dir, model_path, dtype="bfloat16")
+            if merged_path:
+                print(f"✓ Using merged model {merged_path} (merged from {model_path})")
+                model_path = merged_path
+        
         print(f"🔧 Loading model from: {model_path}")
         
         self.tokenizer = AutoTokenizer.from_pretrained(
@@ -34,6 +89,109 @@ class FlutterCodeGenerator:
         
         self.model.eval()
         print("✓ Model loaded successfully")
+        
+        self.compiled = compile
+        self.prompt_buckets = sorted(prompt_buckets)
+        if compile:
+            # Static shapes: a fixed-size KV cache and a handful of padded prompt lengths.
+            # The prefix cache and speculative decoding feed dynamic shapes, so they are off.
+            use_prefix_cache, draft_model_path = False, None
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.model.generation_config.cache_implementation = "static"
+            mode = "reduce-overhead" if self.model.device.type == "cuda" else "default"
+            self.model.forward = torch.compile(self.model.forward, mode=mode, fullgraph=True)
+        
+        self.prefix_cache = None
+        if use_prefix_cache:
+            self.prefix_cache = PrefixCache(self.model, self.tokenizer, self.model.device)
+            self.prefix_cache.register(TASK_PREAMBLE)
+        
+        self.speculative = None
+        if draft_model_path:
+            draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_path, trust_remote_code=True)
+            if vocabularies_match(self.tokenizer, draft_tokenizer):
+                draft_model = AutoModelForCausalLM.from_pretrained(
+                    draft_model_path,
+                    torch_dtype=torch.bfloat16,
+                    trust_remote_code=True
+                ).to(self.model.device)
+                draft_model.eval()
+                self.speculative = SpeculativeDecoder(
+                    DraftModelProposer(draft_model, self.model.device),
+                    num_draft_tokens=num_draft_tokens,
+                )
+                print(f"✓ Speculative decoding with draft model: {draft_model_path}")
+            else:
+                print(f"⚠️  Draft model {draft_model_path} uses a different tokenizer; speculative decoding disabled")
+        
+        if compile:
+            self.warmup()
+    
+    def _tokenize(self, prompt: str):
+        """Tokenize a prompt, left-padding it to the smallest fitting bucket in compiled mode"""
+        if not self.compiled:
+            return self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512).to(self.model.device)
+        
+        length = len(self.tokenizer(prompt, truncation=True, max_length=512)["input_ids"])
+        bucket = next((b for b in self.prompt_buckets if b >= length), length)
+        return self.tokenizer(
+            prompt,
+            return_tensors="pt",
+            padding="max_length",
+            truncation=True,
+            max_length=bucket
+        ).to(self.model.device)
+    
+    def _tokenize_batch(self, prompts: List[str]):
+        """Left-pad prompts to the longest one (or, in compiled mode, to the bucket that fits it)"""
+        if not self.compiled:
+            return self.tokenizer(
+                prompts, return_tensors="pt", padding=True, truncation=True, max_length=512
+            ).to(self.model.device)
+        
+        length = max(len(ids) for ids in self.tokenizer(prompts, truncation=True, max_length=512)["input_ids"])
+        bucket = next((b for b in self.prompt_buckets if b >= length), length)
+        return self.tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding="max_length",
+            truncation=True,
+            max_length=bucket
+        ).to(self.model.device)
+    
+    def warmup(self, max_length: int = 2048, steps: int = 4):
+        """
+        Compile the prefill of every prompt bucket and the decode step ahead of real requests
+        
+        Args:
+            max_length: Generation length the static cache is sized for (match generate_code)
+            steps: Tokens decoded per warmup generation
+        """
+        print(f"🔥 Warming up compiled generation for prompt buckets {self.prompt_buckets}...")
+        for bucket in self.prompt_buckets:
+            inputs = self.tokenizer(
+                "Warmup " * bucket,
+                return_tensors="pt",
+                padding="max_length",
+                truncation=True,
+                max_length=bucket
+            ).to(self.model.device)
+            gen_config = GenerationConfig(
+                max_length=max_length,
+                do_sample=True,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+            )
+            with torch.no_grad():
+                # max_length sizes the static cache like generate_code's, so its shapes are compiled
+                self.model.generate(
+                    **inputs,
+                    generation_config=gen_config,
+                    stopping_criteria=StoppingCriteriaList([StepLimitCriteria(bucket, steps)])
+                )
+        print("✓ Warmup complete")
     
     def generate_code(
         self,
@@ -45,7 +203,8 @@ class FlutterCodeGenerator:
         temperature: float = 0.7,
         top_p: float = 0.9,
         top_k: int = 50,
-        num_return_sequences: int = 1
+        num_return_sequences: int = 1,
+        stop_at_structure: bool = True
     ) -> str:
         """
         Generate Flutter code based on instruction
@@ -60,34 +219,43 @@ class FlutterCodeGenerator:
             top_p: Nucleus sampling parameter
             top_k: Top-k sampling parameter
             num_return_sequences: Number of outputs to generate
+            stop_at_structure: Stop once the Dart code or JSON output object is complete
+            
+        With a draft model, single-output requests use speculative decoding,
+        which samples with temperature and top_p only (top_k is not applied).
             
         Returns:
             Generated code/project structure
         """
-        # Format prompt
-        prompt = f"""### Task: Flutter Application Development
-
-**Framework**: {framework}
-**Architecture**: {architecture}
-
-**Instruction**: {instruction}
-"""
-        
-        if input_text:
-            prompt += f"\n**Input**: {input_text}\n"
-        
-        prompt += "\n**Output**:"
+        prompt = self.format_prompt(instruction, input_text, framework, architecture)
         
         print(f"\n📝 Prompt:\n{prompt}\n")
         print("⏳ Generating...")
         
         # Tokenize
-        inputs = self.tokenizer(
-            prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=512
-        ).to(self.model.device)
+        inputs = self._tokenize(prompt)
+        
+        hit = self.prefix_cache.lookup(inputs["input_ids"][0].tolist()) if self.prefix_cache is not None else None
+        
+        prompt_length = inputs["input_ids"].shape[1]
+        max_new_tokens = max(1, max_length - prompt_length)
+        
+        if self.speculative is not None and num_return_sequences == 1:
+            stopper = DartCodeStopper(self.tokenizer) if stop_at_structure else None
+            params = SamplingParams(temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens)
+            token_ids = speculative_generate(
+                self.model,
+                self.speculative,
+                inputs["input_ids"][0].tolist(),
+                params,
+                self.tokenizer.eos_token_id,
+                self.model.device,
+                prefix=hit,
+                stopper=stopper,
+            )
+            if stopper is not None and stopper.tokens_saved(max_new_tokens):
+                print(f"✂️  Code complete, stopped early (saved {stopper.tokens_saved(max_new_tokens)} tokens)")
+            return self.tokenizer.decode(token_ids, skip_special_tokens=True).strip()
         
         # Generation config
         gen_config = GenerationConfig(
@@ -97,20 +265,41 @@ class FlutterCodeGenerator:
             top_k=top_k,
             num_return_sequences=num_return_sequences,
             do_sample=True,
-            pad_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id if self.compiled else self.tokenizer.eos_token_id,
             eos_token_id=self.tokenizer.eos_token_id,
         )
         
+        # Reuse the preamble's KV states so only the rest of the prompt is prefilled
+        prefix_kwargs = {}
+        if hit is not None:
+            _, layers = hit
+            prefix_kwargs["past_key_values"] = layers_to_cache([
+                (k.expand(num_return_sequences, -1, -1, -1), v.expand(num_return_sequences, -1, -1, -1))
+                for k, v in layers
+            ])
+        
+        # Stop once the code is structurally complete instead of running to max_length
+        stopping = DartStoppingCriteria(self.tokenizer, prompt_length) if stop_at_structure else None
+        
         # Generate
         with torch.no_grad():
             outputs = self.model.generate(
                 **inputs,
-                generation_config=gen_config
+                generation_config=gen_config,
+                stopping_criteria=StoppingCriteriaList([stopping]) if stopping is not None else None,
+                **prefix_kwargs
             )
         
+        output_ids = outputs[0]
+        if stopping is not None and stopping.stoppers and stopping.stoppers[0].tracker.complete:
+            saved = max_new_tokens - (outputs.shape[1] - prompt_length)
+            if saved > 0:
+                print(f"✂️  Code complete, stopped early (saved {saved} tokens)")
+            output_ids = output_ids[:prompt_length + stopping.stoppers[0].keep_tokens]
+        
         # Decode
         generated_text = self.tokenizer.decode(
-            outputs[0],
+            output_ids,
             skip_special_tokens=True
         )
         
@@ -119,6 +308,112 @@ class FlutterCodeGenerator:
         
         return response
     
+    @staticmethod
+    def format_prompt(
+        instruction: str,
+        input_text: str = "",
+        framework: str = "Flutter 3.0+",
+        architecture: str = "Clean Architecture",
+    ) -> str:
+        """Build the model prompt for an instruction"""
+        prompt = f"""### Task: Flutter Application Development
+
+**Framework**: {framework}
+**Architecture**: {architecture}
+
+**Instruction**: {instruction}
+"""
+        
+        if input_text:
+            prompt += f"\n**Input**: {input_text}\n"
+        
+        prompt += "\n**Output**:"
+        return prompt
+    
+    def generate_batch(
+        self,
+        instructions: List[str],
+        input_texts: Optional[List[str]] = None,
+        framework: str = "Flutter 3.0+",
+        architecture: str = "Clean Architecture",
+        max_length: int = 2048,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        batch_size: int = 8,
+        stop_at_structure: bool = True
+    ) -> List[str]:
+        """
+        Generate Flutter code for many instructions in batched forward passes
+        
+        Prompts are sorted by length and split into batches of similar length.
+        Each batch is left-padded to its longest prompt (or to the prompt
+        bucket in compiled mode), so little compute goes to padding. Each row
+        stops on its own once its code is complete. The prefix cache and
+        speculative decoding are single-sequence only and are not used here.
+        
+        Args:
+            instructions: What to build, one entry per output
+            input_texts: Optional additional context per instruction
+            framework: Flutter framework version
+            architecture: Architecture pattern
+            max_length: Maximum total length (prompt + generated tokens) of each batch
+            temperature: Sampling temperature
+            top_p: Nucleus sampling parameter
+            top_k: Top-k sampling parameter
+            batch_size: Prompts generated together
+            stop_at_structure: Stop each row once its Dart code or JSON output object is complete
+            
+        Returns:
+            Generated code, in the order of instructions
+        """
+        input_texts = input_texts or [""] * len(instructions)
+        prompts = [
+            self.format_prompt(instruction, input_text, framework, architecture)
+            for instruction, input_text in zip(instructions, input_texts)
+        ]
+        lengths = [len(ids) for ids in self.tokenizer(prompts, truncation=True, max_length=512)["input_ids"]] if prompts else []
+        order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+        
+        padding_side, pad_token = self.tokenizer.padding_side, self.tokenizer.pad_token
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        outputs: List[Optional[str]] = [None] * len(prompts)
+        try:
+            for start in range(0, len(order), batch_size):
+                rows = order[start:start + batch_size]
+                inputs = self._tokenize_batch([prompts[i] for i in rows])
+                prompt_length = inputs["input_ids"].shape[1]
+                
+                gen_config = GenerationConfig(
+                    max_length=max(max_length, prompt_length + 1),
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    do_sample=True,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                )
+                stopping = DartStoppingCriteria(self.tokenizer, prompt_length) if stop_at_structure else None
+                with torch.no_grad():
+                    generated = self.model.generate(
+                        **inputs,
+                        generation_config=gen_config,
+                        stopping_criteria=StoppingCriteriaList([stopping]) if stopping is not None else None,
+                    )
+                
+                for row, index in enumerate(rows):
+                    output_ids = generated[row, prompt_length:]
+                    if stopping is not None and stopping.stoppers and stopping.stoppers[row].tracker.complete:
+                        output_ids = output_ids[:stopping.stoppers[row].keep_tokens]
+                    outputs[index] = self.tokenizer.decode(output_ids, skip_special_tokens=True).strip()
+        finally:
+            self.tokenizer.padding_side, self.tokenizer.pad_token = padding_side, pad_token
+        
+        return outputs
+    
     def interactive_mode(self):
         """Interactive mode for testing"""
         print("\n" + "=" * 70)
@@ -170,6 +465,124 @@ class FlutterCodeGenerator:
                 print(f"❌ Error: {e}")
 
 
+def read_jsonl(path: str) -> Iterator[Tuple[int, dict]]:
+    """Yield (line number, record) for every JSON line of a file, skipping blank ones"""
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            if line.strip():
+                yield line_number, json.loads(line)
+
+
+def completed_ids(output_path: str) -> set:
+    """Ids already written to a batch output file; lines cut off by a crash or holding an error are not counted"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "error" not in record:
+                done.add(str(record["id"]))
+    return done
+
+
+def run_batch_file(
+    generator: FlutterCodeGenerator,
+    input_path: str,
+    output_path: str,
+    batch_size: int = 8,
+    window_batches: int = 4,
+    temperature: float = 0.7,
+    max_length: int = 2048,
+):
+    """
+    Generate code for every instruction of a JSONL file, appending results to another
+    
+    Input lines hold an "instruction" (or "prompt"), plus optional "id",
+    "input", "framework" and "architecture" fields. The line number is the
+    id when none is given. The input is read as a stream, `window_batches`
+    batches at a time, and every batch's results are flushed to disk before
+    the next one starts. Re-running skips ids already in the output, so an
+    interrupted run resumes where it stopped.
+    
+    Args:
+        generator: Loaded FlutterCodeGenerator
+        input_path: JSONL file of instructions
+        output_path: JSONL file results are appended to
+        batch_size: Prompts generated together
+        window_batches: Batches read ahead, so prompts can be grouped by length
+        temperature: Sampling temperature
+        max_length: Maximum total length of each batch
+    """
+    done = completed_ids(output_path)
+    if done:
+        print(f"⏭️  Resuming: {len(done)} ids already in {output_path}")
+    
+    with open(output_path, "a") as out:
+        # A crash mid-write leaves a partial line; start on a fresh one
+        if out.tell() > 0:
+            with open(output_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    out.write("\n")
+        
+        def flush(pending: List[dict]):
+            # Records sharing framework/architecture share a prompt template
+            groups = {}
+            for record in pending:
+                key = (record.get("framework", "Flutter 3.0+"), record.get("architecture", "Clean Architecture"))
+                groups.setdefault(key, []).append(record)
+            for (framework, architecture), records in groups.items():
+                try:
+                    outputs = generator.generate_batch(
+                        [record["instruction"] for record in records],
+                        [record.get("input", "") for record in records],
+                        framework=framework,
+                        architecture=architecture,
+                        max_length=max_length,
+                        temperature=temperature,
+                        batch_size=batch_size,
+                    )
+                    results = [
+                        {"id": record["id"], "instruction": record["instruction"], "output": output,
+                         "generated_at": datetime.now().isoformat()}
+                        for record, output in zip(records, outputs)
+                    ]
+                except Exception as e:
+                    print(f"❌ Batch failed: {e}")
+                    results = [{"id": record["id"], "error": str(e)} for record in records]
+                for result in results:
+                    out.write(json.dumps(result) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+                print(f"✓ Wrote {len(results)} results to {output_path}")
+        
+        pending, skipped = [], 0
+        for line_number, record in read_jsonl(input_path):
+            record = dict(record)
+            record["id"] = str(record.get("id", line_number))
+            record["instruction"] = record.get("instruction") or record.get("prompt")
+            if record["id"] in done:
+                skipped += 1
+                continue
+            if not record["instruction"]:
+                print(f"⚠️  Skipping line {line_number + 1}: no instruction")
+                continue
+            done.add(record["id"])
+            pending.append(record)
+            if len(pending) >= batch_size * window_batches:
+                flush(pending)
+                pending = []
+        if pending:
+            flush(pending)
+    
+    if skipped:
+        print(f"⏭️  Skipped {skipped} instructions that were already generated")
+
+
 def main():
     """Main execution"""
     import argparse
@@ -204,13 +617,58 @@ def main():
         default=2048,
         help="Maximum generation length"
     )
+    parser.add_argument(
+        "--draft_model_path",
+        type=str,
+        default=None,
+        help="Small draft model for speculative decoding (must share the tokenizer)"
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile with a static KV cache and bucketed prompt lengths (warms up at startup)"
+    )
+    parser.add_argument(
+        "--input",
+        type=str,
+        default=None,
+        help="JSONL file of instructions to generate in batches (requires --output)"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSONL file batch results are appended to; ids already in it are skipped"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Prompts generated together in batch mode"
+    )
     
     args = parser.parse_args()
+    if bool(args.input) != bool(args.output):
+        parser.error("--input and --output must be given together")
     
     # Initialize generator
-    generator = FlutterCodeGenerator(args.model_path)
+    generator = FlutterCodeGenerator(
+        args.model_path,
+        draft_model_path=args.draft_model_path,
+        compile=args.compile,
+    )
     
-    if args.interactive or args.instruction is None:
+    if args.input:
+        # Batch mode
+        run_batch_file(
+            generator,
+            args.input,
+            args.output,
+            batch_size=args.batch_size,
+            temperature=args.temperature,
+            max_length=args.max_length,
+        )
+    elif args.interactive or args.instruction is None:
         # Interactive mode
         generator.interactive_mode()
     else:
@@ -229,29 +687,4 @@ def main():
 
 
 if __name__ == "__main__":
-    # Example usage
-    print("=" * 70)
-    print("FLUTTER CODE GENERATOR - INFERENCE")
-    print("=" * 70)
-    
-    # Example 1: Direct generation
-    print("\n📝 Example 1: Direct Generation\n")
-    
-    generator = FlutterCodeGenerator("./outputs/dpo_model")
-    
-    response = generator.generate_code(
-        instruction="Create a simple Flutter counter app with Provider state management",
-        framework="Flutter 3.0+",
-        architecture="Clean Architecture",
-        temperature=0.7
-    )
-    
-    print("\n" + "=" * 70)
-    print("GENERATED OUTPUT:")
-    print("=" * 70)
-    print(response[:500] + "..." if len(response) > 500 else response)
-    print("=" * 70)
-    
-    # Example 2: Interactive mode
-    print("\n\n📝 Starting Interactive Mode...\n")
-    generator.interactive_mode()
+    main()
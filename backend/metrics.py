@@ -0,0 +1,325 @@
+"""
+Prometheus Metrics for the Inference Server
+Counters, gauges and histograms rendered in the Prometheus text exposition
+format, plus the serving metrics api_server.py exports on /metrics
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# Request-scale latencies (seconds), from a cache hit to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Per-token decode latencies (seconds)
+TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """A named metric with a fixed set of label names"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(Metric):
+    """Monotonically increasing total"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._labels(key)} {_format_number(value)}" for key, value in values]
+
+
+class Gauge(Metric):
+    """Value that goes up and down, usually sampled when /metrics is scraped"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def replace(self, values: Dict[Tuple[str, ...], float]):
+        """Swap in a complete set of labelled values (so label sets that disappeared are dropped)"""
+        with self._lock:
+            self._values = dict(values)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._labels(key)} {_format_number(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    """Distribution of observations over cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (per-bucket counts, sum, count)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self._labels(key, (('le', _format_number(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{self._labels(key, (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+class RateMeter:
+    """Events per second over a trailing window"""
+
+    def __init__(self, window_seconds: float = 60.0):
+        self.window_seconds = window_seconds
+        self._events: Deque[Tuple[float, float]] = deque()
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, amount: float):
+        with self._lock:
+            self._events.append((time.monotonic(), amount))
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            while self._events and self._events[0][0] < now - self.window_seconds:
+                self._events.popleft()
+            total = sum(amount for _, amount in self._events)
+        # Right after startup the window has not filled yet
+        return total / max(min(self.window_seconds, now - self._started), 1e-9)
+
+
+class MetricsRegistry:
+    """Metrics rendered together on one /metrics page"""
+
+    def __init__(self, namespace: str = ""):
+        self.namespace = namespace
+        self.metrics: List[Metric] = []
+
+    def _add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def _name(self, name: str) -> str:
+        return f"{self.namespace}_{name}" if self.namespace else name
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self._add(Counter(self._name(name), help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = ()) -> Gauge:
+        return self._add(Gauge(self._name(name), help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._add(Histogram(self._name(name), help, labels, buckets))
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ServingMetrics:
+    """
+    The inference server's metrics
+
+    Request-level metrics (latency, rejections, response cache lookups) are
+    recorded once per HTTP or WebSocket request. Generation-level metrics
+    (queue wait, prefill, decode, token counts) are recorded once per
+    generation, so requests that joined an identical in-flight generation
+    only count towards the former. Everything request-related is labelled
+    by endpoint and adapter.
+    """
+
+    def __init__(self, throughput_window_seconds: float = 60.0):
+        registry = MetricsRegistry("flutter_ai")
+        labels = ("endpoint", "adapter")
+        self.registry = registry
+
+        self.request_latency = registry.histogram(
+            "request_latency_seconds", "Time from receiving a request to its last response byte", labels
+        )
+        self.rejected_requests = registry.counter(
+            "rejected_requests_total", "Requests refused before generation (queue full, loading, bad adapter)",
+            labels + ("status",)
+        )
+        self.cache_lookups = registry.counter(
+            "cache_lookups_total", "Response and prefix cache lookups", labels + ("cache", "result")
+        )
+        self.queue_wait = registry.histogram(
+            "queue_wait_seconds", "Time sequences waited for a batch slot", labels
+        )
+        self.tokenization = registry.histogram(
+            "tokenization_seconds", "Time spent tokenizing prompts", labels
+        )
+        self.prefill = registry.histogram(
+            "prefill_seconds", "Prompt prefill time, including the first token", labels
+        )
+        self.time_to_first_token = registry.histogram(
+            "time_to_first_token_seconds", "Time from starting a generation to its first token", labels
+        )
+        self.token_latency = registry.histogram(
+            "decode_token_seconds", "Mean per-token decode latency of each sequence", labels, TOKEN_BUCKETS
+        )
+        self.prompt_tokens = registry.counter(
+            "prompt_tokens_total", "Prompt tokens of generations", labels
+        )
+        self.generated_tokens = registry.counter(
+            "generated_tokens_total", "Tokens generated", labels
+        )
+        self.pruned_sequences = registry.counter(
+            "pruned_sequences_total", "best_of candidates stopped early for their low likelihood", labels
+        )
+        self.tokens_per_second = registry.gauge(
+            "generated_tokens_per_second", f"Tokens generated per second over the last {throughput_window_seconds:g}s"
+        )
+        self.active_sequences = registry.gauge(
+            "active_sequences", "Sequences in the running batch", ("adapter",)
+        )
+        self.waiting_sequences = registry.gauge(
+            "waiting_sequences", "Sequences waiting for a batch slot", ("adapter",)
+        )
+        self.kv_cache_bytes = registry.gauge(
+            "kv_cache_bytes", "Memory held by the running batch's KV cache"
+        )
+        self.throughput = RateMeter(throughput_window_seconds)
+
+    @staticmethod
+    def labels(endpoint: str, adapter: Optional[str]) -> Dict[str, str]:
+        return {"endpoint": endpoint, "adapter": adapter or "none"}
+
+    def observe_generation(self, labels: Dict[str, str], results, tokenize_seconds: float, prompt_tokens: int):
+        """
+        Record a finished generation
+
+        Args:
+            labels: endpoint/adapter labels from labels()
+            results: GenerationResults of the generation's sequences (one prefill shared by all)
+            tokenize_seconds: Time spent tokenizing the prompt
+            prompt_tokens: Prompt length in tokens
+        """
+        if not results:
+            return
+        generated = sum(len(result.token_ids) for result in results)
+        first = min(results, key=lambda result: result.queue_seconds + result.prefill_seconds)
+
+        self.tokenization.observe(tokenize_seconds, **labels)
+        self.queue_wait.observe(first.queue_seconds, **labels)
+        self.prefill.observe(first.prefill_seconds, **labels)
+        self.time_to_first_token.observe(tokenize_seconds + first.queue_seconds + first.prefill_seconds, **labels)
+        for result in results:
+            if len(result.token_ids) > 1:
+                self.token_latency.observe(result.decode_seconds / (len(result.token_ids) - 1), **labels)
+
+        self.prompt_tokens.inc(prompt_tokens, **labels)
+        self.generated_tokens.inc(generated, **labels)
+        self.pruned_sequences.inc(sum(result.finish_reason == "pruned" for result in results), **labels)
+        self.throughput.add(generated)
+        self.cache_lookups.inc(cache="prefix", result="hit" if first.cached_tokens else "miss", **labels)
+
+    def observe_usage(self, usages: List[dict]):
+        """
+        Refresh the scheduler gauges
+
+        Args:
+            usages: ContinuousBatchScheduler.usage() of every scheduler (one per worker)
+        """
+        active: Dict[Tuple[str, ...], float] = {}
+        waiting: Dict[Tuple[str, ...], float] = {}
+        for usage in usages:
+            for adapter, count in usage["active"].items():
+                active[(adapter or "none",)] = active.get((adapter or "none",), 0) + count
+            for adapter, count in usage["waiting"].items():
+                waiting[(adapter or "none",)] = waiting.get((adapter or "none",), 0) + count
+        self.active_sequences.replace(active)
+        self.waiting_sequences.replace(waiting)
+        self.kv_cache_bytes.set(sum(usage["kv_cache_bytes"] for usage in usages))
+
+    def render(self) -> str:
+        self.tokens_per_second.set(self.throughput.rate())
+        return self.registry.render()
@@ -0,0 +1,151 @@
+"""
+Mixed-Adapter LoRA Batching
+Applies a different LoRA adapter to each row of one batch: the adapters'
+low-rank factors are stacked per layer and masked by row, so a batch of
+SFT, DPO and experiment rows runs as one forward pass
+"""
+
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+
+def lora_layers(model) -> List[nn.Module]:
+    """PEFT LoRA-wrapped Linear layers of a model"""
+    return [
+        module for module in model.modules()
+        if hasattr(module, "base_layer") and isinstance(getattr(module, "lora_A", None), nn.ModuleDict)
+    ]
+
+
+def unsupported_adapters(model) -> List[str]:
+    """Adapters using LoRA variants (DoRA, LoRA bias) that the stacked path cannot apply"""
+    names = set()
+    for module in lora_layers(model):
+        names.update(getattr(module, "lora_variant", {}))
+        names.update(name for name, enabled in getattr(module, "lora_bias", {}).items() if enabled)
+        names.update(name for name, enabled in getattr(module, "use_dora", {}).items() if enabled)
+    return sorted(names)
+
+
+class MixedLoraBatcher:
+    """
+    Row-wise adapter routing for a PeftModel
+
+    Every LoRA layer gets its adapters' factors concatenated along the rank
+    axis: A [adapters * r, in] and B [out, adapters * r], with ranks
+    zero-padded to the layer's largest one and the LoRA scaling folded into
+    B. Inside rows(), each layer adds ((x @ A^T) * mask) @ B^T to its base
+    output, where the mask keeps every row's own adapter block. Two dense
+    matmuls over the adapters present in the batch are much cheaper on CPU
+    than gathering a weight copy per row. Outside rows(), PEFT's own
+    single-adapter forward runs.
+    """
+
+    def __init__(self, model):
+        """
+        Install the routing on a PeftModel's LoRA layers
+
+        Args:
+            model: PeftModel with one or more adapters loaded
+        """
+        self.model = model
+        self.names: List[str] = []
+        # layer -> (A blocks, B blocks, rank per adapter block)
+        self._stacks: Dict[nn.Module, Tuple[torch.Tensor, torch.Tensor, int]] = {}
+        self._originals: Dict[nn.Module, object] = {}
+        self._row_ids: Optional[List[int]] = None
+        # rank -> (column indices of the present adapters or None for all, row mask)
+        self._routing: Dict[int, Tuple[Optional[torch.Tensor], torch.Tensor]] = {}
+        self.refresh()
+
+    def refresh(self):
+        """Restack every layer's factors; call after loading or deleting an adapter"""
+        layers = lora_layers(self.model)
+        self.names = sorted({name for layer in layers for name in layer.lora_A})
+        self._stacks = {layer: self._stack(layer) for layer in layers}
+
+        for layer in layers:
+            if layer not in self._originals:
+                self._originals[layer] = layer.forward
+                layer.forward = self._forward_for(layer)
+        logger.info(f"Mixed-adapter batching over {self.names} in {len(layers)} LoRA layers")
+
+    def _stack(self, layer: nn.Module) -> Tuple[torch.Tensor, torch.Tensor, int]:
+        reference = next(iter(layer.lora_A.values())).weight
+        rank = max(layer.lora_A[name].weight.shape[0] for name in layer.lora_A)
+        out_features = next(iter(layer.lora_B.values())).weight.shape[0]
+
+        A = reference.new_zeros((len(self.names) * rank, reference.shape[1]))
+        B = reference.new_zeros((out_features, len(self.names) * rank))
+        for index, name in enumerate(self.names):
+            if name not in layer.lora_A:
+                # Adapter does not target this layer: its rows get a zero delta
+                continue
+            a = layer.lora_A[name].weight
+            b = layer.lora_B[name].weight * layer.scaling[name]
+            A[index * rank:index * rank + a.shape[0]] = a.to(A.dtype)
+            B[:, index * rank:index * rank + b.shape[1]] = b.to(B.dtype)
+        return A, B, rank
+
+    @contextmanager
+    def rows(self, adapter_names: List[str]):
+        """
+        Route the forward passes inside the block row by row
+
+        Args:
+            adapter_names: Adapter of each batch row
+        """
+        self._row_ids = [self.names.index(name) for name in adapter_names]
+        self._routing = {}
+        try:
+            yield
+        finally:
+            self._row_ids = None
+            self._routing = {}
+
+    def _route(self, rank: int, device) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+        """Columns of the adapters present in the batch and the mask keeping each row's own block"""
+        if rank not in self._routing:
+            present = sorted(set(self._row_ids))
+            columns = None
+            if len(present) < len(self.names):
+                columns = torch.tensor(
+                    [index * rank + offset for index in present for offset in range(rank)],
+                    dtype=torch.long,
+                    device=device,
+                )
+            mask = torch.zeros((len(self._row_ids), 1, len(present) * rank), device=device)
+            for row, index in enumerate(self._row_ids):
+                block = present.index(index)
+                mask[row, :, block * rank:(block + 1) * rank] = 1
+            self._routing[rank] = (columns, mask)
+        return self._routing[rank]
+
+    def _forward_for(self, layer: nn.Module):
+        original = layer.forward
+
+        def forward(x: torch.Tensor, *args, **kwargs):
+            if self._row_ids is None:
+                return original(x, *args, **kwargs)
+
+            result = layer.base_layer(x, *args, **kwargs)
+            A, B, rank = self._stacks[layer]
+            h = x.to(A.dtype).reshape(x.shape[0], -1, x.shape[-1])
+            if len(set(self._row_ids)) == 1:
+                # Single adapter in the batch: just its own block
+                block = slice(self._row_ids[0] * rank, (self._row_ids[0] + 1) * rank)
+                delta = (h @ A[block].T) @ B[:, block].T
+            else:
+                columns, mask = self._route(rank, A.device)
+                if columns is not None:
+                    A, B = A.index_select(0, columns), B.index_select(1, columns)
+                delta = ((h @ A.T) * mask.to(A.dtype)) @ B.T
+            return result + delta.reshape(result.shape).to(result.dtype)
+
+        return forward
@@ -0,0 +1,137 @@
+"""
+Prompt Prefix KV Cache
+Precomputes the KV states of constant prompt preambles so only the
+request-specific suffix has to be prefilled
+"""
+
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from generation_engine import cache_to_layers
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PrefixEntry:
+    """KV states of one preamble"""
+    text: str
+    token_ids: List[int]
+    layers: List[tuple]
+    namespace: str = ""
+
+
+class PrefixCache:
+    """
+    Holds precomputed KV states for fixed prompt preambles
+
+    Prompts are matched on token ids rather than text, so a prompt whose
+    tokenization merges across the preamble boundary still reuses every
+    token up to the first difference. Entries live in namespaces (one per
+    LoRA adapter), since KV states depend on the weights that produced them.
+    """
+
+    def __init__(self, model, tokenizer, device: str):
+        """
+        Initialize the cache
+
+        Args:
+            model: Causal LM whose KV states are cached
+            tokenizer: Tokenizer matching the model
+            device: Device the preamble tokens are placed on
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        # (namespace, text) -> entry
+        self.entries: Dict[Tuple[str, str], PrefixEntry] = {}
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._lock = threading.Lock()
+
+    def register(self, text: str, namespace: str = "") -> PrefixEntry:
+        """
+        Compute and store the KV states for a preamble
+
+        Args:
+            text: Preamble exactly as it starts the formatted prompts
+            namespace: Adapter the model currently runs with ("" for none)
+
+        Returns:
+            The cached entry
+        """
+        token_ids = self.tokenizer(text)["input_ids"]
+        input_ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+        with torch.inference_mode():
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+
+        entry = PrefixEntry(
+            text=text,
+            token_ids=token_ids,
+            layers=cache_to_layers(outputs.past_key_values),
+            namespace=namespace,
+        )
+        with self._lock:
+            self.entries[(namespace, text)] = entry
+        logger.info(f"Cached {len(token_ids)} prefix tokens{f' ({namespace})' if namespace else ''} for: {text[:40]!r}")
+        return entry
+
+    def texts(self) -> List[str]:
+        """Distinct preambles cached in any namespace"""
+        with self._lock:
+            return list(dict.fromkeys(text for _, text in self.entries))
+
+    def drop(self, namespace: str):
+        """Forget every entry of a namespace"""
+        with self._lock:
+            for key in [key for key in self.entries if key[0] == namespace]:
+                del self.entries[key]
+
+    def lookup(self, prompt_ids: List[int], namespace: str = "") -> Optional[Tuple[int, List[tuple]]]:
+        """
+        Find the cached KV states sharing the longest token prefix with a prompt
+
+        At least one prompt token is always left uncached so the caller gets
+        logits for the next position.
+
+        Args:
+            prompt_ids: Tokenized prompt
+            namespace: Adapter the prompt will be decoded with
+
+        Returns:
+            (number of cached tokens, per-layer key/value tensors for them), or None
+        """
+        with self._lock:
+            candidates = [entry for entry in self.entries.values() if entry.namespace == namespace]
+
+        best_length, best_entry = 0, None
+        for entry in candidates:
+            length = 0
+            limit = min(len(entry.token_ids), len(prompt_ids) - 1)
+            while length < limit and entry.token_ids[length] == prompt_ids[length]:
+                length += 1
+            if length > best_length:
+                best_length, best_entry = length, entry
+
+        with self._lock:
+            if best_entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tokens_saved += best_length
+
+        layers = [(k[:, :, :best_length], v[:, :, :best_length]) for k, v in best_entry.layers]
+        return best_length, layers
+
+    def stats(self) -> dict:
+        return {
+            "prefixes": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "tokens_saved": self.tokens_saved,
+        }
@@ -0,0 +1,290 @@
+"""
+On-Demand Profiling for the Inference Server
+Arms torch.profiler on the decode loop and a Python stack sampler on the
+API process for the next N requests or T seconds, then writes a Chrome
+trace, a top-ops table and sampled Python stacks to a local directory
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Scheduler -> running torch profiler; one per process (each pool worker has its own)
+_torch_profilers: Dict[int, torch.profiler.profile] = {}
+
+
+class ProfilerBusyError(RuntimeError):
+    """Raised when arming a capture while another one is running"""
+
+
+# Scheduler operations: run through scheduler.call(), which passes the scheduler in.
+# Module-level so worker pools can pickle them to their forked workers.
+def start_torch_profiler(scheduler):
+    """Start recording the ops of the scheduler thread's forward passes"""
+    if id(scheduler) in _torch_profilers:
+        raise ProfilerBusyError("torch.profiler is already recording")
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+    profiler.start()
+    _torch_profilers[id(scheduler)] = profiler
+
+
+def stop_torch_profiler(scheduler, directory: Optional[str]) -> List[str]:
+    """
+    Stop recording and write the Chrome trace and top-ops table
+
+    Args:
+        scheduler: Scheduler the profiler was started on
+        directory: Capture directory (None discards the profile)
+
+    Returns:
+        Paths of the written files
+    """
+    profiler = _torch_profilers.pop(id(scheduler), None)
+    if profiler is None:
+        return []
+    profiler.stop()
+    if directory is None:
+        return []
+
+    trace_path = os.path.join(directory, f"torch_trace_{os.getpid()}.json")
+    ops_path = os.path.join(directory, f"torch_ops_{os.getpid()}.txt")
+    profiler.export_chrome_trace(trace_path)
+    sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+    with open(ops_path, "w") as f:
+        f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=40))
+        f.write("\n\nGrouped by input shape:\n")
+        f.write(profiler.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=40))
+    return [trace_path, ops_path]
+
+
+class StackSampler:
+    """
+    Wall-clock sampler of every thread's Python stack
+
+    A background thread records sys._current_frames() at a fixed interval.
+    Waiting threads are sampled too, so the event loop shows up idle in
+    select() when it has nothing to do.
+    """
+
+    def __init__(self, interval_seconds: float = 0.005):
+        self.interval_seconds = interval_seconds
+        # (thread name, outermost frame, ..., innermost frame) -> samples
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopping.wait(self.interval_seconds):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[(names.get(ident, str(ident)), *reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, directory: str) -> List[str]:
+        """
+        Write the collapsed stacks (flamegraph.pl / speedscope input) and a top-functions summary
+
+        Args:
+            directory: Capture directory
+
+        Returns:
+            Paths of the written files
+        """
+        stacks_path = os.path.join(directory, "python_stacks.txt")
+        top_path = os.path.join(directory, "python_top.txt")
+
+        with open(stacks_path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        own_samples: Counter = Counter()
+        total_samples: Counter = Counter()
+        for stack, count in self.stacks.items():
+            own_samples[stack[-1]] += count
+            for function in set(stack[1:]):
+                total_samples[function] += count
+        all_samples = max(sum(self.stacks.values()), 1)
+
+        with open(top_path, "w") as f:
+            f.write(f"{self.samples} samples every {self.interval_seconds * 1000:g} ms\n\n")
+            for title, counts in (("Self", own_samples), ("Total (including callees)", total_samples)):
+                f.write(f"{title}:\n")
+                for function, count in counts.most_common(40):
+                    f.write(f"{count / all_samples:>7.1%} {count:>8} {function}\n")
+                f.write("\n")
+        return [stacks_path, top_path]
+
+
+class ProfileCapture:
+    """
+    A profiling session armed for the next N requests and/or T seconds
+
+    At most one session runs at a time. While nothing is armed, the only
+    cost is request_finished() checking a flag. The session stops when the
+    request budget is used up, when the time limit passes, or on stop();
+    every scheduler (one per worker in a pool) writes its own torch trace.
+    """
+
+    def __init__(self, output_dir: str = "./profiles", max_seconds: float = 300.0, sample_interval_seconds: float = 0.005):
+        """
+        Initialize the capture
+
+        Args:
+            output_dir: Directory each session gets a timestamped subdirectory in
+            max_seconds: Time limit applied to every session
+            sample_interval_seconds: Interval of the Python stack sampler
+        """
+        self.output_dir = output_dir
+        self.max_seconds = max_seconds
+        self.sample_interval_seconds = sample_interval_seconds
+        self.session: Optional[dict] = None
+        self.last: Optional[dict] = None
+        self._scheduler = None
+        self._sampler: Optional[StackSampler] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._stopping: Optional[asyncio.Future] = None
+        self._started = 0.0
+        self._arming = False
+
+    @property
+    def armed(self) -> bool:
+        return self.session is not None
+
+    async def arm(self, scheduler, requests: Optional[int] = None, seconds: Optional[float] = None) -> dict:
+        """
+        Start profiling
+
+        Args:
+            scheduler: ContinuousBatchScheduler or ModelWorkerPool serving the requests
+            requests: Stop after this many requests have finished
+            seconds: Stop after this long (capped at max_seconds)
+
+        Returns:
+            The running session
+
+        Raises:
+            ProfilerBusyError: If a session is already running
+        """
+        if self.armed or self._arming:
+            raise ProfilerBusyError("A profiling session is already running")
+        seconds = min(seconds or self.max_seconds, self.max_seconds)
+        directory = os.path.join(self.output_dir, datetime.now().strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(directory, exist_ok=True)
+
+        self._arming = True
+        try:
+            await asyncio.wrap_future(scheduler.call(start_torch_profiler))
+        except Exception:
+            # Some pool workers may have started recording; discard their profiles
+            scheduler.call(functools.partial(stop_torch_profiler, directory=None))
+            raise
+        finally:
+            self._arming = False
+
+        self.session = {
+            "directory": directory,
+            "started_at": datetime.now().isoformat(),
+            "requests": requests,
+            "seconds": seconds,
+            "requests_seen": 0,
+        }
+        self._scheduler = scheduler
+        self._started = time.monotonic()
+        self._sampler = StackSampler(self.sample_interval_seconds)
+        self._sampler.start()
+        self._timer = asyncio.get_running_loop().call_later(seconds, self._stop_soon)
+
+        logger.info(f"Profiling armed for {requests or 'any number of'} requests / {seconds:g}s into {directory}")
+        return dict(self.session)
+
+    def request_finished(self):
+        """Count a finished request towards the session's budget (call from the event loop)"""
+        if self.session is None:
+            return
+        self.session["requests_seen"] += 1
+        if self.session["requests"] is not None and self.session["requests_seen"] >= self.session["requests"]:
+            self._stop_soon()
+
+    def _stop_soon(self):
+        if self.session is not None and self._stopping is None:
+            self._stopping = asyncio.ensure_future(self._finish())
+
+    async def stop(self) -> dict:
+        """
+        Stop profiling now and write every profile
+
+        Returns:
+            The finished session, with the files written
+        """
+        if self.session is None:
+            raise RuntimeError("No profiling session is running")
+        self._stop_soon()
+        return await asyncio.shield(self._stopping)
+
+    async def _finish(self) -> dict:
+        self._timer.cancel()
+        self._sampler.stop()
+        session, directory = self.session, self.session["directory"]
+        files = []
+        try:
+            written = await asyncio.wrap_future(
+                self._scheduler.call(functools.partial(stop_torch_profiler, directory=directory))
+            )
+            # A worker pool answers with one list per worker
+            for paths in (written if written and isinstance(written[0], list) else [written]):
+                files.extend(paths)
+        except Exception as e:
+            logger.error(f"Collecting the torch profile failed: {e}")
+            session["error"] = str(e)
+        files.extend(await asyncio.to_thread(self._sampler.write, directory))
+
+        session.update(
+            duration_seconds=round(time.monotonic() - self._started, 3),
+            finished_at=datetime.now().isoformat(),
+            files=files,
+        )
+        with open(os.path.join(directory, "session.json"), "w") as f:
+            json.dump(session, f, indent=2)
+
+        self.last, self.session = session, None
+        self._scheduler, self._sampler, self._timer, self._stopping = None, None, None, None
+        logger.info(f"Profile written to {directory} ({len(files)} files)")
+        return session
+
+    def status(self) -> dict:
+        return {"armed": self.armed, "session": self.session, "last": self.last}
+
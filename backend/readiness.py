@@ -0,0 +1,89 @@
+"""
+Model Readiness Tracking
+Records the phases of background model loading so the API can report
+progress while it is not yet able to serve requests
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+LOADING_PHASES = ["loading_tokenizer", "loading_weights", "loading_adapter", "warming_up"]
+
+
+class ReadinessTracker:
+    """
+    Phase-by-phase progress of model startup
+
+    Phases are entered in order by the loading thread and read by request
+    handlers. Skipped phases simply record no timing.
+    """
+
+    def __init__(self, phases: Optional[List[str]] = None):
+        self.phases = phases or LOADING_PHASES
+        self.phase = "starting"
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        # phase -> seconds spent in it
+        self.timings: Dict[str, float] = {}
+        self._phase_started = self.started_at
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
+
+    @property
+    def failed(self) -> bool:
+        return self.phase == "failed"
+
+    def enter(self, phase: str):
+        """Finish the current phase and start the next one"""
+        with self._lock:
+            now = time.time()
+            self._record(now)
+            self.phase = phase
+            self._phase_started = now
+            if phase == "ready":
+                self.ready_at = now
+        if phase == "ready":
+            logger.info(f"Model ready after {self.ready_at - self.started_at:.1f}s")
+        else:
+            logger.info(f"Startup phase: {phase}")
+
+    def fail(self, error: BaseException):
+        """Mark startup as failed"""
+        with self._lock:
+            self._record(time.time())
+            self.phase = "failed"
+            self.error = str(error)
+
+    def progress(self) -> float:
+        """Fraction of the loading phases completed"""
+        if self.ready:
+            return 1.0
+        if self.phase in self.phases:
+            return self.phases.index(self.phase) / len(self.phases)
+        return 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.time()
+            timings = dict(self.timings)
+            if self.phase not in ("ready", "failed", "starting"):
+                timings[self.phase] = now - self._phase_started
+            return {
+                "phase": self.phase,
+                "progress": round(self.progress(), 3),
+                "elapsed_seconds": round((self.ready_at or now) - self.started_at, 3),
+                "phase_timings": {name: round(seconds, 3) for name, seconds in timings.items()},
+                "error": self.error,
+            }
+
+    def _record(self, now: float):
+        if self.phase not in ("ready", "failed", "starting"):
+            self.timings[self.phase] = now - self._phase_started
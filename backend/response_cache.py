@@ -0,0 +1,162 @@
+"""
+Generation Response Cache
+Exact-match cache for deterministic generation results, with LRU eviction,
+a TTL and an optional on-disk tier that survives restarts
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(**fields) -> str:
+    """Hash the request fields that determine a generation result"""
+    payload = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache of JSON-serializable responses, backed by an optional directory
+
+    Entries expire after `ttl_seconds` in both tiers. The memory tier is
+    bounded by entry count and by the serialized size of its values.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: float = 3600,
+        disk_dir: Optional[str] = None,
+    ):
+        """
+        Initialize the cache
+
+        Args:
+            max_entries: Maximum number of entries kept in memory
+            max_bytes: Maximum total serialized size of entries kept in memory
+            ttl_seconds: Lifetime of an entry
+            disk_dir: Directory for the persistent tier (None for memory only)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+
+        # key -> (created_at, size_bytes, value)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return the cached value for a key, or None on a miss or expiry"""
+        now = time.time()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            created_at, _, value = entry
+            if now - created_at <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+
+        value = self._read_disk(key, now)
+        if value is not None:
+            self.disk_hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: dict):
+        """Store a value in memory and, if configured, on disk"""
+        serialized = json.dumps(value)
+        created_at = time.time()
+        self._store(key, value, len(serialized), created_at)
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump({"created_at": created_at, "value": value}, f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Could not persist cache entry {key[:12]}: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def _store(self, key: str, value: dict, size: int, created_at: float):
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (created_at, size, value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str, now: float) -> Optional[dict]:
+        if not self.disk_dir:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Dropping unreadable cache entry {key[:12]}: {e}")
+            self._unlink(path)
+            return None
+
+        if now - record["created_at"] > self.ttl_seconds:
+            self._unlink(path)
+            return None
+
+        value = record["value"]
+        self._store(key, value, len(json.dumps(value)), record["created_at"])
+        return value
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
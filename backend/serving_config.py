@@ -0,0 +1,233 @@
+"""
+Serving Configuration for the Flutter Code Generation API
+Reads the [serving] section of config.ini used by api_server.py
+"""
+
+import configparser
+import os
+from dataclasses import dataclass, field, fields
+from typing import List
+
+
+@dataclass
+class ServingConfig:
+    """Settings for the inference server"""
+    base_model: str = field(
+        default="codellama/CodeLlama-7b-hf",
+        metadata={"help": "Base model served by the API"}
+    )
+    merged_model_dir: str = field(
+        default="./outputs/merged_model",
+        metadata={"help": "export_merged.py artifact served instead of base + adapter when present"}
+    )
+    max_batch_size: int = field(
+        default=8,
+        metadata={"help": "Maximum number of sequences decoded together in one batch"}
+    )
+    max_queue_size: int = field(
+        default=64,
+        metadata={"help": "Maximum number of sequences waiting for a batch slot before requests are rejected"}
+    )
+    retry_after_seconds: int = field(
+        default=5,
+        metadata={"help": "Retry-After value sent when the queue is full"}
+    )
+    prefix_cache: bool = field(
+        default=True,
+        metadata={"help": "Precompute the KV states of the fixed prompt preambles at startup"}
+    )
+    response_cache: bool = field(
+        default=True,
+        metadata={"help": "Cache responses of seeded or greedy requests"}
+    )
+    response_cache_max_entries: int = field(
+        default=512,
+        metadata={"help": "Maximum number of cached responses kept in memory"}
+    )
+    response_cache_max_mb: int = field(
+        default=64,
+        metadata={"help": "Maximum memory used by cached responses (MB)"}
+    )
+    response_cache_ttl_seconds: int = field(
+        default=3600,
+        metadata={"help": "Lifetime of a cached response"}
+    )
+    response_cache_dir: str = field(
+        default="",
+        metadata={"help": "Directory for the persistent cache tier (empty for memory only)"}
+    )
+    workers: int = field(
+        default=1,
+        metadata={"help": "Model worker processes for CPU serving (1 = decode inside the API process)"}
+    )
+    cores_per_worker: int = field(
+        default=0,
+        metadata={"help": "Cores pinned to each worker (0 = split the available cores evenly)"}
+    )
+    reload: bool = field(
+        default=False,
+        metadata={"help": "Auto-reload on code changes (development only, forces a single process)"}
+    )
+    draft_model: str = field(
+        default="",
+        metadata={"help": "Small draft model for speculative decoding (empty to disable); must share the base tokenizer"}
+    )
+    num_draft_tokens: int = field(
+        default=4,
+        metadata={"help": "Tokens drafted per speculative step"}
+    )
+    speculative_min_acceptance: float = field(
+        default=0.3,
+        metadata={"help": "Draft acceptance rate below which speculation pauses"}
+    )
+    prompt_lookup: bool = field(
+        default=True,
+        metadata={"help": "Draft refine outputs from n-grams of the code being refined"}
+    )
+    prompt_lookup_num_tokens: int = field(
+        default=10,
+        metadata={"help": "Tokens copied from the prompt per prompt-lookup step"}
+    )
+    prompt_lookup_max_ngram: int = field(
+        default=3,
+        metadata={"help": "Longest n-gram matched against the prompt"}
+    )
+    early_stopping: bool = field(
+        default=True,
+        metadata={"help": "Stop once the generated Dart code or JSON object is structurally complete"}
+    )
+    structure_penalty: float = field(
+        default=0.5,
+        metadata={"help": "Factor applied to the score of variants whose Dart structure is incomplete (1.0 disables the check)"}
+    )
+    max_best_of: int = field(
+        default=8,
+        metadata={"help": "Largest best_of a generation request may ask for"}
+    )
+    max_batch_prompts: int = field(
+        default=256,
+        metadata={"help": "Most prompts one /api/generate/batch request may carry"}
+    )
+    max_score_candidates: int = field(
+        default=64,
+        metadata={"help": "Most candidates one /api/score request may rank"}
+    )
+    prune_interval_tokens: int = field(
+        default=32,
+        metadata={"help": "Tokens between checkpoints at which best_of candidates are pruned (0 disables pruning)"}
+    )
+    prune_margin: float = field(
+        default=1.0,
+        metadata={"help": "Prune candidates whose mean token log-prob trails the leader by more than this (0 disables)"}
+    )
+    prune_percentile: float = field(
+        default=0.0,
+        metadata={"help": "Also prune candidates below this percentile of the running ones at each checkpoint (0 disables)"}
+    )
+    compile_model: bool = field(
+        default=False,
+        metadata={"help": "Run the model through torch.compile and pad prompts to prefill_buckets"}
+    )
+    prefill_buckets: str = field(
+        default="128,256,512,1024",
+        metadata={"help": "Comma-separated prompt lengths prefill is padded to in compiled mode"}
+    )
+    warmup: bool = field(
+        default=True,
+        metadata={"help": "Run synthetic generations before reporting ready"}
+    )
+    warmup_tokens: int = field(
+        default=8,
+        metadata={"help": "Tokens decoded per warmup generation"}
+    )
+    cpu_quantization: str = field(
+        default="int8",
+        metadata={"help": "Weight-only quantization of Linear layers when serving on CPU: none, int8 or int4"}
+    )
+    quantization_group_size: int = field(
+        default=128,
+        metadata={"help": "Input weights sharing one scale under int4 quantization"}
+    )
+    cpu_dtype: str = field(
+        default="bfloat16",
+        metadata={"help": "Activation and unquantized weight dtype on CPU: bfloat16 or float32"}
+    )
+    hot_swap_adapters: bool = field(
+        default=False,
+        metadata={"help": "Serve base + every adapter unmerged so requests can pick one and adapters can be attached at runtime"}
+    )
+    adapters: str = field(
+        default="",
+        metadata={"help": "Extra adapters to attach at startup, as comma-separated name=path pairs"}
+    )
+    default_adapter: str = field(
+        default="",
+        metadata={"help": "Adapter for requests that do not name one (default: dpo, else sft)"}
+    )
+    mixed_adapter_batching: bool = field(
+        default=True,
+        metadata={"help": "Decode rows of different adapters in one batch instead of one adapter at a time"}
+    )
+    admin_token: str = field(
+        default="",
+        metadata={"help": "Token the admin endpoints require in the X-Admin-Token header (empty = loopback clients only)"}
+    )
+    metrics_window_seconds: float = field(
+        default=60.0,
+        metadata={"help": "Trailing window of the tokens-per-second gauge on /metrics"}
+    )
+    profile_dir: str = field(
+        default="./profiles",
+        metadata={"help": "Directory /api/admin/profile writes its captures to"}
+    )
+    profile_max_seconds: float = field(
+        default=300.0,
+        metadata={"help": "Longest a profiling session may stay armed"}
+    )
+    profile_sample_interval_seconds: float = field(
+        default=0.005,
+        metadata={"help": "Sampling interval of the API process's Python stack profiler"}
+    )
+    idle_wait_seconds: float = field(
+        default=0.05,
+        metadata={"help": "How long the scheduler sleeps when there is no work"}
+    )
+
+    def bucket_sizes(self) -> List[int]:
+        """Parsed prefill bucket lengths, ascending"""
+        return sorted(int(size) for size in self.prefill_buckets.split(",") if size.strip())
+
+
+def load_serving_config(path: str = "config.ini") -> ServingConfig:
+    """
+    Load the [serving] section of config.ini
+
+    Missing files, sections or keys fall back to the dataclass defaults.
+
+    Args:
+        path: Path to the ini file
+
+    Returns:
+        ServingConfig with values parsed to the field types
+    """
+    config = ServingConfig()
+    parser = configparser.ConfigParser()
+
+    if not os.path.exists(path) or not parser.read(path) or not parser.has_section("serving"):
+        return config
+
+    section = parser["serving"]
+    for f in fields(ServingConfig):
+        if f.name not in section:
+            continue
+        if f.type is bool or f.type == "bool":
+            value = section.getboolean(f.name)
+        elif f.type is int or f.type == "int":
+            value = section.getint(f.name)
+        elif f.type is float or f.type == "float":
+            value = section.getfloat(f.name)
+        else:
+            value = section.get(f.name)
+        setattr(config, f.name, value)
+
+    return config
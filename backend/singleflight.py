@@ -0,0 +1,123 @@
+"""
+Singleflight Coalescing of Identical Requests
+Identical concurrent requests share one in-flight generation and its event stream
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Event = Tuple[str, dict]
+
+
+class Flight:
+    """
+    One running generation shared by every request with the same key
+
+    A background task drives the underlying event stream and fans events
+    out to subscribers. Late subscribers first replay what was already
+    emitted. The generation is cancelled only when its last subscriber
+    leaves.
+    """
+
+    def __init__(self, key: str, events: AsyncIterator[Event], on_close: Callable[["Flight"], None]):
+        self.key = key
+        self.buffer: List[Event] = []
+        self.error: Optional[BaseException] = None
+        self.finished = False
+        self.cancelled = False
+        self._subscribers: List[asyncio.Queue] = []
+        self._on_close = on_close
+        self._task = asyncio.create_task(self._drive(events))
+
+    @property
+    def num_subscribers(self) -> int:
+        return len(self._subscribers)
+
+    async def _drive(self, events: AsyncIterator[Event]):
+        try:
+            async for item in events:
+                self.buffer.append(item)
+                for queue in self._subscribers:
+                    queue.put_nowait(item)
+        except asyncio.CancelledError:
+            self.error = RuntimeError("Generation was cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            for queue in self._subscribers:
+                queue.put_nowait(None)
+            self._on_close(self)
+
+    def subscribe(self) -> AsyncIterator[Event]:
+        """Register a subscriber and return its iterator over every event, from the first one"""
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in self.buffer:
+            queue.put_nowait(item)
+        if self.finished:
+            queue.put_nowait(None)
+        self._subscribers.append(queue)
+        return self._consume(queue)
+
+    async def _consume(self, queue: asyncio.Queue) -> AsyncIterator[Event]:
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                yield item
+        finally:
+            self._subscribers.remove(queue)
+            if not self._subscribers and not self.finished:
+                logger.info(f"Cancelling flight {self.key[:12]}: no subscribers left")
+                self.cancelled = True
+                self._task.cancel()
+
+
+class SingleFlight:
+    """Registry of in-flight generations keyed by request identity"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def join(self, key: str, start: Callable[[], AsyncIterator[Event]]) -> AsyncIterator[Event]:
+        """
+        Subscribe to the flight for `key`, starting it with `start()` if none is running
+
+        `start` runs synchronously, so errors raised while queueing the
+        generation (e.g. a full queue) reach the caller directly.
+
+        Args:
+            key: Identity of the request
+            start: Factory returning the event stream of a new generation
+
+        Returns:
+            Async iterator over the flight's events
+        """
+        flight = self._flights.get(key)
+        if flight is not None and not flight.finished and not flight.cancelled:
+            self.coalesced += 1
+            logger.info(f"Joining in-flight generation {key[:12]} ({flight.num_subscribers} waiting)")
+        else:
+            flight = Flight(key, start(), self._close)
+            self._flights[key] = flight
+            self.started += 1
+        return flight.subscribe()
+
+    def _close(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,396 @@
+"""
+Speculative Decoding for Flutter Code Generation
+A small draft model proposes several tokens that the main model verifies
+in a single forward pass
+"""
+
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from generation_engine import SamplingParams, cache_to_layers, layers_to_cache, nucleus_probs, token_logprobs
+
+logger = logging.getLogger(__name__)
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    length = 0
+    limit = min(len(a), len(b))
+    while length < limit and a[length] == b[length]:
+        length += 1
+    return length
+
+
+def vocabularies_match(tokenizer, draft_tokenizer) -> bool:
+    """Speculative decoding needs draft and target to agree on every token id"""
+    return tokenizer.get_vocab() == draft_tokenizer.get_vocab()
+
+
+def verify_draft(
+    logits: torch.Tensor,
+    draft: List[int],
+    params: SamplingParams,
+    generator: Optional[torch.Generator] = None,
+) -> List[int]:
+    """
+    Accept a prefix of the drafted tokens and sample the token after it
+
+    Drafts are deterministic proposals, so acceptance follows speculative
+    sampling with a one-hot draft distribution. Token j is kept with
+    probability p(draft_j). On rejection the replacement comes from p with
+    draft_j removed. The output is distributed exactly as plain sampling
+    from the target model.
+
+    Args:
+        logits: [len(draft) + 1, vocab] target logits; row j predicts the token after draft[:j]
+        draft: Proposed token ids
+        params: Sampling settings of the sequence
+        generator: Optional seeded generator
+
+    Returns:
+        Accepted draft tokens followed by one token sampled from the target
+    """
+    if params.temperature <= 0:
+        predictions = logits.argmax(dim=-1).tolist()
+        accepted = []
+        for j, token in enumerate(draft):
+            if predictions[j] != token:
+                return accepted + [predictions[j]]
+            accepted.append(token)
+        return accepted + [predictions[len(draft)]]
+
+    rows = logits.shape[0]
+    probs = nucleus_probs(
+        logits,
+        torch.full((rows,), params.temperature, device=logits.device),
+        torch.full((rows,), params.top_p, device=logits.device),
+    )
+
+    accepted = []
+    for j, token in enumerate(draft):
+        p = probs[j]
+        if torch.rand(1, generator=generator, device=p.device).item() < p[token].item():
+            accepted.append(token)
+            continue
+        residual = p.clone()
+        residual[token] = 0
+        replacement = torch.multinomial(residual / residual.sum(), num_samples=1, generator=generator)
+        return accepted + [int(replacement)]
+
+    bonus = torch.multinomial(probs[len(draft)], num_samples=1, generator=generator)
+    return accepted + [int(bonus)]
+
+
+class DraftModelProposer:
+    """
+    Proposes tokens greedily with a small draft model
+
+    The draft model's KV cache is kept per sequence and trimmed back to the
+    longest prefix still consistent with the sequence, so each proposal only
+    feeds the tokens the draft has not seen yet.
+    """
+
+    def __init__(self, draft_model, device: str):
+        self.draft_model = draft_model
+        self.device = device
+        self._states: Dict[object, Tuple[List[int], Optional[List[tuple]]]] = {}
+        self._lock = threading.Lock()
+
+    def propose(self, key, context_ids: List[int], num_tokens: int) -> List[int]:
+        """
+        Draft the next tokens of a sequence
+
+        Args:
+            key: Identity of the sequence (for its cached draft state)
+            context_ids: Prompt and generated tokens so far
+            num_tokens: How many tokens to draft
+
+        Returns:
+            Drafted token ids
+        """
+        with self._lock:
+            seen, layers = self._states.get(key, ([], None))
+
+        # Keep at least one token to feed so the draft produces fresh logits
+        reuse = min(common_prefix_length(seen, context_ids), len(context_ids) - 1)
+        layers = [(k[:, :, :reuse], v[:, :, :reuse]) for k, v in layers] if layers and reuse else None
+
+        input_ids = torch.tensor([context_ids[reuse:]], dtype=torch.long, device=self.device)
+        draft = []
+        with torch.inference_mode():
+            for _ in range(num_tokens):
+                outputs = self.draft_model(
+                    input_ids=input_ids,
+                    past_key_values=layers_to_cache(layers) if layers else None,
+                    use_cache=True,
+                )
+                layers = cache_to_layers(outputs.past_key_values)
+                token = int(outputs.logits[0, -1].argmax())
+                draft.append(token)
+                input_ids = torch.tensor([[token]], dtype=torch.long, device=self.device)
+
+        with self._lock:
+            self._states[key] = (list(context_ids) + draft[:-1], layers)
+        return draft
+
+    def release(self, key):
+        """Forget the draft state of a finished sequence"""
+        with self._lock:
+            self._states.pop(key, None)
+
+
+class PromptLookupProposer:
+    """
+    Drafts tokens by copying what followed the latest n-gram match in the context
+
+    Edits such as refinements repeat long stretches of the code in their
+    prompt. When the last few tokens also occur earlier in the prompt or
+    output, the tokens after that occurrence make a cheap draft that needs
+    no extra model.
+    """
+
+    def __init__(self, max_ngram: int = 3, min_ngram: int = 1):
+        """
+        Initialize the proposer
+
+        Args:
+            max_ngram: Longest suffix matched against the context
+            min_ngram: Shortest suffix matched before giving up
+        """
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, key, context_ids: List[int], num_tokens: int) -> List[int]:
+        """
+        Draft the next tokens of a sequence
+
+        Longer n-grams are tried first; among equal lengths the most recent
+        occurrence wins.
+
+        Args:
+            key: Identity of the sequence (unused; the proposer is stateless)
+            context_ids: Prompt and generated tokens so far
+            num_tokens: Maximum number of tokens to draft
+
+        Returns:
+            Drafted token ids (empty when nothing matches)
+        """
+        length = len(context_ids)
+        for n in range(min(self.max_ngram, length - 1), self.min_ngram - 1, -1):
+            pattern = context_ids[-n:]
+            last = pattern[-1]
+            for end in range(length - 2, n - 2, -1):
+                if context_ids[end] == last and context_ids[end - n + 1:end + 1] == pattern:
+                    return list(context_ids[end + 1:end + 1 + num_tokens])
+        return []
+
+    def release(self, key):
+        pass
+
+
+class SpeculativeStats:
+    """Acceptance counters with a fallback switch for unproductive speculation"""
+
+    def __init__(self, min_acceptance: float, cooldown_steps: int, ema_decay: float = 0.9):
+        self.min_acceptance = min_acceptance
+        self.cooldown_steps = cooldown_steps
+        self.ema_decay = ema_decay
+
+        self.steps = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.fallbacks = 0
+        self.acceptance_ema = 1.0
+        self._cooldown = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._cooldown == 0
+
+    def record(self, proposed: int, accepted: int):
+        """Record one verification step (or a plain step while falling back)"""
+        if self._cooldown:
+            self._cooldown -= 1
+            if self._cooldown == 0:
+                # Give speculation a fresh chance
+                self.acceptance_ema = 1.0
+            return
+        if not proposed:
+            return
+
+        self.steps += 1
+        self.proposed += proposed
+        self.accepted += accepted
+        rate = accepted / proposed
+        self.acceptance_ema = self.ema_decay * self.acceptance_ema + (1 - self.ema_decay) * rate
+
+        if self.acceptance_ema < self.min_acceptance:
+            self.fallbacks += 1
+            self._cooldown = self.cooldown_steps
+            logger.info(
+                f"Draft acceptance fell to {self.acceptance_ema:.2f}; "
+                f"plain decoding for the next {self.cooldown_steps} steps"
+            )
+
+    def snapshot(self) -> dict:
+        return {
+            "steps": self.steps,
+            "proposed_tokens": self.proposed,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+            "acceptance_ema": self.acceptance_ema,
+            "tokens_per_step": (self.accepted + self.steps) / self.steps if self.steps else 0.0,
+            "fallbacks": self.fallbacks,
+            "enabled": self.enabled,
+        }
+
+
+class SpeculativeDecoder:
+    """
+    Runs draft-and-verify decode steps for a single sequence
+
+    Each step feeds the pending token plus `num_draft_tokens` drafted ones
+    through the target model at once, keeps the accepted prefix and rolls
+    the KV cache back past the rejected drafts.
+    """
+
+    def __init__(
+        self,
+        proposer,
+        num_draft_tokens: int = 4,
+        min_acceptance: float = 0.3,
+        cooldown_steps: int = 64,
+    ):
+        """
+        Initialize the decoder
+
+        Args:
+            proposer: Object with propose(key, context_ids, num_tokens) and release(key)
+            num_draft_tokens: Tokens drafted per step
+            min_acceptance: Acceptance rate (moving average) below which speculation pauses
+            cooldown_steps: Plain decode steps taken before speculation is retried
+        """
+        self.proposer = proposer
+        self.num_draft_tokens = num_draft_tokens
+        self.stats = SpeculativeStats(min_acceptance, cooldown_steps)
+
+    def step(
+        self,
+        model,
+        layers: List[tuple],
+        attention_mask: torch.Tensor,
+        context_ids: List[int],
+        params: SamplingParams,
+        generator: Optional[torch.Generator] = None,
+        key=None,
+    ) -> Tuple[List[int], List[float], List[tuple], torch.Tensor]:
+        """
+        Decode one or more tokens for a batch-of-one sequence
+
+        Args:
+            model: Target causal LM
+            layers: Per-layer KV tensors for every context token except the last
+            attention_mask: [1, cached length] mask matching `layers`
+            context_ids: Prompt and generated tokens; the last one is not cached yet
+            params: Sampling settings of the sequence
+            generator: Optional seeded generator
+            key: Identity of the sequence for the proposer
+
+        Returns:
+            (new tokens, their log-probabilities, updated KV layers, updated
+            attention mask); the last new token is, again, not cached yet
+        """
+        draft = []
+        if self.stats.enabled and self.num_draft_tokens > 0:
+            draft = self.proposer.propose(key, context_ids, self.num_draft_tokens)
+
+        input_ids = torch.tensor([[context_ids[-1]] + draft], dtype=torch.long, device=attention_mask.device)
+        steps = input_ids.shape[1]
+        position_ids = attention_mask.sum(dim=1, keepdim=True) + torch.arange(steps, device=attention_mask.device)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((1, steps))], dim=1)
+
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=layers_to_cache(layers),
+            use_cache=True,
+        )
+        tokens = verify_draft(outputs.logits[0], draft, params, generator)
+        self.stats.record(len(draft), len(tokens) - 1)
+        # Row j of the logits predicted token j, whether it was an accepted draft or the sampled one
+        logprobs = token_logprobs(
+            outputs.logits[0, :len(tokens)], torch.tensor(tokens, device=outputs.logits.device)
+        ).tolist()
+
+        # Drop the cache entries of rejected drafts
+        keep = attention_mask.shape[1] - (len(draft) - (len(tokens) - 1))
+        layers = [(k[:, :, :keep], v[:, :, :keep]) for k, v in cache_to_layers(outputs.past_key_values)]
+        return tokens, logprobs, layers, attention_mask[:, :keep]
+
+    def release(self, key):
+        self.proposer.release(key)
+
+
+def speculative_generate(
+    model,
+    decoder: SpeculativeDecoder,
+    input_ids: List[int],
+    params: SamplingParams,
+    eos_token_id: Optional[int],
+    device,
+    prefix: Optional[Tuple[int, List[tuple]]] = None,
+    stopper=None,
+) -> List[int]:
+    """
+    Generate one sequence with speculative decoding
+
+    Args:
+        model: Target causal LM
+        decoder: SpeculativeDecoder holding the proposer
+        input_ids: Tokenized prompt
+        params: Sampling settings
+        eos_token_id: Token that ends generation
+        device: Device the inputs are placed on
+        prefix: Optional (cached token count, KV layers) from a PrefixCache lookup
+        stopper: Optional DartCodeStopper ending generation once the code is complete
+
+    Returns:
+        Generated token ids (without the prompt or the EOS token)
+    """
+    generator = None
+    if params.seed is not None:
+        generator = torch.Generator(device=device).manual_seed(params.seed)
+    key = object()
+
+    with torch.inference_mode():
+        prompt = torch.tensor([input_ids], dtype=torch.long, device=device)
+        cached, past_key_values = 0, None
+        if prefix is not None:
+            cached, prefix_layers = prefix
+            past_key_values = layers_to_cache(prefix_layers)
+        outputs = model(input_ids=prompt[:, cached:], past_key_values=past_key_values, use_cache=True)
+        first = verify_draft(outputs.logits[0, -1:], [], params, generator)[0]
+
+        layers = cache_to_layers(outputs.past_key_values)
+        attention_mask = torch.ones_like(prompt)
+        generated = []
+        pending = [first]
+
+        try:
+            while True:
+                for token in pending:
+                    if token == eos_token_id:
+                        return generated
+                    generated.append(token)
+                    if stopper is not None and stopper.append(token):
+                        return generated[:stopper.keep_tokens]
+                    if len(generated) >= params.max_new_tokens:
+                        return generated
+                pending, _, layers, attention_mask = decoder.step(
+                    model, layers, attention_mask, list(input_ids) + generated, params, generator, key
+                )
+        finally:
+            decoder.release(key)
@@ -0,0 +1,82 @@
+"""
+Token Streaming Helpers for the Flutter Code Generation API
+Bridges scheduler-thread token callbacks to SSE and WebSocket responses
+"""
+
+import asyncio
+import json
+from concurrent.futures import Future
+from typing import AsyncIterator, List, Tuple
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing list of token ids into text deltas
+
+    Only a short window of tokens is re-decoded per step, and text is held
+    back while the tail decodes to an incomplete multi-byte character.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add(self, token_id: int) -> str:
+        """Append a token and return the newly completed text, if any"""
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:], skip_special_tokens=True)
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+
+class TokenStream:
+    """Collects tokens from scheduler callbacks onto an asyncio queue"""
+
+    def __init__(self, tokenizer, num_sequences: int):
+        """
+        Initialize the stream
+
+        Args:
+            tokenizer: Tokenizer used for incremental decoding
+            num_sequences: Number of sequences submitted with this stream
+        """
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.decoders = [IncrementalDetokenizer(tokenizer) for _ in range(num_sequences)]
+
+    def on_token(self, index: int, token_id: int):
+        """Scheduler-thread callback for a decoded token"""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (index, token_id))
+
+    def watch(self, futures: List[Future]):
+        """Post an end-of-sequence marker once each future settles"""
+        for index, future in enumerate(futures):
+            future.add_done_callback(
+                lambda _, index=index: self.loop.call_soon_threadsafe(self.queue.put_nowait, (index, None))
+            )
+
+    async def deltas(self) -> AsyncIterator[Tuple[int, str]]:
+        """Yield (sequence index, text delta) until every sequence has finished"""
+        remaining = len(self.decoders)
+        while remaining:
+            index, token_id = await self.queue.get()
+            if token_id is None:
+                remaining -= 1
+                continue
+            text = self.decoders[index].add(token_id)
+            if text:
+                yield index, text
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
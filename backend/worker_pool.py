@@ -0,0 +1,430 @@
+"""
+Multi-Replica Model Worker Pool for CPU Serving
+Forks N model workers pinned to disjoint core sets behind a router in the API process
+"""
+
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+from adapter_registry import register_prefixes
+from generation_engine import ContinuousBatchScheduler, PruningPolicy, QueueFullError, SamplingParams
+from prefix_cache import PrefixCache
+
+logger = logging.getLogger(__name__)
+
+
+def split_cores(num_workers: int, cores_per_worker: int = 0) -> List[List[int]]:
+    """
+    Split the cores this process may run on into disjoint per-worker sets
+
+    Args:
+        num_workers: Number of worker processes
+        cores_per_worker: Cores per worker (0 = divide the available cores evenly)
+
+    Returns:
+        One sorted list of core ids per worker
+    """
+    available = sorted(os.sched_getaffinity(0))
+    if cores_per_worker <= 0:
+        cores_per_worker = max(1, len(available) // num_workers)
+    if cores_per_worker * num_workers > len(available):
+        raise ValueError(
+            f"{num_workers} workers x {cores_per_worker} cores exceeds the {len(available)} available cores"
+        )
+    return [available[i * cores_per_worker:(i + 1) * cores_per_worker] for i in range(num_workers)]
+
+
+def _worker_main(
+    index: int,
+    cores: List[int],
+    model,
+    tokenizer,
+    scheduler_kwargs: dict,
+    prefix_texts: List[str],
+    request_queue,
+    response_queue,
+):
+    """Entry point of a forked worker: pin to its cores and serve requests from the router"""
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    logger.info(f"Worker {index} (pid {os.getpid()}) pinned to cores {cores}")
+
+    prefix_cache = None
+    if prefix_texts:
+        prefix_cache = PrefixCache(model, tokenizer, "cpu")
+        register_prefixes(prefix_cache, scheduler_kwargs.get("adapters"), prefix_texts)
+
+    scheduler = ContinuousBatchScheduler(model, tokenizer, "cpu", prefix_cache=prefix_cache, **scheduler_kwargs)
+    scheduler.start()
+    futures: Dict[int, List[Future]] = {}
+
+    def report(request_id: int, seq_index: int, future: Future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            response_queue.put(("error", request_id, seq_index, str(error)))
+        else:
+            response_queue.put(("result", request_id, seq_index, future.result()))
+
+    def stream(request_id: int, seq_index: int, token_id: int):
+        response_queue.put(("token", request_id, seq_index, token_id))
+
+    def report_call(call_id: int, future: Future):
+        error = future.exception()
+        response_queue.put(("call", call_id, index, (error, None if error is not None else future.result())))
+
+    while True:
+        message = request_queue.get()
+        kind = message[0]
+
+        if kind == "stop":
+            break
+        if kind == "cancel":
+            for future in futures.pop(message[1], []):
+                future.cancel()
+            continue
+        if kind == "call":
+            _, call_id, fn = message
+            scheduler.call(fn).add_done_callback(functools.partial(report_call, call_id))
+            continue
+
+        _, request_id, prompt_ids, params_list, streamed, pruning = message
+        on_token = functools.partial(stream, request_id) if streamed else None
+        try:
+            request_futures = scheduler.submit_many(prompt_ids, params_list, on_token=on_token, pruning=pruning)
+        except (QueueFullError, KeyError, ValueError) as e:
+            # Sent as the exception itself so the API can tell a detached adapter from a full queue
+            for seq_index in range(len(params_list)):
+                response_queue.put(("error", request_id, seq_index, e))
+            continue
+
+        futures[request_id] = request_futures
+        for seq_index, future in enumerate(request_futures):
+            future.add_done_callback(functools.partial(report, request_id, seq_index))
+        # Forget requests whose sequences have all settled
+        for finished_id in [rid for rid, fs in futures.items() if all(f.done() for f in fs)]:
+            del futures[finished_id]
+
+    scheduler.stop()
+
+
+class ModelWorkerPool:
+    """
+    Router over forked model workers
+
+    The model is loaded once in the API process and the workers are forked
+    afterwards, so every replica shares the weight pages copy-on-write.
+    Each worker runs its own continuous batching scheduler on a disjoint
+    set of cores. The router sends each request to the worker with the
+    fewest outstanding sequences and exposes the same submit interface
+    as ContinuousBatchScheduler.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        num_workers: int,
+        cores_per_worker: int = 0,
+        max_batch_size: int = 8,
+        max_queue_size: int = 64,
+        idle_wait_seconds: float = 0.05,
+        prefix_texts: Optional[List[str]] = None,
+        speculative=None,
+        prompt_lookup=None,
+        prefill_buckets: Optional[List[int]] = None,
+        adapters=None,
+    ):
+        """
+        Initialize the pool
+
+        Args:
+            model: CPU model shared by the workers
+            tokenizer: Tokenizer matching the model
+            num_workers: Number of worker processes
+            cores_per_worker: Cores pinned per worker (0 = divide evenly)
+            max_batch_size: Batch size of each worker's scheduler
+            max_queue_size: Waiting-queue size of each worker's scheduler
+            idle_wait_seconds: Scheduler sleep interval when idle
+            prefix_texts: Preambles each worker precomputes KV states for
+            speculative: Optional SpeculativeDecoder; each worker gets its own forked copy
+            prompt_lookup: Optional prompt-lookup SpeculativeDecoder for the workers
+            prefill_buckets: Prompt lengths each worker pads prefill to
+            adapters: Optional AdapterRegistry; each worker gets its own forked copy
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.num_workers = num_workers
+        self.core_sets = split_cores(num_workers, cores_per_worker)
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.scheduler_kwargs = {
+            "max_batch_size": max_batch_size,
+            "max_queue_size": max_queue_size,
+            "idle_wait_seconds": idle_wait_seconds,
+            "speculative": speculative,
+            "prompt_lookup": prompt_lookup,
+            "prefill_buckets": prefill_buckets,
+            "adapters": adapters,
+        }
+        self.prefix_texts = prefix_texts or []
+        self.prefix_cache = None
+        # The router's copy of the registry; workers hold forked ones
+        self.adapters = adapters
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._processes = []
+        self._request_queues = []
+        self._response_queue = None
+        self._listener: Optional[threading.Thread] = None
+        # request_id -> (worker index, futures, token callback)
+        self._pending: Dict[int, tuple] = {}
+        # call_id -> (future, per-worker outcomes, "all" | "each" | "one")
+        self._calls: Dict[int, tuple] = {}
+        self._outstanding = [0] * num_workers
+
+    @property
+    def num_active(self) -> int:
+        return sum(min(n, self.max_batch_size) for n in self._outstanding)
+
+    @property
+    def num_waiting(self) -> int:
+        return sum(max(0, n - self.max_batch_size) for n in self._outstanding)
+
+    def start(self):
+        """Fork the workers and start listening for their results"""
+        context = multiprocessing.get_context("fork")
+        self._response_queue = context.Queue()
+
+        for index, cores in enumerate(self.core_sets):
+            request_queue = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                args=(
+                    index,
+                    cores,
+                    self.model,
+                    self.tokenizer,
+                    self.scheduler_kwargs,
+                    self.prefix_texts,
+                    request_queue,
+                    self._response_queue,
+                ),
+                name=f"model-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+            self._request_queues.append(request_queue)
+
+        self._listener = threading.Thread(target=self._listen, name="worker-pool-listener", daemon=True)
+        self._listener.start()
+        logger.info(f"Started {self.num_workers} model workers on cores {self.core_sets}")
+
+    def stop(self):
+        """Stop every worker and fail requests still pending"""
+        for request_queue in self._request_queues:
+            request_queue.put(("stop",))
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        if self._response_queue is not None:
+            self._response_queue.put(None)
+        if self._listener is not None:
+            self._listener.join()
+
+        error = RuntimeError("Worker pool stopped")
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            calls = list(self._calls.values())
+            self._calls.clear()
+        for _, futures, _ in pending:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+        for future, _, _ in calls:
+            if not future.done():
+                future.set_exception(error)
+
+        self._processes, self._request_queues = [], []
+        self._listener = None
+
+    def submit(self, prompt_ids: List[int], params: SamplingParams) -> Future:
+        return self.submit_many(prompt_ids, [params])[0]
+
+    def submit_many(
+        self,
+        prompt_ids: List[int],
+        params_list: List[SamplingParams],
+        on_token: Optional[Callable[[int, int], None]] = None,
+        pruning: Optional[PruningPolicy] = None,
+    ) -> List[Future]:
+        """
+        Route a group of sequences to the least-loaded worker
+
+        Args:
+            prompt_ids: Tokenized prompt
+            params_list: Sampling settings, one entry per sequence
+            on_token: Optional callback receiving (sequence index, token id)
+            pruning: Optional policy for stopping the group's weakest samples early
+
+        Returns:
+            Futures resolving to GenerationResults
+
+        Raises:
+            QueueFullError: If no worker has room for the group
+        """
+        capacity = self.max_batch_size + self.max_queue_size
+        with self._lock:
+            worker = min(range(self.num_workers), key=lambda i: self._outstanding[i])
+            if self._outstanding[worker] + len(params_list) > capacity:
+                raise QueueFullError(f"All {self.num_workers} model workers are full")
+
+            request_id = next(self._ids)
+            futures = [Future() for _ in params_list]
+            self._pending[request_id] = (worker, futures, on_token)
+            self._outstanding[worker] += len(params_list)
+
+        for future in futures:
+            future.add_done_callback(functools.partial(self._on_done, request_id))
+        self._request_queues[worker].put(
+            ("submit", request_id, list(prompt_ids), list(params_list), on_token is not None, pruning)
+        )
+        return futures
+
+    def uses_adapter(self, name: str) -> bool:
+        # Each worker checks its own sequences before an adapter is detached
+        return False
+
+    def call(self, fn: Callable) -> Future:
+        """
+        Run a function on every worker's scheduler thread
+
+        Args:
+            fn: Picklable callable, called with each worker's scheduler
+
+        Returns:
+            Future resolving to the per-worker results, or to the first worker's error
+        """
+        return self._broadcast(fn, "all")
+
+    def call_each(self, fn: Callable) -> Future:
+        """
+        Run a function on every worker's scheduler thread, collecting failures too
+
+        Args:
+            fn: Picklable callable, called with each worker's scheduler
+
+        Returns:
+            Future resolving to each worker's (error, result), so a change that
+            only some workers applied can be rolled back
+        """
+        return self._broadcast(fn, "each")
+
+    def _broadcast(self, fn: Callable, mode: str) -> Future:
+        with self._lock:
+            call_id = next(self._ids)
+            future = Future()
+            self._calls[call_id] = (future, {}, mode)
+        for request_queue in self._request_queues:
+            request_queue.put(("call", call_id, fn))
+        return future
+
+    def call_one(self, fn: Callable) -> Future:
+        """
+        Run a function on the scheduler thread of the least-loaded worker
+
+        Args:
+            fn: Picklable callable, called with that worker's scheduler
+
+        Returns:
+            Future resolving to fn's return value
+        """
+        with self._lock:
+            call_id = next(self._ids)
+            future = Future()
+            self._calls[call_id] = (future, {}, "one")
+            worker = min(range(self.num_workers), key=lambda i: self._outstanding[i])
+        self._request_queues[worker].put(("call", call_id, fn))
+        return future
+
+    def _on_call_done(self, call_id: int, worker: int, outcome: tuple):
+        with self._lock:
+            entry = self._calls.get(call_id)
+            if entry is None:
+                return
+            future, results, mode = entry
+            results[worker] = outcome
+            if len(results) < (1 if mode == "one" else self.num_workers):
+                return
+            del self._calls[call_id]
+
+        errors = [error for error, _ in results.values() if error is not None]
+        if mode == "each":
+            future.set_result([results[worker] for worker in sorted(results)])
+        elif errors:
+            future.set_exception(errors[0])
+        elif mode == "one":
+            future.set_result(results[worker][1])
+        else:
+            future.set_result([results[worker][1] for worker in sorted(results)])
+
+    def _on_done(self, request_id: int, future: Future):
+        with self._lock:
+            entry = self._pending.get(request_id)
+            if entry is None:
+                return
+            worker, futures, _ = entry
+            self._outstanding[worker] -= 1
+            if all(f.done() for f in futures):
+                del self._pending[request_id]
+        if future.cancelled():
+            self._request_queues[worker].put(("cancel", request_id))
+
+    def _listen(self):
+        """Dispatch worker messages to the waiting futures and token callbacks"""
+        while True:
+            message = self._response_queue.get()
+            if message is None:
+                return
+
+            kind, request_id, seq_index, payload = message
+            if kind == "call":
+                self._on_call_done(request_id, seq_index, payload)
+                continue
+            with self._lock:
+                entry = self._pending.get(request_id)
+            if entry is None:
+                continue
+            _, futures, on_token = entry
+            future = futures[seq_index]
+            if future.done():
+                continue
+
+            if kind == "token":
+                if on_token is not None:
+                    try:
+                        on_token(seq_index, payload)
+                    except Exception as e:
+                        logger.warning(f"Token callback failed for request {request_id}: {e}")
+            else:
+                try:
+                    if kind == "result":
+                        future.set_result(payload)
+                    else:
+                        future.set_exception(payload if isinstance(payload, Exception) else RuntimeError(payload))
+                except InvalidStateError:
+                    # Cancelled by the caller while the message was in transit
+                    pass
@@ -10,7 +10,11 @@ export interface GenerateRequest {
     temperature?: number;
     max_tokens?: number;
     num_variants?: number;
+    best_of?: number;
     style?: string;
+    seed?: number;
+    adapter?: string;
+    include_timings?: boolean;
 }
 
 export interface CodeVariant {
@@ -20,16 +24,64 @@ export interface CodeVariant {
     score: number;
 }
 
+export interface CandidateScore {
+    index: number;
+    score: number;
+    mean_logprob: number | null;
+    total_logprob: number;
+    tokens: string[];
+    surprisal: number[];
+}
+
+export interface ScoreResponse {
+    scores: CandidateScore[];
+    prompt: string;
+    prompt_tokens: number;
+    scored_at: string;
+}
+
+export interface VariantTimings {
+    variant_id: string;
+    queue_ms: number;
+    prefill_ms: number;
+    decode_ms: number;
+    detokenize_ms: number;
+    tokens_generated: number;
+    tokens_per_second: number;
+}
+
+export interface Timings {
+    tokenize_ms: number;
+    prompt_tokens: number;
+    cached_prompt_tokens: number;
+    variants: VariantTimings[];
+}
+
 export interface GenerateResponse {
     variants: CodeVariant[];
     prompt: string;
     generated_at: string;
+    tokens_saved?: number;
+    timings?: Timings | null;
+}
+
+export interface StreamTokenEvent {
+    variant_id: string;
+    index: number;
+    text: string;
 }
 
 export interface HealthResponse {
-    status: string;
+    status: 'healthy' | 'loading' | 'failed';
     model_loaded: boolean;
+    phase: string;
+    progress: number;
+    elapsed_seconds: number;
+    phase_timings: Record<string, number>;
+    error: string | null;
     device: string;
+    queue_depth: number;
+    active_sequences: number;
     timestamp: string;
 }
 
@@ -39,6 +91,27 @@ export interface ModelInfo {
     model_path: string | null;
     device: string;
     model_type: string;
+    default_adapter?: string | null;
+    adapters?: AdapterInfo[];
+}
+
+export interface AdapterInfo {
+    name: string;
+    path: string;
+    fingerprint: string;
+    attached_at: string;
+    default: boolean;
+}
+
+/**
+ * Message of a FastAPI error body; the 503 sent while the model loads carries
+ * {message, ...startup progress} instead of a string
+ */
+function errorDetail(detail: unknown): string | undefined {
+    if (typeof detail === 'string') {
+        return detail;
+    }
+    return (detail as { message?: string } | null | undefined)?.message;
 }
 
 class AIApiClient {
@@ -73,33 +146,130 @@ class AIApiClient {
                 temperature: request.temperature ?? 0.7,
                 max_tokens: request.max_tokens ?? 512,
                 num_variants: request.num_variants ?? 3,
+                best_of: request.best_of,
                 style: request.style ?? 'lovable',
+                seed: request.seed,
+                adapter: request.adapter,
+                include_timings: request.include_timings,
             }),
         });
 
         if (!response.ok) {
             const error = await response.json();
-            throw new Error(error.detail || 'Failed to generate code');
+            throw new Error(errorDetail(error.detail) || 'Failed to generate code');
         }
 
         return response.json();
     }
 
+    /**
+     * Stream Flutter code variants as they are decoded.
+     * Pass an AbortSignal to cancel generation early.
+     */
+    async generateCodeStream(
+        request: GenerateRequest,
+        onToken: (event: StreamTokenEvent) => void,
+        signal?: AbortSignal,
+    ): Promise<GenerateResponse> {
+        const response = await fetch(`${this.baseUrl}/api/generate/stream`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                prompt: request.prompt,
+                temperature: request.temperature ?? 0.7,
+                max_tokens: request.max_tokens ?? 512,
+                num_variants: request.num_variants ?? 3,
+                best_of: request.best_of,
+                style: request.style ?? 'lovable',
+                seed: request.seed,
+                adapter: request.adapter,
+                include_timings: request.include_timings,
+            }),
+            signal,
+        });
+
+        if (!response.ok || !response.body) {
+            const error = await response.json();
+            throw new Error(errorDetail(error.detail) || 'Failed to generate code');
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary = buffer.indexOf('\n\n');
+            while (boundary !== -1) {
+                const chunk = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                boundary = buffer.indexOf('\n\n');
+
+                const event = chunk.match(/^event: (.*)$/m)?.[1];
+                const data = chunk.match(/^data: (.*)$/m)?.[1];
+                if (!event || !data) continue;
+
+                if (event === 'token') {
+                    onToken(JSON.parse(data));
+                } else if (event === 'done') {
+                    return JSON.parse(data);
+                } else if (event === 'error') {
+                    throw new Error(errorDetail(JSON.parse(data).detail) || 'Failed to generate code');
+                }
+            }
+        }
+
+        throw new Error('Stream ended before generation finished');
+    }
+
     /**
      * Refine existing code based on instructions
      */
-    async refineCode(code: string, instructions: string): Promise<{ refined_code: string }> {
+    async refineCode(
+        code: string,
+        instructions: string,
+        includeTimings: boolean = false,
+    ): Promise<{ refined_code: string; timings?: Timings }> {
         const response = await fetch(`${this.baseUrl}/api/refine`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ code, instructions }),
+            body: JSON.stringify({ code, instructions, include_timings: includeTimings }),
+        });
+
+        if (!response.ok) {
+            const error = await response.json();
+            throw new Error(errorDetail(error.detail) || 'Failed to refine code');
+        }
+
+        return response.json();
+    }
+
+    /**
+     * Rank existing code candidates for a prompt without generating (best first)
+     */
+    async scoreCandidates(
+        prompt: string,
+        candidates: string[],
+        adapter?: string,
+    ): Promise<ScoreResponse> {
+        const response = await fetch(`${this.baseUrl}/api/score`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ prompt, candidates, adapter }),
         });
 
         if (!response.ok) {
             const error = await response.json();
-            throw new Error(error.detail || 'Failed to refine code');
+            throw new Error(errorDetail(error.detail) || 'Failed to score candidates');
         }
 
         return response.json();
@@ -53,11 +53,11 @@ echo -e "   Logs: backend.log"
 echo -e "   URL: http://localhost:8000"
 echo ""
 
-# Wait for backend to be ready
+# Wait for backend to be ready (the API binds immediately; the model keeps loading in the background)
 echo -e "${BLUE}⏳ Waiting for backend to be ready...${NC}"
 for i in {1..30}; do
     if curl -s http://localhost:8000/health > /dev/null 2>&1; then
-        echo -e "${GREEN}✅ Backend is ready!${NC}"
+        echo -e "${GREEN}✅ Backend is up! Model loading progress: curl http://localhost:8000/health${NC}"
         break
     fi
     if [ $i -eq 30 ]; then